@@ -2,10 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 MEDIA_ROOT = BASE_DIR + '/core/static/images'
 DOC_ROOT = BASE_DIR + '/core/static/documents'
+PDF_CACHE_ROOT = DOC_ROOT + '/confirmations'  # rendered confirmations, named by the digest of their html
+PDF_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PDF_WORKERS = 2  # wkhtmltopdf processes running at the same time per web worker
 
 SECRET_KEY = 'it@$m0xes8n(pjxr9m=j=abez2ojem$2euy3%f@ebt2o-t5*rr'
 
@@ -42,10 +46,23 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ),
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
+    'DEFAULT_PAGINATION_CLASS': 'rest.pagination.LimitOffsetOrCursorPagination',  # ?pagination=cursor for cursor pages
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest.renderers.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    # limits of the reservation actions per user and event, '-event' ones for every user together, see rest.throttles
+    'DEFAULT_THROTTLE_RATES': {
+        'claim': '30/min',
+        'claim-event': '100/s',  # sized on the claims the database takes for one event
+        'finish': '30/min',
+        'confirmation': '10/min',  # each call opens an SMTP session
+    },
 }
 
 MIDDLEWARE = [
+    'core.metrics.InstrumentationMiddleware',  # first, measures the whole request
+    'core.routers.PrimaryPinMiddleware',  # first, so the writes of every other middleware pin the client
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -61,8 +78,14 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR + '/core/templates/'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # templates are compiled once per process, the confirmation ones when the app is ready
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -99,6 +122,36 @@ DATABASES = {
     }
 }
 
+# seconds a connection is reused by the requests of a worker thread, 0 closes it after each
+# request as gevent workers must (a connection per greenlet)
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
+# 'pgbouncer' when the connections go through pgbouncer in transaction mode, its server
+# connections change between transactions so the exports can not use server-side cursors
+DATABASE_POOLER = os.environ.get('DATABASE_POOLER', '')
+
+for database in DATABASES.values():
+    database.setdefault('CONN_MAX_AGE', DATABASE_CONN_MAX_AGE)
+    if DATABASE_POOLER == 'pgbouncer':
+        database.setdefault('DISABLE_SERVER_SIDE_CURSORS', True)
+
+DATABASE_HEALTH_CHECKS = True  # check reused connections at the start of each request, see core.health
+
+DATABASE_HEALTH_CHECK_INTERVAL = 10  # seconds between two checks of the same connection
+
+# reads of the endpoints marked on the view sets go to the aliases on DATABASE_REPLICAS,
+# set their TEST MIRROR to 'default' so the test runner does not create them
+DATABASE_ROUTERS = ['core.routers.ReplicaRouter']
+
+# point CACHE_BACKEND/CACHE_LOCATION to a memcached server to share the cache between workers, required in production:
+# the throttles count the calls of every worker in it, manage.py check --deploy and gunicorn refuse the per process default
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -138,4 +191,82 @@ MAIL_PASS = 'academia2tap'
 
 SMTP = 'smtp.gmail.com'
 
-SMTP_PORT = 587
\ No newline at end of file
+SMTP_PORT = 587
+
+CONFIRMATION_CACHE_TIMEOUT = 60 * 60  # seconds the context of a confirmation is cached, changes invalidate it sooner
+
+SEAT_LAYOUT_MAX_AGE = 60 * 5  # seconds clients and CDNs may reuse the seats layout
+
+SEAT_STREAM_BROKER = 'core.streams.DatabaseBroker'  # fans out the seat changes of every process to the event watchers, InMemoryBroker for a single process
+
+SEAT_STREAM_TIMEOUT = 60 * 5  # seconds a seat stream stays open before the client reconnects
+
+SEAT_STREAM_KEEPALIVE = 15  # seconds between keepalive comments on idle seat streams
+
+SEAT_STREAM_POLL = 1  # seconds between reads of the new seat deltas, on PostgreSQL NOTIFY wakes the readers first
+
+SEAT_STREAM_GAP = 5  # seconds a delta id skipped by the readers is looked for, longer than a claim transaction runs
+
+SEAT_STREAM_HISTORY = 60 * 10  # seconds the seat deltas are kept for reconnecting watchers
+
+SEAT_STREAM_BACKLOG = 1000  # deltas sent at most to a reconnecting watcher
+
+SMTP_USE_TLS = True
+
+MAIL_POOL_SIZE = 2  # SMTP connections and mail sender threads per web worker
+
+MAIL_BATCH_SIZE = 50  # messages sent per connection checkout
+
+MAIL_MAX_RETRIES = 3
+
+MAIL_RETRY_BACKOFF = 1.0  # seconds, doubled on each retry
+
+MAIL_FLUSH_TIMEOUT = 20  # seconds an exiting worker waits for its queued mail, under the gunicorn graceful_timeout
+
+TOKEN_VALIDATE_MAX_BATCH = 500  # codes validated per request at the door
+
+DOOR_SNAPSHOT_KEY = SECRET_KEY  # signs the door snapshots, shared with the door devices
+
+DOOR_SNAPSHOT_MARGIN = 60  # seconds a door delta goes back, longer than any transaction stamping a reserve runs
+
+DOOR_SNAPSHOT_HISTORY = 60 * 60 * 24 * 7  # seconds the cancelled codes are kept for the deltas, older versions download it all
+
+EXPORT_CHUNK_SIZE = 2000  # reserves read per round trip by the streaming exports
+
+RESERVE_BULK_MAX_BATCH = 1000  # reserves paid, finished or cancelled per bulk request
+
+DATABASE_REPLICAS = [alias for alias in os.environ.get('DATABASE_REPLICAS', '').split(',') if alias]  # aliases of DATABASES serving reads
+
+DATABASE_REPLICA_MAX_LAG = 5  # seconds a replica may be behind, and reads of a client stay on the primary after it writes
+
+DATABASE_REPLICA_LAG_CHECK = 1  # seconds between lag checks of each replica
+
+ADMISSION_RATE = 0  # users let through per second to the claims of an event, 0 for no waiting room unless set on the event
+
+ADMISSION_TOKEN_MAX_AGE = 60 * 60 * 2  # seconds a queue token is accepted, waiting included
+
+ADMISSION_CACHE_TIMEOUT = 60  # seconds the waiting room of an event, kept on the event, is cached
+
+IDEMPOTENCY_TTL = 60 * 60 * 24  # seconds the responses of calls sent with an Idempotency-Key are replayed
+
+IDEMPOTENCY_LOCK_TIMEOUT = 60  # seconds a call holds its key, longer than any request runs
+
+IDEMPOTENCY_WAIT = 10  # seconds a duplicate waits for the response of the call running with its key
+
+METRICS_ENABLED = True  # per route wall time, queries and phases, served on /metrics
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # bearer token asked by /metrics, closed when empty
+
+METRICS_FLUSH_INTERVAL = 10  # seconds between writes of the metrics of a worker to the shared cache
+
+METRICS_SERVER_TIMING = DEBUG  # Server-Timing header with the phases on every response
+
+PROFILE_SAMPLE_RATE = 0 if sys.argv[1:2] == ['test'] else 0.01  # part of the requests run under cProfile, none under manage.py test
+
+PROFILE_SLOW_SECONDS = 1.0  # profiles of the sampled requests slower than this are kept
+
+PROFILE_ROOT = BASE_DIR + '/profiles'
+
+PROFILE_MAX_FILES = 200
+
+SERIALIZE_FROM_VALUES = os.environ.get('SERIALIZE_FROM_VALUES', '1') != '0'  # list events, seats and reservations from .values() rows instead of model instances
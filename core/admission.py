@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import math
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+
+from core.models import Event
+
+ROOM_KEY = 'admission:{0}:room'
+ISSUED_KEY = 'admission:{0}:issued'
+
+SALT = 'core.admission'
+
+
+class InvalidTicket(Exception):
+    pass
+
+
+class Ticket(object):
+    """Place of a user in the waiting room of an event
+
+    The queue moves ``rate`` positions per second, ``admitted`` is the last position
+    let through so far.
+    """
+
+    def __init__(self, event_id, user_id, position, rate, admitted, token):
+        self.event_id = event_id
+        self.user_id = user_id
+        self.position = position
+        self.rate = rate
+        self.ahead = max(position - admitted, 0) if rate else 0
+        self.wait = self.ahead / rate if rate else 0
+        self.token = token
+
+    @property
+    def admitted(self):
+        return self.ahead == 0
+
+    def to_dict(self):
+        return {
+            'event': self.event_id,
+            'position': self.position,
+            'ahead': self.ahead,
+            'wait': math.ceil(self.wait),
+            'admitted': self.admitted,
+            'token': self.token,
+        }
+
+
+def _load(event_id):
+    row = Event.objects.filter(pk=event_id).values_list('admission_rate', 'admission_opened').first() or (None, None)
+    room = (settings.ADMISSION_RATE if row[0] is None else row[0]), row[1]
+    cache.set(ROOM_KEY.format(event_id), room, settings.ADMISSION_CACHE_TIMEOUT)
+    return room
+
+
+def _read(event_id):
+    """
+    rate, positions issued and opening time of the waiting room, the rate and opening time kept on the event are cached for a while
+    """
+
+    keys = ROOM_KEY.format(event_id), ISSUED_KEY.format(event_id)
+    values = cache.get_many(keys)
+    rate, opened = values.get(keys[0]) or _load(event_id)
+    return rate, values.get(keys[1], 0), opened
+
+
+def _admitted(rate, opened, now):
+    if not rate or opened is None:
+        return 0
+    return int((now - opened) * rate)
+
+
+def get_rate(event_id):
+    """
+    users let through per second to the claims of the event, 0 when the event has no waiting room
+    """
+
+    room = cache.get(ROOM_KEY.format(event_id)) or _load(event_id)
+    return room[0]
+
+
+def set_rate(event_id, rate):
+    """Open, change or close the waiting room of an event
+
+    The users already let through stay admitted, and so does everyone who joined while
+    the waiting room was closed. Opening it lets the next user in right away, the
+    queue moves on at the new rate. The rate is kept on the event, only the positions
+    live in the cache.
+    """
+
+    now = time.time()
+    old_rate, issued, opened = _read(event_id)
+    admitted = min(_admitted(old_rate, opened, now), issued) if old_rate else issued + 1
+    opened = now - admitted / rate if rate else now
+
+    Event.objects.filter(pk=event_id).update(admission_rate=rate, admission_opened=opened)
+    cache.set(ROOM_KEY.format(event_id), (rate, opened), settings.ADMISSION_CACHE_TIMEOUT)
+
+
+def get_status(event_id):
+    rate, issued, opened = _read(event_id)
+    return {'event': event_id, 'rate': rate, 'issued': issued, 'admitted': min(_admitted(rate, opened, time.time()), issued)}
+
+
+def join(event_id, user_id):
+    """Give the user the next position in the waiting room of the event
+
+    An idle queue does not bank the time nobody was waiting: when every issued
+    position was let through, it restarts with the next position admitted right away.
+    Only one of the users joining an idle queue together restarts it, the others take
+    the next positions of the restarted queue. Positions lost by the cache restart the
+    queue the same way, the room stays shut.
+
+    Arguments:
+        event_id {int} -- id of the event
+        user_id {int} -- id of the user, the token is only accepted for this user
+
+    Returns:
+        Ticket -- position of the user and its signed queue token, position 0 when the event has no waiting room
+    """
+
+    now = time.time()
+    rate, issued, opened = _read(event_id)
+    position = 0
+
+    if rate:
+        if opened is None or _admitted(rate, opened, now) > issued:
+            restarted = now - (issued + 1) / rate
+            if Event.objects.filter(pk=event_id, admission_opened=opened).update(admission_opened=restarted):
+                cache.set(ROOM_KEY.format(event_id), (rate, restarted), settings.ADMISSION_CACHE_TIMEOUT)
+                opened = restarted
+            else:
+                rate, opened = _load(event_id)  # restarted by another user
+
+        cache.add(ISSUED_KEY.format(event_id), 0, None)
+        position = cache.incr(ISSUED_KEY.format(event_id))
+
+    token = signing.dumps([event_id, user_id, position], salt=SALT)
+
+    return Ticket(event_id, user_id, position, rate, _admitted(rate, opened, now), token)
+
+
+def check(token, event_id, user_id=None):
+    """Read the place of a queue token in the waiting room, from the cache while the room is cached
+
+    Arguments:
+        token {string} -- queue token given by join
+        event_id {int} -- event the token must have been given for
+        user_id {int} -- user the token must have been given to, None to skip the check
+
+    Raises:
+        InvalidTicket -- Indicating the token is forged, expired or given for another event or user
+
+    Returns:
+        Ticket -- current place of the token
+    """
+
+    try:
+        token_event, token_user, position = signing.loads(token, salt=SALT, max_age=settings.ADMISSION_TOKEN_MAX_AGE)
+    except (signing.BadSignature, TypeError, ValueError):
+        raise InvalidTicket(token)
+
+    if str(token_event) != str(event_id) or (user_id is not None and token_user != user_id):
+        raise InvalidTicket(token)
+
+    rate, _, opened = _read(token_event)
+
+    return Ticket(token_event, token_user, position, rate, _admitted(rate, opened, time.time()), token)
@@ -3,3 +3,37 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from django.core.signals import request_started
+        from django.db.models.signals import post_delete, post_save
+
+        from core import checks, controllers, counters, health, layout, seatmap, signals, streams
+        from core.models import Event, Reserve, Seat, User
+
+        controllers.warm_templates()
+
+        request_started.connect(health.close_unusable_connections, dispatch_uid='health_connections')
+
+        post_save.connect(controllers.on_reserve_changed, sender=Reserve, dispatch_uid='confirmation_reserve_saved')
+        post_delete.connect(controllers.on_reserve_changed, sender=Reserve, dispatch_uid='confirmation_reserve_deleted')
+        signals.seats_claimed.connect(controllers.on_reserve_changed, dispatch_uid='confirmation_seats_claimed')
+        signals.reserves_finished.connect(controllers.on_reserve_changed, dispatch_uid='confirmation_reserves_finished')
+        post_save.connect(controllers.on_event_changed, sender=Event, dispatch_uid='confirmation_event_saved')
+        post_save.connect(controllers.on_user_changed, sender=User, dispatch_uid='confirmation_user_saved')
+
+        post_save.connect(layout.invalidate, sender=Seat, dispatch_uid='layout_seat_saved')
+        post_delete.connect(layout.invalidate, sender=Seat, dispatch_uid='layout_seat_deleted')
+
+        signals.seats_claimed.connect(seatmap.on_seats_claimed, dispatch_uid='seatmap_claimed')
+        signals.seats_released.connect(seatmap.on_seats_released, dispatch_uid='seatmap_released')
+
+        signals.seats_claimed.connect(streams.on_seats_claimed, dispatch_uid='streams_claimed')
+        signals.seats_released.connect(streams.on_seats_released, dispatch_uid='streams_released')
+        signals.seats_paid.connect(streams.on_seats_paid, dispatch_uid='streams_paid')
+
+        signals.seats_claimed.connect(counters.on_seats_claimed, dispatch_uid='counters_claimed')
+        signals.seats_released.connect(counters.on_seats_released, dispatch_uid='counters_released')
+        signals.reserves_finished.connect(counters.on_reserves_finished, dispatch_uid='counters_finished')
+        signals.seats_paid.connect(counters.on_seats_paid, dispatch_uid='counters_paid')
+        signals.reserves_released.connect(counters.on_reserves_released, dispatch_uid='counters_reserves_released')
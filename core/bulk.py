@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, CharField, Value, When
+from django.utils import timezone
+
+from core.codes import generate_codes
+from core.models import Reserve, ReserveSeat
+from core.signals import reserves_finished, seats_paid
+
+PAID = 'paid'
+ALREADY_PAID = 'already_paid'
+FINISHED = 'finished'
+ALREADY_FINISHED = 'already_finished'
+EXPIRED = 'expired'
+CANCELLED = 'cancelled'
+NOT_FOUND = 'not_found'
+
+
+def _locked(key, values, *fields):
+    # the reserves asked by id or code, locked until the end of the transaction
+    fields = dict.fromkeys((key, 'id', 'event_id') + fields)
+    rows = Reserve.objects.select_for_update().filter(**{key + '__in': values}).values(*fields)
+    return {row[key]: row for row in rows}
+
+
+def _results(key, values, statuses):
+    return [{key: value, 'status': statuses.get(value, NOT_FOUND)} for value in values]
+
+
+def _by_event(rows):
+    events = {}
+    for row in rows:
+        events.setdefault(row['event_id'], []).append(row['id'])
+    return events
+
+
+def pay(key, values):
+    """Mark reserves as paid with a single UPDATE
+
+    Arguments:
+        key {string} -- id or code, the field ``values`` are matched on
+        values {list} -- ids or codes of the reserves
+
+    Returns:
+        list -- status of each value: paid, already_paid or not_found
+    """
+
+    with transaction.atomic():
+        rows = _locked(key, values, 'is_paid')
+        paying = [row for row in rows.values() if not row['is_paid']]
+
+        if paying:
+            pks = [row['id'] for row in paying]
+            Reserve.objects.filter(pk__in=pks).update(is_paid=True, updated_at=timezone.now())
+
+            seats = {}
+            for reserve_id, seat_id in ReserveSeat.objects.filter(reserve_id__in=pks).values_list('reserve_id', 'seat_id'):
+                seats.setdefault(reserve_id, []).append(seat_id)
+
+            for event_id, reserve_ids in _by_event(paying).items():
+                seats_paid.send(sender=Reserve, event_id=event_id, reserve_ids=reserve_ids,
+                                seat_ids=[seat_id for pk in reserve_ids for seat_id in seats.get(pk, ())])
+
+    return _results(key, values, {value: ALREADY_PAID if row['is_paid'] else PAID for value, row in rows.items()})
+
+
+def finish(key, values, attempts=5):
+    """Finish reserves, each with a new code, with a single UPDATE
+
+    Reserves whose session expired are left to be released, like a single finish refuses them.
+
+    Arguments:
+        key {string} -- id or code, the field ``values`` are matched on
+        values {list} -- ids or codes of the reserves
+
+    Returns:
+        list -- status of each value: finished, already_finished, expired or not_found
+    """
+
+    now = timezone.now()
+
+    with transaction.atomic():
+        rows = _locked(key, values, 'finished', 'updated_at', 'session')
+
+        statuses, finishing = {}, []
+        for value, row in rows.items():
+            if row['finished']:
+                statuses[value] = ALREADY_FINISHED
+            elif row['updated_at'] + row['session'] < now:
+                statuses[value] = EXPIRED
+            else:
+                statuses[value] = FINISHED
+                finishing.append(row)
+
+        if finishing:
+            pks = [row['id'] for row in finishing]
+            for attempt in range(attempts):
+                codes = Case(*[When(pk=pk, then=Value(code)) for pk, code in zip(pks, generate_codes(len(pks)))],
+                             output_field=CharField())
+                try:
+                    with transaction.atomic():
+                        Reserve.objects.filter(pk__in=pks).update(finished=True, code=codes, updated_at=now)
+                    break
+                except IntegrityError:
+                    # a code was taken by a reserve finished meanwhile
+                    if attempt == attempts - 1:
+                        raise
+
+            for event_id, reserve_ids in _by_event(finishing).items():
+                reserves_finished.send(sender=Reserve, event_id=event_id, reserve_ids=reserve_ids)
+
+    return _results(key, values, statuses)
+
+
+def cancel(key, values):
+    """Delete reserves and release their seats with a single DELETE
+
+    Returns:
+        list -- status of each value: cancelled or not_found
+    """
+
+    with transaction.atomic():
+        rows = _locked(key, values)
+        Reserve.objects.filter(pk__in=[row['id'] for row in rows.values()]).release()
+
+    return _results(key, values, dict.fromkeys(rows, CANCELLED))
@@ -0,0 +1,33 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.core import checks
+
+PROCESS_CACHES = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+
+
+@checks.register('caches', deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    the throttles of the reservation actions count the calls of every worker in the default cache, it must be shared
+    """
+
+    if settings.CACHES['default']['BACKEND'] in PROCESS_CACHES:
+        return [checks.Error('O cache padrão é mantido em cada processo.',
+                             hint='Aponte CACHE_BACKEND e CACHE_LOCATION para um memcached compartilhado pelos workers.',
+                             id='core.E001')]
+    return []
+
+
+@checks.register(deploy=True)
+def check_metrics_token(app_configs, **kwargs):
+    """
+    /metrics answers only with the METRICS_TOKEN bearer token, without one Prometheus can not scrape it
+    """
+
+    if getattr(settings, 'METRICS_ENABLED', True) and not getattr(settings, 'METRICS_TOKEN', ''):
+        return [checks.Warning('METRICS_TOKEN não definido, /metrics recusa todas as requisições.',
+                               hint='Defina METRICS_TOKEN no ambiente e configure o mesmo bearer token no Prometheus.',
+                               id='core.W002')]
+    return []
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+
+from core.models import Event, Reserve, ReserveSeat, Seat
+from core.signals import seats_claimed
+
+
+class SeatTaken(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Assento já reservado por outro aluno.'
+    default_code = 'seat_taken'
+
+    def __init__(self, seats, detail=None):
+        super(SeatTaken, self).__init__(detail)
+        self.seats = seats
+
+
+class TicketLimitReached(APIException):
+    status_code = status.HTTP_300_MULTIPLE_CHOICES
+    default_detail = 'Você selecionou o máximo de assentos disponíveis para sua reserva.'
+    default_code = 'ticket_limit'
+
+    def __init__(self, max_tickets, detail=None):
+        super(TicketLimitReached, self).__init__(detail)
+        self.max_tickets = max_tickets
+
+
+def _seat_ids(values):
+    try:
+        return sorted(set(int(value) for value in values))
+    except (TypeError, ValueError):
+        raise NotFound('Assento não encontrado.')
+
+
+def _add(reserve, event, seats, touch=None):
+    """Insert the seats the reserve does not own yet, in a single statement
+
+    On PostgreSQL the session of the reserve is refreshed to ``touch`` by the same
+    statement, elsewhere by an UPDATE after it.
+
+    Returns:
+        list -- ids of the seats added
+    """
+
+    through, reserve_table = ReserveSeat._meta.db_table, Reserve._meta.db_table
+    seat_ids = [seat.id for seat in seats]
+    insert = ('INSERT INTO {through} (reserve_id, seat_id, event_id) '
+              'SELECT %s, seat.id, %s FROM {seat} seat WHERE seat.id IN ({seats}) '
+              'AND NOT EXISTS (SELECT 1 FROM {through} owned WHERE owned.reserve_id = %s AND owned.seat_id = seat.id) '
+              'RETURNING seat_id').format(through=through, seat=Seat._meta.db_table, seats=', '.join(['%s'] * len(seat_ids)))
+    params = [reserve.pk, event.id] + seat_ids + [reserve.pk]
+
+    if touch is not None and connection.vendor == 'postgresql':
+        insert = 'WITH added AS ({0}), touched AS (UPDATE {1} SET updated_at = %s WHERE id = %s) SELECT seat_id FROM added'.format(
+            insert, reserve_table)
+        params += [touch, reserve.pk]
+        touch = None
+
+    with connection.cursor() as cursor:
+        cursor.execute(insert, params)
+        added = [row[0] for row in cursor.fetchall()]
+
+    if touch is not None:
+        Reserve.objects.filter(pk=reserve.pk).update(updated_at=touch)
+
+    return added
+
+
+def _insert(reserve, event, seats, touch=None):
+    try:
+        with transaction.atomic():
+            return _add(reserve, event, seats, touch)
+    except IntegrityError:
+        pass
+
+    # seats still held by expired sessions are given back before the second and last try
+    if Reserve.objects.filter(event=event, seats__in=seats).expired().release()[0]:
+        try:
+            with transaction.atomic():
+                return _add(reserve, event, seats, touch)
+        except IntegrityError:
+            pass
+
+    taken = ReserveSeat.objects.filter(event=event, seat__in=seats).exclude(reserve=reserve).values_list('seat_id', flat=True)
+    raise SeatTaken(seats=list(taken))
+
+
+def claim_seats(alumn, event_id, seat_ids):
+    """Add seats to the reserve of an alumn for an event, creating the reserve when needed
+
+    Every seat is claimed or none is: ``ReserveSeat`` is unique per (event, seat), so two
+    alumns racing for the same seat end with one winner, and the reserve row is locked
+    while its tickets are counted so parallel clicks can not go over ``Event.max_tickets``.
+    The tickets are counted once the lock is held, a query taking its snapshot before the
+    lock misses the seats of a parallel claim, the seats already owned are skipped by the
+    insert itself.
+
+    Arguments:
+        alumn {User} -- alumn owning the reserve
+        event_id {int} -- event of the reserve
+        seat_ids {list} -- seats to add to the reserve
+
+    Raises:
+        NotFound -- Indicating the event or some seat does not exist
+        ValidationError -- Indicating the reserve session expired, its seats were released
+        TicketLimitReached -- Indicating the seats are over the event tickets limit
+        SeatTaken -- Indicating some seat belongs to another reserve
+
+    Returns:
+        tuple -- the reserve, the seats and the tickets still available (None when unlimited)
+    """
+
+    seat_ids = _seat_ids(seat_ids)
+    if not seat_ids:
+        raise ValidationError('Nenhum assento informado.')
+
+    try:
+        event = Event.objects.only('id', 'max_tickets').get(pk=event_id)
+    except (Event.DoesNotExist, TypeError, ValueError):
+        raise NotFound('Evento não encontrado.')
+
+    seats = list(Seat.objects.filter(pk__in=seat_ids))
+    if len(seats) != len(seat_ids):
+        raise NotFound('Assento não encontrado.')
+
+    with transaction.atomic():
+        reserve, created = Reserve.objects.select_for_update().get_or_create(alumn=alumn, event=event)
+
+        expired = not created and reserve.is_expired
+        if expired:
+            Reserve.objects.filter(pk=reserve.pk).release()
+        else:
+            # counted in its own statement, after the lock is granted
+            tickets = 0 if created else ReserveSeat.objects.filter(reserve=reserve).count()
+            if event.max_tickets is not None and tickets + len(seats) > event.max_tickets:
+                # over the limit unless some seats are owned already, only then are they read
+                owned = set(ReserveSeat.objects.filter(reserve=reserve).values_list('seat_id', flat=True))
+                if len(owned | set(seat_ids)) > event.max_tickets:
+                    raise TicketLimitReached(event.max_tickets)
+
+            # refresh the session, a new reserve is fresh
+            touch = None if created else timezone.now()
+            added = _insert(reserve, event, seats, touch)
+            tickets += len(added)
+            if touch is not None:
+                reserve.updated_at = touch
+
+            if added:
+                seats_claimed.send(sender=Reserve, event_id=event.id, seat_ids=sorted(added), reserve_id=reserve.pk)
+
+    if expired:
+        raise ValidationError('Sua sessão expirou e sua reserva não foi finalizada. Escolha novos assentos para continuar.')
+
+    available = event.max_tickets - tickets if event.max_tickets is not None else None
+
+    return reserve, seats, available
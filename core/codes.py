@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import secrets
+
+from django.db import IntegrityError, transaction
+
+from core.models import Reserve
+
+CODE_BYTES = 5  # 10 hex digits, the size of Reserve.code
+
+
+def generate_code():
+    return secrets.token_hex(CODE_BYTES).upper()
+
+
+def save_with_code(reserve, attempts=5):
+    """Give a reserve a new random code and save it
+
+    ``Reserve.code`` is unique: a code drawn twice fails the insert of the second reserve,
+    which draws another one instead of sharing the code.
+
+    Arguments:
+        reserve {Reserve} -- reserve to save with a code
+        attempts {int} -- codes tried before giving up
+
+    Raises:
+        IntegrityError -- Indicating every code tried was taken
+    """
+
+    for attempt in range(attempts):
+        reserve.code = generate_code()
+        try:
+            with transaction.atomic():
+                reserve.save()
+                return reserve
+        except IntegrityError:
+            if attempt == attempts - 1 or not Reserve.objects.filter(code=reserve.code).exclude(pk=reserve.pk).exists():
+                raise
+
+
+def generate_codes(quantity):
+    """Draw codes not taken by any reserve, a query per round of draws
+
+    A code may still be taken by a reserve finished meanwhile, callers saving the codes
+    draw them again when the unique index rejects one.
+
+    Returns:
+        list -- ``quantity`` distinct codes
+    """
+
+    codes = set()
+    while len(codes) < quantity:
+        drawn = {generate_code() for _ in range(quantity - len(codes))} - codes
+        codes |= drawn - set(Reserve.objects.filter(code__in=drawn).values_list('code', flat=True))
+
+    return list(codes)
@@ -1,33 +1,124 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import os
-import uuid
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-
-import pdfkit
-from django.http import HttpResponse
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse
 from django.template import Context, TemplateDoesNotExist
 from django.template.loader import get_template
 from rest_framework.exceptions import NotFound, ValidationError
 
-from api import settings
+from core.documents import get_renderer
+from core.mail import build_message, get_mail_queue
+from core.models import Event, Reserve, Seat, User
+
+CONFIRMATION_TEMPLATES = ('booking-confirmation.html', 'emails/booking-confirmation.html')
+CONFIRMATION_KEY = 'confirmation:{0}'
+
+logger = logging.getLogger(__name__)
+
+
+def warm_templates():
+    """
+    compile the confirmation templates, kept by the cached template loader
+    """
+
+    for template_src in CONFIRMATION_TEMPLATES:
+        get_template(template_src)
+
+
+def get_confirmation_context(pk):
+    """Context of the confirmation templates of a reserve
+
+    Read with a single query joining the reserve, its alumn, event and seats, and
+    kept in the cache for CONFIRMATION_CACHE_TIMEOUT seconds or until the reserve, its
+    alumn or its event change (see invalidate_confirmation).
+
+    Raises:
+        NotFound -- Indicating the reserve does not exist
+
+    Returns:
+        dict -- context of the confirmation
+    """
+
+    key = CONFIRMATION_KEY.format(pk)
+    context = cache.get(key)
+    if context is not None:
+        return context
+
+    rows = Reserve.objects.filter(pk=pk).values(
+        'code', 'alumn__first_name', 'alumn__last_name', 'alumn__email', 'event__title', 'event__date',
+        'seats__type', 'seats__row', 'seats__column')
+
+    try:
+        rows = list(rows)
+    except (TypeError, ValueError):
+        rows = []
+
+    if not rows:
+        raise NotFound('Reserva não encontrada')
+
+    row = rows[0]
+    alumn = User(first_name=row['alumn__first_name'], last_name=row['alumn__last_name'])
+    event = Event(title=row['event__title'], date=row['event__date'])
+
+    context = {
+        'alumn_name': alumn.get_full_name(),
+        'alumn_email': row['alumn__email'],
+        'event_title': event.title,
+        'event_date': event.slug_date if event.date else None,
+        'event_hour': event.slug_hour if event.date else None,
+        'seats': [Seat(type=row['seats__type'], row=row['seats__row'], column=row['seats__column']).slug
+                  for row in rows if row['seats__row'] is not None],
+        'code': row['code']
+    }
+
+    cache.set(key, context, settings.CONFIRMATION_CACHE_TIMEOUT)
+
+    return context
+
+
+def invalidate_confirmation(*pks):
+    cache.delete_many([CONFIRMATION_KEY.format(pk) for pk in pks])
+
+
+def on_reserve_changed(sender, instance=None, reserve_id=None, reserve_ids=(), **kwargs):
+    pks = [pk for pk in (instance.pk if instance is not None else None, reserve_id) if pk is not None] + list(reserve_ids)
+    if pks:
+        transaction.on_commit(lambda: invalidate_confirmation(*pks))
+
+
+def on_event_changed(sender, instance, created=False, update_fields=None, **kwargs):
+    if created or (update_fields and not {'title', 'date'} & set(update_fields)):
+        return
+    transaction.on_commit(lambda: invalidate_confirmation(*Reserve.objects.filter(event=instance.pk).values_list('pk', flat=True)))
 
 
-def render_to_pdf(template_src, context={}):
+def on_user_changed(sender, instance, created=False, update_fields=None, **kwargs):
+    if created or (update_fields and not {'first_name', 'last_name', 'email'} & set(update_fields)):
+        return  # a login only saves last_login
+    transaction.on_commit(lambda: invalidate_confirmation(*Reserve.objects.filter(alumn=instance.pk).values_list('pk', flat=True)))
+
+
+def render_to_pdf(template_src, context={}, poll_url=None):
     """Generate a pdf file from template
 
+    The pdf is rendered by the workers of core.documents, the first request for a
+    document answers 202 and the client polls ``poll_url`` until it is ready.
+
     Arguments:
         template_src {string} -- path from template
+        poll_url {string} -- url to poll while the pdf is rendering
 
     Raises:
         ValidationError -- Indicating error on getting the template
         ValidationError -- Indicating error making pdf
 
     Returns:
-        Response -- Response with the pdf file for download
+        Response -- Response with the pdf file for download or 202 while it is rendering
     """
 
     try:
@@ -36,24 +127,23 @@ def render_to_pdf(template_src, context={}):
         raise ValidationError('Template não encontrado.')
 
     html = template.render(context)
-    # return HttpResponse(html)
-    filepath = settings.DOC_ROOT
-    filename = uuid.uuid4().hex + '.pdf'
-    full_path = os.path.join(filepath, filename)
 
     try:
-        pdfkit.from_string(html, full_path)
+        pdf = get_renderer().get_or_submit(html)
     except Exception as e:
-        raise ValidationError('Erro ao gerar o arquivo PDF. %s' % e.message)
+        raise ValidationError('Erro ao gerar o arquivo PDF. %s' % e)
 
-    pdf = open(os.path.join(filepath, filename))
+    if pdf is None:
+        response = JsonResponse({'info': 'O comprovante está sendo gerado, tente novamente em instantes.', 'poll': poll_url},
+                                status=202)
+        response['Retry-After'] = '1'
+        if poll_url:
+            response['Location'] = poll_url
+        return response
 
-    response = HttpResponse(pdf.read(), content_type='application/pdf')
+    response = HttpResponse(pdf, content_type='application/pdf')
     response['Content-Disposition'] = 'attachment; filename=confirmation.pdf'
 
-    pdf.close()
-    os.remove('confirmation.pdf')
-
     return response
 
 
@@ -69,6 +159,18 @@ def render(template_src, context={}):
 
 
 def send_mail(template_src, context={}, mail_from='', mail_to=''):
+    """Queue an email rendered from template
+
+    The message is sent by the background sender of core.mail, through its pool of
+    SMTP connections.
+
+    Arguments:
+        template_src {string} -- path from template
+
+    Raises:
+        ValidationError -- Indicating error on getting the template
+    """
+
     try:
         template = get_template(template_src)
     except TemplateDoesNotExist:
@@ -76,30 +178,48 @@ def send_mail(template_src, context={}, mail_from='', mail_to=''):
 
     html = template.render(context)
 
-    # connect to server
-    server = smtplib.SMTP(settings.SMTP, settings.SMTP_PORT)
-    server.ehlo()
-    server.starttls()
-    server.ehlo()
-    server.login(settings.MAIL_USER, settings.MAIL_PASS)
+    get_mail_queue().send(build_message(html, mail_from if mail_from else settings.MAIL_USER, mail_to))
+
+
+def send_bulk_mail(template_src, contexts, mail_from=''):
+    """Queue one email per context as a single job
 
-    # send the message
-    msg = MIMEMultipart('related')
-    msg['From'] = mail_from if mail_from else settings.MAIL_USER
-    msg['To'] = mail_to
-    msg['Subject'] = 'Confirmação de Reserva'
-    msg.preamble = 'This is a multi-part message in MIME format.'
+    Contexts are read and rendered by the background sender, each message goes to
+    the ``alumn_email`` of its context.
 
-    msg_alternative = MIMEMultipart('alternative')
-    msg.attach(msg_alternative)
+    Arguments:
+        template_src {string} -- path from template
+        contexts {iterable} -- contexts of the messages, may be a generator
 
-    msg_text = MIMEText('This is the alternative plain text message.')
-    msg_alternative.attach(msg_text)
+    Raises:
+        ValidationError -- Indicating error on getting the template
+    """
 
-    msg_text = MIMEText(html, 'html')
-    msg_alternative.attach(msg_text)
+    try:
+        template = get_template(template_src)
+    except TemplateDoesNotExist:
+        raise ValidationError('Template não encontrado.')
+
+    mail_from = mail_from if mail_from else settings.MAIL_USER
+
+    def messages():
+        for context in contexts:
+            # a message failing to render is skipped, not the rest of the job
+            try:
+                yield build_message(template.render(context), mail_from, context['alumn_email'])
+            except Exception:
+                logger.exception('mail to %s skipped', context.get('alumn_email'))
+
+    get_mail_queue().send_bulk(messages())
 
-    mail = server.sendmail(msg['From'], msg['To'], msg.as_string())
-    server.quit()
 
-    return mail
+def confirmation_contexts(pks):
+    """
+    contexts of the confirmations of many reserves, skipping the reserves deleted before their turn
+    """
+
+    for pk in pks:
+        try:
+            yield get_confirmation_context(pk)
+        except NotFound:
+            logger.warning('confirmation of reserve %s skipped, the reserve was deleted', pk)
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from core.models import Event, Reserve, ReserveSeat
+
+COUNTERS = ('claimed_seats', 'finished_reserves', 'paid_reserves')
+
+
+def _add(event_id, **counters):
+    # a single UPDATE once the change commits, concurrent changes add up instead of overwriting; run in the
+    # transaction of the change it would hold the lock of the event row until then, one claim of the event at a time
+    counters = {name: F(name) + value for name, value in counters.items() if value}
+    if event_id is not None and counters:
+        transaction.on_commit(lambda: Event.objects.filter(pk=event_id).update(**counters))
+
+
+def on_seats_claimed(sender, event_id, seat_ids, **kwargs):
+    _add(event_id, claimed_seats=len(seat_ids))
+
+
+def on_seats_released(sender, event_id, seat_ids, **kwargs):
+    _add(event_id, claimed_seats=-len(seat_ids))
+
+
+def on_reserves_finished(sender, event_id, reserve_ids, **kwargs):
+    _add(event_id, finished_reserves=len(reserve_ids))
+
+
+def on_seats_paid(sender, event_id, reserve_ids, **kwargs):
+    _add(event_id, paid_reserves=len(reserve_ids))
+
+
+def on_reserves_released(sender, event_id, finished, paid, **kwargs):
+    _add(event_id, finished_reserves=-finished, paid_reserves=-paid)
+
+
+def count(event_ids=None):
+    """Count the seats and reserves of the events from the reserves
+
+    Returns:
+        dict -- counters of each event id, events without reserves are left out
+    """
+
+    reserves = Reserve.objects.exclude(event=None)
+    seats = ReserveSeat.objects.exclude(event=None)
+    if event_ids is not None:
+        reserves = reserves.filter(event_id__in=event_ids)
+        seats = seats.filter(event_id__in=event_ids)
+
+    counted = {}
+    for row in reserves.order_by().values('event_id').annotate(finished=Count('pk', filter=Q(finished=True)),
+                                                              paid=Count('pk', filter=Q(is_paid=True))):
+        counted[row['event_id']] = {'claimed_seats': 0, 'finished_reserves': row['finished'], 'paid_reserves': row['paid']}
+
+    for row in seats.order_by().values('event_id').annotate(seats=Count('pk')):
+        counted.setdefault(row['event_id'], {'claimed_seats': 0, 'finished_reserves': 0, 'paid_reserves': 0})
+        counted[row['event_id']]['claimed_seats'] = row['seats']
+
+    return counted
+
+
+def _drifted(event, counted):
+    expected = counted.get(event.id, dict.fromkeys(COUNTERS, 0))
+    return expected if any(getattr(event, name) != expected[name] for name in COUNTERS) else None
+
+
+def reconcile(event_ids=None):
+    """Correct the counters of the events that drifted from their reserves
+
+    Counters drift when reserves are changed bypassing the signals, like bulk updates or the
+    admin, or when a process stops between a change and the update of its counters, sent
+    after the change commits. The events found drifting are counted again with their row locked.
+
+    The counter updates of the signals run after their change commits, in their own
+    statement: one still pending when an event is counted again is added on top of a count
+    that already has its change, and the event drifts until the next reconcile. Counters
+    are exact only once the changes settled, run it again when an event keeps drifting.
+
+    Returns:
+        list -- ids of the events corrected
+    """
+
+    counted = count(event_ids)
+    events = Event.objects.only('id', *COUNTERS)
+    if event_ids is not None:
+        events = events.filter(pk__in=event_ids)
+
+    corrected = []
+    for event_id in [event.id for event in events.iterator() if _drifted(event, counted)]:
+        with transaction.atomic():
+            event = Event.objects.select_for_update().only('id', *COUNTERS).get(pk=event_id)
+            expected = _drifted(event, count([event_id]))
+            if expected:
+                Event.objects.filter(pk=event_id).update(**expected)
+                corrected.append(event_id)
+
+    return corrected
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pdfkit
+from django.conf import settings
+
+from core.metrics import timed
+
+
+class PdfStore(object):
+    """PDF files on disk named by the digest of the html they were rendered from
+
+    When the files go over ``max_bytes`` the least recently used ones are removed.
+    The size of the directory is counted as files are written and read from the disk
+    again only when it goes over, or every ``scan_interval`` seconds to see the files
+    written by the other processes.
+    """
+
+    def __init__(self, root, max_bytes, scan_interval=60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.scan_interval = scan_interval
+        self.lock = threading.Lock()
+        self.size = None
+        self.scanned = 0
+
+    def path(self, digest):
+        return os.path.join(self.root, digest + '.pdf')
+
+    def get(self, digest):
+        path = self.path(digest)
+        try:
+            with open(path, 'rb') as pdf:
+                content = pdf.read()
+        except (IOError, OSError):
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return content
+
+    def put(self, digest, content):
+        os.makedirs(self.root, exist_ok=True)
+
+        # write aside and rename, readers never see a partial file
+        tmp_path = os.path.join(self.root, '.{0}.tmp'.format(uuid.uuid4().hex))
+        with open(tmp_path, 'wb') as pdf:
+            pdf.write(content)
+        os.replace(tmp_path, self.path(digest))
+
+        with self.lock:
+            if self.size is not None:
+                self.size += len(content)
+            if self.size is not None and self.size <= self.max_bytes and time.time() - self.scanned < self.scan_interval:
+                return
+
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            files = []
+            for entry in os.scandir(self.root):
+                if entry.name.endswith('.pdf'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+            self.size, self.scanned = total, time.time()
+
+
+class PdfRenderer(object):
+    """Render PDF files with wkhtmltopdf on a pool of workers, out of the request
+
+    Each html is rendered once: requests for an html already rendered are served
+    from the store, requests for an html still rendering share its job. Jobs leave
+    ``jobs`` as they finish, a failed one stays until the next request raises its error.
+    """
+
+    def __init__(self, store, workers):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def _render(self, digest, html):
+        with timed('wkhtmltopdf'):
+            content = pdfkit.from_string(html, False)
+        self.store.put(digest, content)
+        return content
+
+    def get_or_submit(self, html):
+        """Return the PDF of an html or start rendering it
+
+        Arguments:
+            html {string} -- html to render
+
+        Raises:
+            Exception -- Indicating the rendering job failed, next call starts a new one
+
+        Returns:
+            bytes -- content of the PDF or None while it is rendering
+        """
+
+        digest = hashlib.sha1(html.encode('utf-8')).hexdigest()
+
+        with self.lock:
+            job = self.jobs.get(digest)
+            if job is not None and job.done():
+                del self.jobs[digest]
+                return job.result()
+
+        content = self.store.get(digest)
+        if content is not None:
+            return content
+
+        with self.lock:
+            job = None
+            if digest not in self.jobs:
+                job = self.jobs[digest] = self.executor.submit(self._render, digest, html)
+
+        if job is not None:
+            # outside the lock, a job already done runs the callback right away
+            job.add_done_callback(lambda job: self._finished(digest, job))
+
+        return None
+
+    def _finished(self, digest, job):
+        if job.exception() is not None:
+            return
+
+        with self.lock:
+            if self.jobs.get(digest) is job:
+                del self.jobs[digest]
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer():
+    global _renderer
+
+    with _renderer_lock:
+        if _renderer is None:
+            store = PdfStore(settings.PDF_CACHE_ROOT, settings.PDF_CACHE_MAX_BYTES)
+            _renderer = PdfRenderer(store, settings.PDF_WORKERS)
+
+    return _renderer
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import gzip
+import io
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pytz
+from django.conf import settings
+from django.utils import timezone
+
+from core.doorcheck import signature
+from core.models import DoorRevocation, ReserveSeat
+
+SECTIONS = {'0': 'Balcão', '1': 'Palco'}
+
+MAX_VERSION = 253402300800 * 1000000  # year 10000, in microseconds
+
+
+class DoorSnapshot(object):
+
+    def __init__(self, event_id, version, content):
+        self.event_id = event_id
+        self.version = version
+        self.content = content
+        self.signature = signature(content, settings.DOOR_SNAPSHOT_KEY)
+
+
+def seat_slug(seat_type, row, column):
+    # Seat.slug for values read from the database, where the type is a string
+    return '{0} {1}{2}'.format(SECTIONS.get(str(seat_type), 'Palco'), row, column)
+
+
+def _version(moment):
+    return int(moment.timestamp() * 1000000)
+
+
+def _moment(version):
+    return datetime.fromtimestamp(version / 1000000, tz=pytz.utc)
+
+
+def _compress(data):
+    buffer = io.BytesIO()
+    # no timestamp in the header, the same snapshot always has the same bytes and signature
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as compressed:
+        compressed.write(data)
+    return buffer.getvalue()
+
+
+def build_snapshot(event_id, since=None):
+    """Paid reserve codes of an event and their seat slugs, to check codes at the door offline
+
+    The version is the time of the snapshot, in microseconds, less DOOR_SNAPSHOT_MARGIN
+    seconds: a reserve is stamped before its transaction commits, so the changes stamped
+    in the last seconds may still be committing and are sent again by the next delta.
+    With ``since`` only the reserves updated after that version are listed, along with
+    the codes of the paid reserves deleted since then in ``revoked``. Versions older than
+    DOOR_SNAPSHOT_HISTORY seconds, whose revocations were pruned, get the whole snapshot.
+    ``total`` always counts every paid code.
+
+    Arguments:
+        event_id {int} -- event of the reserves
+        since {int} -- version already held by the client
+
+    Returns:
+        DoorSnapshot -- version, gzip json content and signature of the snapshot
+    """
+
+    now = timezone.now()
+    if since is not None and _moment(since) < now - timedelta(seconds=settings.DOOR_SNAPSHOT_HISTORY):
+        since = None
+    version = max(_version(now - timedelta(seconds=settings.DOOR_SNAPSHOT_MARGIN)), since or 0)
+
+    rows = (ReserveSeat.objects.filter(event_id=event_id, reserve__is_paid=True, reserve__code__isnull=False)
+            .order_by('reserve__code', 'seat_id')
+            .values_list('reserve__code', 'reserve__updated_at', 'seat__type', 'seat__row', 'seat__column'))
+
+    codes = OrderedDict()
+    total = set()
+
+    for code, updated_at, seat_type, row, column in rows:
+        total.add(code)
+
+        if since is None or _version(updated_at) > since:
+            codes.setdefault(code, []).append(seat_slug(seat_type, row, column))
+
+    revoked = []
+    if since is not None:
+        revocations = DoorRevocation.objects.filter(event_id=event_id, created_at__gt=_moment(since))
+        revoked = sorted(set(revocations.values_list('code', flat=True)) - total)  # a code paid again stays
+
+    data = {'event': int(event_id), 'version': version, 'since': since, 'total': len(total), 'codes': codes, 'revoked': revoked}
+    content = _compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    return DoorSnapshot(int(event_id), version, content)
+
+
+def prune_revocations():
+    """
+    delete the revocations older than DOOR_SNAPSHOT_HISTORY, clients holding older versions get the whole snapshot
+    """
+
+    horizon = timezone.now() - timedelta(seconds=settings.DOOR_SNAPSHOT_HISTORY)
+    return DoorRevocation.objects.filter(created_at__lt=horizon).delete()[0]
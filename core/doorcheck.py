@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Check reserve codes at the door without the API
+
+Only the standard library is used, so the module runs on the devices of the door
+staff. A ``DoorList`` is loaded with the snapshot of GET /api/events/id/door-snapshot
+and kept current with the deltas downloaded with ``?since=<version>``.
+"""
+
+import gzip
+import hashlib
+import hmac
+import json
+
+
+class InvalidSnapshot(ValueError):
+    pass
+
+
+def signature(content, key):
+    """
+    signature of a snapshot, sent on its X-Snapshot-Signature header
+    """
+
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+
+    return 'sha256=' + hmac.new(key, content, hashlib.sha256).hexdigest()
+
+
+class DoorList(object):
+    """Paid reserve codes of an event and their seats, held in a dict for constant time checks"""
+
+    def __init__(self, key):
+        self.key = key
+        self.event = None
+        self.version = None
+        self.total = 0
+        self.codes = {}
+
+    @property
+    def complete(self):
+        """
+        False when the codes held do not add up to the paid codes of the event, download it all again
+        """
+
+        return len(self.codes) == self.total
+
+    def load(self, content, content_signature):
+        """Apply a snapshot or a delta
+
+        Arguments:
+            content {bytes} -- body of the door-snapshot response
+            content_signature {string} -- X-Snapshot-Signature header of the response
+
+        Raises:
+            InvalidSnapshot -- Indicating the signature does not match or the delta does not follow the loaded version
+        """
+
+        if not hmac.compare_digest(signature(content, self.key), content_signature or ''):
+            raise InvalidSnapshot('signature does not match')
+
+        snapshot = json.loads(gzip.decompress(content).decode('utf-8'))
+
+        if snapshot['since'] is None:
+            self.codes = {}
+        elif snapshot['event'] != self.event or snapshot['since'] != self.version:
+            raise InvalidSnapshot('delta since {0} does not follow version {1}'.format(snapshot['since'], self.version))
+
+        for code in snapshot.get('revoked', ()):
+            self.codes.pop(code, None)
+        self.codes.update(snapshot['codes'])
+        self.event = snapshot['event']
+        self.version = snapshot['version']
+        self.total = snapshot['total']
+
+    def check(self, code):
+        """
+        seats of a paid reserve code, None when the code is not valid for the event
+        """
+
+        return self.codes.get(code.strip().upper())
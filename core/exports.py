@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import csv
+import io
+import itertools
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from core.door import seat_slug
+from core.models import Reserve, ReserveSeat
+
+COLUMNS = ('id', 'code', 'is_paid', 'finished', 'updated_at', 'alumn_id', 'alumn_first_name', 'alumn_last_name',
+           'alumn_email', 'event_id', 'event_title', 'event_date', 'seats')
+
+FIELDS = ('id', 'code', 'is_paid', 'finished', 'updated_at', 'alumn_id', 'alumn__first_name', 'alumn__last_name',
+          'alumn__email', 'event_id', 'event__title', 'event__date')
+
+
+def reserve_rows(event_id=None, is_paid=None, chunk_size=2000):
+    """Every reserve with its alumn, event and seats, read chunk by chunk
+
+    The reserves come from a server-side cursor joined to their alumn and event, the
+    seats of each chunk are read with one more query, so memory does not grow with the
+    number of reserves.
+
+    Arguments:
+        event_id {int} -- only the reserves of an event
+        is_paid {bool} -- only the paid or the unpaid reserves
+        chunk_size {int} -- reserves read per round trip
+
+    Returns:
+        generator -- a dict per reserve, keyed by COLUMNS
+    """
+
+    reserves = Reserve.objects.order_by('id')
+    if event_id is not None:
+        reserves = reserves.filter(event_id=event_id)
+    if is_paid is not None:
+        reserves = reserves.filter(is_paid=is_paid)
+
+    rows = reserves.values_list(*FIELDS).iterator(chunk_size=chunk_size)
+
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        seats = {}
+        for reserve_id, seat_type, row, column in (ReserveSeat.objects.filter(reserve_id__in=[values[0] for values in chunk])
+                                                   .order_by('seat_id').values_list('reserve_id', 'seat__type', 'seat__row', 'seat__column')):
+            seats.setdefault(reserve_id, []).append(seat_slug(seat_type, row, column))
+
+        for values in chunk:
+            yield dict(zip(COLUMNS, values + (seats.get(values[0], []), )))
+
+
+def to_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow(values)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield line(COLUMNS)
+    for row in rows:
+        yield line([row[column] if column != 'seats' else ';'.join(row['seats']) for column in COLUMNS])
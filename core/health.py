@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def close_unusable_connections(**kwargs):
+    """Close the persistent connections the database dropped while they were idle
+
+    Kept open with CONN_MAX_AGE, a connection may have been closed by the server, a
+    restart or a pooler in the meantime. Django only notices after a query failed,
+    checked at the start of a request the next query opens a new connection instead.
+    Each connection is checked at most once every DATABASE_HEALTH_CHECK_INTERVAL seconds,
+    not with a round trip on every request.
+    """
+
+    if not getattr(settings, 'DATABASE_HEALTH_CHECKS', True):
+        return
+
+    now = time.monotonic()
+    interval = getattr(settings, 'DATABASE_HEALTH_CHECK_INTERVAL', 10)
+
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+
+        checked_at = getattr(connection, 'health_checked_at', None)
+        if checked_at is not None and now - checked_at < interval:
+            continue
+        connection.health_checked_at = now
+
+        if not connection.is_usable():
+            logger.warning('closing unusable connection to %s', connection.alias)
+            connection.close()
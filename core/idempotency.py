@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+RESULT_KEY = 'idempotency:{0}'
+LOCK_KEY = 'idempotency:{0}:lock'
+
+
+class KeyReused(Exception):
+    pass
+
+
+def make_key(*parts):
+    """
+    cache key of an idempotency key in its scope (user, path...), hashed to fit any cache backend
+    """
+
+    return hashlib.sha256('\n'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def get(key, fingerprint):
+    """Return the result stored for an idempotency key
+
+    Arguments:
+        key {string} -- key from make_key
+        fingerprint {string} -- digest of the request, the same key must come with the same request
+
+    Raises:
+        KeyReused -- Indicating the key was used for a different request
+
+    Returns:
+        dict -- status, content and headers of the response, None when no request finished with the key
+    """
+
+    result = cache.get(RESULT_KEY.format(key))
+    if result is not None and result['fingerprint'] != fingerprint:
+        raise KeyReused(key)
+    return result
+
+
+def acquire(key):
+    """
+    take the key for the request about to run, False when a request with the key is running already
+    """
+
+    return cache.add(LOCK_KEY.format(key), True, settings.IDEMPOTENCY_LOCK_TIMEOUT)
+
+
+def release(key):
+    cache.delete(LOCK_KEY.format(key))
+
+
+def wait(key, fingerprint, timeout, interval=0.05):
+    """
+    wait for the result of the request running with the key, None when it did not finish in time
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        result = get(key, fingerprint)
+        if result is not None or time.time() >= deadline:
+            return result
+        time.sleep(interval)
+
+
+def save(key, fingerprint, status, content, headers):
+    """
+    store the response of the request that ran with the key for IDEMPOTENCY_TTL seconds and let the key go
+    """
+
+    cache.set(RESULT_KEY.format(key), {'fingerprint': fingerprint, 'status': status, 'content': content, 'headers': headers},
+              settings.IDEMPOTENCY_TTL)
+    release(key)
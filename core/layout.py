@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+from core.models import Seat
+from core.routers import use_primary
+
+VERSION_KEY = 'seats:layout:version'
+CONTENT_KEY = 'seats:layout:{0}'
+
+SECTIONS = (('1', 'Palco'), ('0', 'Balcão'))
+
+_local = None  # layout of the current version, shared by the requests of this process
+
+
+class Layout(object):
+
+    def __init__(self, version, content):
+        self.version = version
+        self.content = content
+        self.etag = '"{0}"'.format(hashlib.sha1(content).hexdigest())
+
+
+def _column(column):
+    return int(column) if column.isdigit() else column
+
+
+def _column_key(seat):
+    column = _column(seat[0])
+    return (0, column, '') if isinstance(column, int) else (1, 0, column)
+
+
+def build():
+    """Group every seat by section and row
+
+    Returns:
+        bytes -- json with the sections of the hall, each row listing its seats as [id, column] pairs
+    """
+
+    rows = {}
+    for seat_id, seat_type, row, column in Seat.objects.values_list('id', 'type', 'row', 'column'):
+        rows.setdefault(str(seat_type), {}).setdefault(row, []).append((column, seat_id))
+
+    sections = []
+    for seat_type, name in SECTIONS:
+        section_rows = rows.get(seat_type, {})
+        sections.append({
+            'type': int(seat_type),
+            'name': name,
+            'rows': [{'row': row, 'seats': [[seat_id, _column(column)] for column, seat_id in sorted(section_rows[row], key=_column_key)]}
+                     for row in sorted(section_rows)],
+        })
+
+    return json.dumps({'sections': sections}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def get_layout():
+    """Return the layout of the hall
+
+    The content is built once per version and kept in the shared cache and in this
+    process, a request costs a single cache read to check the version.
+    """
+
+    global _local
+
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+
+    if _local is not None and _local.version == version:
+        return _local
+
+    key = CONTENT_KEY.format(version)
+    content = cache.get(key)
+    if content is None:
+        with use_primary():
+            content = build()
+        cache.set(key, content, None)
+
+    _local = Layout(version, content)
+    return _local
+
+
+def invalidate(**kwargs):
+    """
+    bump the version once the seat change commits, a reader building the layout before the commit would keep the old hall
+    under the new version
+    """
+
+    transaction.on_commit(_bump)
+
+
+def _bump():
+    global _local
+
+    _local = None
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import itertools
+import logging
+import queue
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from django.conf import settings
+from django.db import connection
+
+from core.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+def build_message(html, mail_from, mail_to, subject='Confirmação de Reserva'):
+    msg = MIMEMultipart('related')
+    msg['From'] = mail_from
+    msg['To'] = mail_to
+    msg['Subject'] = subject
+    msg.preamble = 'This is a multi-part message in MIME format.'
+
+    msg_alternative = MIMEMultipart('alternative')
+    msg.attach(msg_alternative)
+
+    msg_text = MIMEText('This is the alternative plain text message.')
+    msg_alternative.attach(msg_text)
+
+    msg_text = MIMEText(html, 'html')
+    msg_alternative.attach(msg_text)
+
+    return msg
+
+
+class SMTPConnectionPool(object):
+    """Authenticated SMTP connections kept open and reused between messages
+
+    Idle connections are checked with NOOP before being reused, broken ones are
+    replaced by new connections.
+    """
+
+    def __init__(self, host, port, username=None, password=None, use_tls=True, size=2, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        with timed('smtp'):
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            server.ehlo()
+            if self.use_tls:
+                server.starttls()
+                server.ehlo()
+            if self.password:
+                server.login(self.username, self.password)
+        return server
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                server = self.idle.pop() if self.idle else None
+
+            if server is None:
+                return self._connect()
+
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close(server)
+
+    def release(self, server, broken=False):
+        with self.lock:
+            if not broken and len(self.idle) < self.size:
+                self.idle.append(server)
+                return
+        self._close(server)
+
+    @contextmanager
+    def connection(self):
+        server = self.acquire()
+        try:
+            yield server
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, OSError):
+            self.release(server, broken=True)
+            raise
+        self.release(server)
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for server in idle:
+            self._close(server)
+
+
+class MailQueue(object):
+    """Send messages from a background thread, many messages per SMTP connection
+
+    A job is an iterable of messages, evaluated by the sender threads, so building
+    a large job (e.g. the confirmations of an event) does not hold the request. Each
+    of the ``workers`` threads holds its own SMTP connection, the batches of a job are
+    taken in turns by the idle threads.
+    Messages failing on connection errors or refused for now by the server (4xx
+    replies) are retried with exponential backoff, messages refused for good (5xx)
+    are dropped. The thread dies with the process: flush waits for the queued jobs
+    before a worker exits (see gunicorn.conf.py).
+    """
+
+    def __init__(self, pool, batch_size=50, max_retries=3, backoff=1.0, workers=1):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = [None] * workers
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        with self.lock:
+            for index, thread in enumerate(self.threads):
+                if thread is None or not thread.is_alive():
+                    self.threads[index] = threading.Thread(target=self._run, name='mail-queue-{0}'.format(index), daemon=True)
+                    self.threads[index].start()
+
+    def send(self, message):
+        self.send_bulk([message])
+
+    def send_bulk(self, messages):
+        self.start()
+        self.jobs.put(messages)
+
+    def join(self):
+        """
+        wait until every queued job was processed
+        """
+
+        self.jobs.join()
+
+    def flush(self, timeout):
+        """Wait until every queued job was processed, at most ``timeout`` seconds
+
+        Returns:
+            int -- jobs left unprocessed
+        """
+
+        deadline = time.time() + timeout
+        while self.jobs.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+        if self.jobs.unfinished_tasks:
+            logger.error('mail queue flushed with %d jobs left', self.jobs.unfinished_tasks)
+        return self.jobs.unfinished_tasks
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                messages = iter(job)
+                batch = list(itertools.islice(messages, self.batch_size))
+                if batch:
+                    # the rest of the job goes back to the queue, the next batch is taken by an idle thread
+                    self.jobs.put(messages)
+                    self._deliver(batch)
+            except Exception:
+                logger.exception('mail job failed')
+            finally:
+                # jobs may read the database from this thread
+                connection.close()
+                self.jobs.task_done()
+
+    def _count(self, sent=0, failed=0):
+        with self.lock:
+            self.sent += sent
+            self.failed += failed
+
+    @staticmethod
+    def _refused_for_now(error):
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500 for code, _ in error.recipients.values())
+        return 400 <= error.smtp_code < 500
+
+    def _deliver(self, batch):
+        pending = list(batch)
+
+        for attempt in range(self.max_retries + 1):
+            deferred = []
+            try:
+                with self.pool.connection() as server:
+                    while pending:
+                        message = pending[0]
+                        try:
+                            with timed('smtp'):
+                                server.sendmail(message['From'], message['To'], message.as_string())
+                            self._count(sent=1)
+                        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                            if self._refused_for_now(e):
+                                deferred.append(message)
+                            else:
+                                self._count(failed=1)
+                                logger.warning('mail to %s refused: %s', message['To'], e)
+                        pending.pop(0)
+                pending = deferred
+                if not pending:
+                    return
+                error = 'deferred by the server'
+            except (smtplib.SMTPException, OSError) as e:
+                pending = deferred + pending
+                error = e
+
+            if attempt == self.max_retries:
+                break
+            logger.warning('mail delivery failed (%s), retrying %d messages', error, len(pending))
+            time.sleep(self.backoff * 2 ** attempt)
+
+        self._count(failed=len(pending))
+        logger.error('mail delivery gave up on %d messages', len(pending))
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_mail_queue():
+    global _queue
+
+    with _queue_lock:
+        if _queue is None:
+            pool = SMTPConnectionPool(settings.SMTP, settings.SMTP_PORT, settings.MAIL_USER, settings.MAIL_PASS,
+                use_tls=settings.SMTP_USE_TLS, size=settings.MAIL_POOL_SIZE)
+            _queue = MailQueue(pool, batch_size=settings.MAIL_BATCH_SIZE, max_retries=settings.MAIL_MAX_RETRIES,
+                backoff=settings.MAIL_RETRY_BACKOFF, workers=settings.MAIL_POOL_SIZE)
+
+    return _queue
+
+
+def flush_mail_queue(timeout):
+    """
+    wait at most ``timeout`` seconds for the mail queued by this process, called before it exits
+    """
+
+    if _queue is not None:
+        _queue.flush(timeout)
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.counters import reconcile
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Count the seats and reserves of every event again, correcting the counters that drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, action='append', dest='events',
+            help='Event to reconcile, may be repeated. Every event by default.')
+        parser.add_argument('--loop', action='store_true',
+            help='Keep running as a worker, reconciling every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=300,
+            help='Seconds between runs when --loop is given.')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.time()
+            corrected = reconcile(options['events'])
+            elapsed = time.time() - started
+
+            if corrected:
+                logger.warning('corrected counters of events %s', corrected, extra={'corrected_events': corrected})
+            self.stdout.write('corrected_events={0} elapsed={1:.3f}s'.format(len(corrected), elapsed))
+
+            if not options['loop']:
+                break
+
+            time.sleep(options['interval'])
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core.door import prune_revocations
+from core.models import Reserve
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Delete the unfinished reserves whose session expired and release their seats, and prune the old door revocations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Reserves deleted per transaction.')
+        parser.add_argument('--loop', action='store_true',
+            help='Keep running as a worker, releasing expired reserves every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=30,
+            help='Seconds between runs when --loop is given.')
+
+    def handle(self, *args, **options):
+        if not options['loop']:
+            self.release(options['batch_size'])
+            return
+
+        while True:
+            # a connection dropped by the database is replaced, a failed run is retried on the next one
+            close_old_connections()
+            try:
+                self.release(options['batch_size'])
+            except Exception:
+                logger.exception('release of the expired reserves failed')
+
+            time.sleep(options['interval'])
+
+    def release(self, batch_size):
+        started = time.time()
+        reserves, seats = Reserve.objects.release_expired(batch_size=batch_size)
+        elapsed = time.time() - started
+
+        logger.info('released_reserves=%d released_seats=%d elapsed=%.3f', reserves, seats, elapsed,
+            extra={'released_reserves': reserves, 'released_seats': seats, 'elapsed': elapsed})
+        self.stdout.write('released_reserves={0} released_seats={1} elapsed={2:.3f}s'.format(reserves, seats, elapsed))
+
+        prune_revocations()
@@ -2,7 +2,11 @@
 # -*- coding: utf-8 -*-
 
 from django.contrib.auth.models import BaseUserManager
-from django.db import models
+from django.db import models, transaction
+from django.db.models import DateTimeField, ExpressionWrapper, F, Min
+from django.utils import timezone
+
+from core.signals import reserves_released, seats_released
 
 
 class UserManager(BaseUserManager):
@@ -30,4 +34,83 @@ class UserManager(BaseUserManager):
         if extra_fields.get('is_superuser') is not True:
             raise ValueError('Superuser must have is_superuser=True.')
 
-        return self.create_user(email, password, **extra_fields)
\ No newline at end of file
+        return self.create_user(email, password, **extra_fields)
+
+class ReserveQuerySet(models.QuerySet):
+
+    def expired(self, now=None, shortest=None):
+        """
+        unfinished reserves whose session is over, given the shortest session the rows are first bounded on updated_at
+        so the expiry index on (finished, updated_at) is used
+        """
+
+        now = now or timezone.now()
+        queryset = self.filter(finished=False)
+        if shortest is not None:
+            queryset = queryset.filter(updated_at__lt=now - shortest)
+
+        expires_at = ExpressionWrapper(F('updated_at') + F('session'), output_field=DateTimeField())
+        return queryset.annotate(expires_at=expires_at).filter(expires_at__lt=now)
+
+    def release(self):
+        """
+        delete the reserves and release their seats, returns the number of reserves and seats released
+        """
+
+        through = self.model.seats.through
+        reserved = through.objects.filter(reserve__in=self).values_list('reserve__event_id', 'seat_id')
+
+        released = {}
+        for event_id, seat_id in reserved:
+            released.setdefault(event_id, []).append(seat_id)
+
+        states = {}
+        revoked = []
+        for event_id, finished, is_paid, code in self.values_list('event_id', 'finished', 'is_paid', 'code'):
+            counts = states.setdefault(event_id, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += finished
+            counts[2] += is_paid
+            if is_paid and code and event_id is not None:
+                revoked.append((event_id, code))
+
+        _, deleted = self.delete()
+
+        if revoked:
+            # tombstones of the paid codes for the door deltas, see core.door
+            from core.models import DoorRevocation
+            DoorRevocation.objects.bulk_create([DoorRevocation(event_id=event_id, code=code) for event_id, code in revoked])
+
+        for event_id, seat_ids in released.items():
+            seats_released.send(sender=self.model, event_id=event_id, seat_ids=seat_ids)
+
+        for event_id, (reserves, finished, paid) in states.items():
+            reserves_released.send(sender=self.model, event_id=event_id, reserves=reserves, finished=finished, paid=paid)
+
+        return deleted.get(self.model._meta.label, 0), sum(len(seat_ids) for seat_ids in released.values())
+
+    def release_expired(self, batch_size=500, now=None):
+        """
+        release the expired reserves in batches, returns the number of reserves and seats released
+        """
+
+        now = now or timezone.now()
+        reserves = seats = 0
+
+        shortest = self.filter(finished=False).aggregate(shortest=Min('session'))['shortest']
+        if shortest is None:
+            return reserves, seats
+
+        while True:
+            with transaction.atomic():
+                expired = list(self.expired(now, shortest).values_list('pk', flat=True)[:batch_size])
+                if not expired:
+                    break
+
+                # checks the expiration again, the reserve may have been refreshed in the meantime
+                released = self.filter(pk__in=expired).expired(now).release()
+
+            reserves += released[0]
+            seats += released[1]
+
+        return reserves, seats
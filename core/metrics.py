@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds, of the request duration histogram
+
+EXTERNAL = ('wkhtmltopdf', 'smtp')  # phases spent waiting on other programs or servers
+
+WORKERS_KEY = 'metrics:workers'  # workers registered so far, each worker takes the next number
+FLOOR_KEY = 'metrics:workers:floor'  # first worker whose snapshot may still be cached
+SNAPSHOT_KEY = 'metrics:worker:{0}'
+SNAPSHOT_TIMEOUT = 60 * 60  # seconds the counters of a stopped worker stay exposed
+
+_local = threading.local()  # stats of the request handled by this thread
+
+
+class RequestStats(object):
+    """
+    time spent by one request in each phase, phases nested in themselves are counted once
+    """
+
+    def __init__(self):
+        self.phases = collections.defaultdict(float)
+        self.queries = 0
+        self.active = set()
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to a phase of the current request
+
+    Blocks of the EXTERNAL phases are also counted out of requests, as the pdf and
+    mail workers run them in their own threads.
+    """
+
+    stats = getattr(_local, 'stats', None)
+    nested = stats is not None and phase in stats.active
+    if stats is not None:
+        stats.active.add(phase)
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if stats is not None and not nested:
+            stats.active.discard(phase)
+            stats.phases[phase] += elapsed
+        if phase in EXTERNAL and not nested:
+            registry.observe_external(phase, elapsed)
+
+
+def _count_query(execute, sql, params, many, context):
+    stats = getattr(_local, 'stats', None)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if stats is not None:
+            stats.queries += 1
+            stats.phases['sql'] += time.perf_counter() - started
+
+
+class Registry(object):
+    """Metrics of the requests handled by this process
+
+    Each worker takes a number from the shared cache and writes its counters there
+    every METRICS_FLUSH_INTERVAL seconds, the metrics view exposes the counters of every
+    worker as its own series, labeled by the worker number. The counters of a series
+    only grow: a worker that stopped leaves its series as it was until its snapshot
+    expires, and the worker replacing it starts a new series.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.worker = None
+        self.flushed = 0
+        self.data = self.empty()
+
+    @staticmethod
+    def empty():
+        return {
+            'requests': collections.defaultdict(int),  # (route, method, status) -> requests
+            'duration': collections.defaultdict(lambda: [0] * (len(BUCKETS) + 2)),  # (route,) -> bucket counts, count, sum
+            'phases': collections.defaultdict(float),  # (route, phase) -> seconds
+            'queries': collections.defaultdict(int),  # (route,) -> queries
+            'external': collections.defaultdict(lambda: [0, 0.0]),  # (service,) -> calls, seconds
+        }
+
+    def observe(self, route, method, status, elapsed, stats):
+        with self.lock:
+            self.data['requests'][route, method, str(status)] += 1
+
+            histogram = self.data['duration'][route, ]
+            for index, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += elapsed
+
+            for phase, seconds in stats.phases.items():
+                self.data['phases'][route, phase] += seconds
+            self.data['queries'][route, ] += stats.queries
+
+        self.flush()
+
+    def observe_external(self, service, elapsed):
+        with self.lock:
+            calls = self.data['external'][service, ]
+            calls[0] += 1
+            calls[1] += elapsed
+
+    def snapshot(self):
+        with self.lock:
+            return {name: {labels: (list(value) if isinstance(value, list) else value) for labels, value in values.items()}
+                    for name, values in self.data.items()}
+
+    def flush(self, force=False):
+        interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+        now = time.time()
+        if not force and now - self.flushed < interval:
+            return
+        self.flushed = now
+
+        try:
+            if self.pid != os.getpid():
+                # forked after counting, the child starts its own series
+                with self.lock:
+                    self.pid, self.worker, self.data = os.getpid(), None, self.empty()
+            if self.worker is None:
+                cache.add(WORKERS_KEY, 0, None)
+                self.worker = cache.incr(WORKERS_KEY)
+            cache.set(SNAPSHOT_KEY.format(self.worker), self.snapshot(), SNAPSHOT_TIMEOUT)
+        except Exception:
+            logger.exception('metrics flush failed')
+
+
+registry = Registry()
+
+
+def collect():
+    """
+    last snapshots of every worker, as (worker, snapshot) pairs
+    """
+
+    registry.flush(force=True)
+
+    last = cache.get(WORKERS_KEY) or 0
+    first = cache.get(FLOOR_KEY) or 1
+    keys = {SNAPSHOT_KEY.format(worker): worker for worker in range(first, last + 1)}
+    snapshots = sorted((keys[key], snapshot) for key, snapshot in cache.get_many(list(keys)).items())
+
+    if snapshots and snapshots[0][0] > first:
+        # the snapshots before the first one left expired, their workers stopped
+        cache.set(FLOOR_KEY, snapshots[0][0], None)
+
+    return snapshots
+
+
+def _labels(**labels):
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels.items()) + '}'
+
+
+def exposition(snapshots):
+    """
+    metrics of every worker in the Prometheus text format, sum them by the labels but worker in the queries
+    """
+
+    def samples(name):
+        for worker, snapshot in snapshots:
+            for labels, value in sorted(snapshot.get(name, {}).items()):
+                yield worker, labels, value
+
+    lines = ['# HELP tap_requests_total Requests handled, by route, method and status.', '# TYPE tap_requests_total counter']
+    for worker, (route, method, status), value in samples('requests'):
+        lines.append('tap_requests_total{0} {1}'.format(_labels(route=route, method=method, status=status, worker=worker), value))
+
+    lines += ['# HELP tap_request_duration_seconds Wall time of the requests, by route.', '# TYPE tap_request_duration_seconds histogram']
+    for worker, (route, ), histogram in samples('duration'):
+        for bound, value in zip(BUCKETS, histogram):
+            lines.append('tap_request_duration_seconds_bucket{0} {1}'.format(_labels(route=route, le=bound, worker=worker), value))
+        lines.append('tap_request_duration_seconds_bucket{0} {1}'.format(_labels(route=route, le='+Inf', worker=worker), histogram[-2]))
+        lines.append('tap_request_duration_seconds_count{0} {1}'.format(_labels(route=route, worker=worker), histogram[-2]))
+        lines.append('tap_request_duration_seconds_sum{0} {1:.6f}'.format(_labels(route=route, worker=worker), histogram[-1]))
+
+    lines += ['# HELP tap_request_phase_seconds_total Time of the requests spent in sql, serialize, auth, permissions, throttles...',
+              '# TYPE tap_request_phase_seconds_total counter']
+    for worker, (route, phase), value in samples('phases'):
+        lines.append('tap_request_phase_seconds_total{0} {1:.6f}'.format(_labels(route=route, phase=phase, worker=worker), value))
+
+    lines += ['# HELP tap_sql_queries_total Queries run by the requests, by route.', '# TYPE tap_sql_queries_total counter']
+    for worker, (route, ), value in samples('queries'):
+        lines.append('tap_sql_queries_total{0} {1}'.format(_labels(route=route, worker=worker), value))
+
+    lines += ['# HELP tap_external_calls_total Calls to wkhtmltopdf and the SMTP server.', '# TYPE tap_external_calls_total counter',
+              '# HELP tap_external_seconds_total Time spent in calls to wkhtmltopdf and the SMTP server.',
+              '# TYPE tap_external_seconds_total counter']
+    for worker, (service, ), (calls, seconds) in samples('external'):
+        lines.append('tap_external_calls_total{0} {1}'.format(_labels(service=service, worker=worker), calls))
+        lines.append('tap_external_seconds_total{0} {1:.6f}'.format(_labels(service=service, worker=worker), seconds))
+
+    return '\n'.join(lines) + '\n'
+
+
+def server_timing(elapsed, stats):
+    metrics = ['total;dur={0:.1f}'.format(elapsed * 1000)]
+    for phase, seconds in sorted(stats.phases.items()):
+        metric = '{0};dur={1:.1f}'.format(phase, seconds * 1000)
+        if phase == 'sql':
+            metric += ';desc="{0} queries"'.format(stats.queries)
+        metrics.append(metric)
+    return ', '.join(metrics)
+
+
+def save_profile(profiler, route, elapsed):
+    """
+    dump the profile of a slow request to PROFILE_ROOT, keeping the last PROFILE_MAX_FILES ones
+    """
+
+    root = settings.PROFILE_ROOT
+    os.makedirs(root, exist_ok=True)
+    name = '{0:%Y%m%dT%H%M%S%f}-{1}-{2:.0f}ms.prof'.format(datetime.now(), route, elapsed * 1000)
+    profiler.dump_stats(os.path.join(root, name))
+
+    profiles = sorted(entry.path for entry in os.scandir(root) if entry.name.endswith('.prof'))
+    for path in profiles[:max(len(profiles) - settings.PROFILE_MAX_FILES, 0)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class InstrumentationMiddleware(object):
+    """Measure every request: wall time, queries and the phases timed by the hooks
+
+    Routes are the url names of the view set actions (reserve-add-seat, event-list...).
+    Adds a Server-Timing header when METRICS_SERVER_TIMING is set, and profiles a
+    PROFILE_SAMPLE_RATE sample of the requests, keeping the profiles of the ones slower
+    than PROFILE_SLOW_SECONDS.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            return self.get_response(request)
+
+        stats = _local.stats = RequestStats()
+        profiler = cProfile.Profile() if random.random() < getattr(settings, 'PROFILE_SAMPLE_RATE', 0) else None
+        started = time.perf_counter()
+
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(_count_query))
+                if profiler is not None:
+                    try:
+                        profiler.enable()
+                    except ValueError:
+                        profiler = None  # another profiler runs in this thread
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+        finally:
+            _local.stats = None
+
+        elapsed = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        route = (match.url_name or match.view_name) if match is not None else 'unmatched'
+
+        registry.observe(route, request.method, response.status_code, elapsed, stats)
+
+        if profiler is not None and elapsed >= settings.PROFILE_SLOW_SECONDS:
+            try:
+                save_profile(profiler, route, elapsed)
+            except OSError:
+                logger.exception('profile of %s not saved', route)
+
+        if getattr(settings, 'METRICS_SERVER_TIMING', False):
+            response['Server-Timing'] = server_timing(elapsed, stats)
+
+        return response
@@ -0,0 +1,90 @@
+# Generated by Django 2.0.7 on 2026-10-18 09:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_reserve_event(apps, schema_editor):
+    ReserveSeat = apps.get_model('core', 'ReserveSeat')
+    Reserve = apps.get_model('core', 'Reserve')
+
+    for event_id in Reserve.objects.exclude(event_id=None).values_list('event_id', flat=True).distinct():
+        ReserveSeat.objects.filter(reserve__event_id=event_id).update(event_id=event_id)
+
+    # keep only the first reserve of a seat booked twice for the same event
+    seen = set()
+    duplicated = []
+    for pk, event_id, seat_id in ReserveSeat.objects.exclude(event_id=None).order_by('pk').values_list('pk', 'event_id', 'seat_id'):
+        if (event_id, seat_id) in seen:
+            duplicated.append(pk)
+        seen.add((event_id, seat_id))
+    ReserveSeat.objects.filter(pk__in=duplicated).delete()
+
+
+def merge_duplicate_reserves(apps, schema_editor):
+    ReserveSeat = apps.get_model('core', 'ReserveSeat')
+    Reserve = apps.get_model('core', 'Reserve')
+
+    # the seats of the reserves an alumn made twice for an event go to the paid one, else the finished one, else the first
+    kept = {}
+    duplicated = []
+    reserves = Reserve.objects.exclude(alumn_id=None).exclude(event_id=None).order_by('-is_paid', '-finished', 'pk')
+    for pk, alumn_id, event_id in reserves.values_list('pk', 'alumn_id', 'event_id'):
+        if (alumn_id, event_id) in kept:
+            ReserveSeat.objects.filter(reserve_id=pk).update(reserve_id=kept[alumn_id, event_id])
+            duplicated.append(pk)
+        else:
+            kept[alumn_id, event_id] = pk
+    Reserve.objects.filter(pk__in=duplicated).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20180708_1530'),
+    ]
+
+    operations = [
+        # the table already exists as the auto created through table of Reserve.seats
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ReserveSeat',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('reserve', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Reserve')),
+                        ('seat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Seat')),
+                    ],
+                    options={
+                        'verbose_name': 'Reserved seat',
+                        'verbose_name_plural': 'Reserved seats',
+                        'db_table': 'core_reserve_seats',
+                    },
+                ),
+                migrations.AlterUniqueTogether(
+                    name='reserveseat',
+                    unique_together={('reserve', 'seat')},
+                ),
+                migrations.AlterField(
+                    model_name='reserve',
+                    name='seats',
+                    field=models.ManyToManyField(through='core.ReserveSeat', to='core.Seat'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='reserveseat',
+            name='event',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.Event'),
+        ),
+        migrations.RunPython(copy_reserve_event, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='reserveseat',
+            unique_together={('reserve', 'seat'), ('event', 'seat')},
+        ),
+        migrations.RunPython(merge_duplicate_reserves, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='reserve',
+            unique_together={('alumn', 'event')},
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.0.7 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_reserveseat'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reserve',
+            index=models.Index(fields=['finished', 'updated_at'], name='core_reserve_expiry_idx'),
+        ),
+    ]
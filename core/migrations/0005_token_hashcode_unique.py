@@ -0,0 +1,33 @@
+# Generated by Django 2.0.7 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+def dedupe_hashcodes(apps, schema_editor):
+    Token = apps.get_model('core', 'Token')
+
+    # keep one token per hashcode, preferring the one already validated
+    seen = set()
+    duplicated = []
+    ordering = ('hashcode', models.F('validate_in').asc(nulls_last=True), 'pk')
+    for pk, hashcode in Token.objects.order_by(*ordering).values_list('pk', 'hashcode'):
+        if hashcode in seen:
+            duplicated.append(pk)
+        seen.add(hashcode)
+    Token.objects.filter(pk__in=duplicated).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_reserve_expiry_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_hashcodes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='token',
+            name='hashcode',
+            field=models.CharField(max_length=10, unique=True),
+        ),
+    ]
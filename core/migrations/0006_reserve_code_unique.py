@@ -0,0 +1,39 @@
+# Generated by Django 2.0.7 on 2026-10-18 13:00
+
+import secrets
+
+from django.db import migrations, models
+
+
+def dedupe_codes(apps, schema_editor):
+    Reserve = apps.get_model('core', 'Reserve')
+
+    # the first reserve keeps a code drawn twice, the others get a new one
+    seen = set(Reserve.objects.exclude(code=None).values_list('code', flat=True).distinct())
+    kept = set()
+    for pk, code in Reserve.objects.exclude(code=None).order_by('pk').values_list('pk', 'code'):
+        if code not in kept:
+            kept.add(code)
+            continue
+
+        new_code = secrets.token_hex(5).upper()
+        while new_code in seen:
+            new_code = secrets.token_hex(5).upper()
+        seen.add(new_code)
+        Reserve.objects.filter(pk=pk).update(code=new_code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_token_hashcode_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='reserve',
+            name='code',
+            field=models.CharField(max_length=10, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.0.7 on 2026-10-18 14:00
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def count_reserves(apps, schema_editor):
+    Event = apps.get_model('core', 'Event')
+    Reserve = apps.get_model('core', 'Reserve')
+    ReserveSeat = apps.get_model('core', 'ReserveSeat')
+
+    reserves = Reserve.objects.exclude(event=None).order_by().values('event_id').annotate(
+        finished=Count('pk', filter=Q(finished=True)), paid=Count('pk', filter=Q(is_paid=True)))
+    for row in reserves:
+        Event.objects.filter(pk=row['event_id']).update(finished_reserves=row['finished'], paid_reserves=row['paid'])
+
+    for row in ReserveSeat.objects.exclude(event=None).order_by().values('event_id').annotate(seats=Count('pk')):
+        Event.objects.filter(pk=row['event_id']).update(claimed_seats=row['seats'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_reserve_code_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='claimed_seats',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='finished_reserves',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='paid_reserves',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_reserves, migrations.RunPython.noop),
+    ]
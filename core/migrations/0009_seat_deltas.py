@@ -0,0 +1,35 @@
+# Generated by Django 2.0.7 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_cursor_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeatDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.IntegerField()),
+                ('state', models.CharField(max_length=10)),
+                ('seats', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Seat delta',
+                'verbose_name_plural': 'Seat deltas',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='seatdelta',
+            index=models.Index(fields=['event_id', 'id'], name='core_seatdelta_event_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='seatdelta',
+            index=models.Index(fields=['created_at'], name='core_seatdelta_created_idx'),
+        ),
+    ]
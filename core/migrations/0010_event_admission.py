@@ -0,0 +1,23 @@
+# Generated by Django 2.0.7 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_seat_deltas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='admission_rate',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='admission_opened',
+            field=models.FloatField(null=True),
+        ),
+    ]
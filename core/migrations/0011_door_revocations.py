@@ -0,0 +1,34 @@
+# Generated by Django 2.0.7 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_event_admission'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoorRevocation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.IntegerField()),
+                ('code', models.CharField(max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Door revocation',
+                'verbose_name_plural': 'Door revocations',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='doorrevocation',
+            index=models.Index(fields=['event_id', 'created_at'], name='core_revocation_event_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='doorrevocation',
+            index=models.Index(fields=['created_at'], name='core_revocation_created_idx'),
+        ),
+    ]
@@ -11,7 +11,7 @@ from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.db import models
 from django.utils import timezone
 
-from core.managers import UserManager as CustomUserManager
+from core.managers import ReserveQuerySet, UserManager as CustomUserManager
 
 TZ = pytz.timezone('America/Sao_Paulo')
 
@@ -54,7 +54,7 @@ class User(AbstractBaseUser, PermissionsMixin):
 
 
 class Token(models.Model):
-    hashcode = models.CharField(max_length=10, null=False)
+    hashcode = models.CharField(max_length=10, null=False, unique=True)  # looked up at the door
     validity = models.DateField(null=True)
     validate_in = models.DateField(null=True)
     validate_by = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
@@ -74,12 +74,20 @@ class Event(models.Model):
     date = models.DateTimeField(null=False)
     max_seatings = models.IntegerField(null=True)  # define quantidade máxima de assentos
     max_tickets = models.IntegerField(null=True)   # define quantidade máxima de tickets por aluno
+    claimed_seats = models.IntegerField(default=0)      # seats in reserves, kept by core.counters
+    finished_reserves = models.IntegerField(default=0)
+    paid_reserves = models.IntegerField(default=0)
+    admission_rate = models.FloatField(null=True)       # waiting room, kept by core.admission
+    admission_opened = models.FloatField(null=True)
 
     objects = models.Manager()
 
     class Meta:
         verbose_name = 'Event'
         verbose_name_plural = 'Events'
+        indexes = [
+            models.Index(fields=['date'], name='core_event_date_idx'),  # cursor pages
+        ]
 
     def __unicode__(self):
         return 'Event: {0}, {1}'.format(self.title, self.date)
@@ -92,6 +100,16 @@ class Event(models.Model):
     def slug_hour(self):  # 20:00
         return self.date.strftime('%H:%M')
 
+    @property
+    def free_seats(self):
+        return self.count_free_seats(self.max_seatings, self.claimed_seats)
+
+    @staticmethod
+    def count_free_seats(max_seatings, claimed_seats):
+        if max_seatings is None:
+            return None
+        return max(max_seatings - claimed_seats, 0)
+
 
 class Seat(models.Model):
     row = models.CharField(max_length=10, null=False)
@@ -102,7 +120,11 @@ class Seat(models.Model):
 
     @property
     def slug(self):
-        return '{0} {1}{2}'.format('Balcão' if self.type == 0 else 'Palco', self.row, self.column)
+        return self.make_slug(self.type, self.row, self.column)
+
+    @staticmethod
+    def make_slug(type, row, column):
+        return '{0} {1}{2}'.format('Balcão' if type == 0 else 'Palco', row, column)
 
     @property
     def is_reserved(self):
@@ -123,23 +145,88 @@ class Seat(models.Model):
 class Reserve(models.Model):
     alumn = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
     event = models.ForeignKey(Event, null=True, on_delete=models.SET_NULL)
-    seats = models.ManyToManyField(Seat)
+    seats = models.ManyToManyField(Seat, through='ReserveSeat')
     is_paid = models.BooleanField(default=False)
     finished = models.BooleanField(default=False)
     updated_at = models.DateTimeField(auto_now_add=timezone.localtime(timezone.now(), timezone=TZ))
     session = models.DurationField(default=timedelta(minutes=20))
-    code = models.CharField(max_length=10, null=True)
+    code = models.CharField(max_length=10, null=True, unique=True)  # drawn by core.codes when the reserve is finished
 
-    objects = models.Manager()
+    objects = ReserveQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Reserve'
         verbose_name_plural = 'Reserves'
+        unique_together = (('alumn', 'event'), )
+        indexes = [
+            models.Index(fields=['finished', 'updated_at'], name='core_reserve_expiry_idx'),  # release expired reserves
+            models.Index(fields=['updated_at'], name='core_reserve_updated_idx'),  # cursor pages
+        ]
 
     def __unicode__(self):
         return 'Reserve: {0} reserved for: {1}'.format(self.event, self.alumn)
 
+    @property
+    def is_expired(self):
+        return not self.finished and self.updated_at + self.session < timezone.now()
+
     def save(self, *args, **kwargs):
         # refresh the field update_at
         self.updated_at = timezone.localtime(timezone.now(), timezone=TZ)
         super(Reserve, self).save(*args, **kwargs)
+
+
+class ReserveSeat(models.Model):
+    reserve = models.ForeignKey(Reserve, on_delete=models.CASCADE)
+    seat = models.ForeignKey(Seat, on_delete=models.CASCADE)
+    event = models.ForeignKey(Event, null=True, on_delete=models.SET_NULL)  # copy of reserve.event, a seat is taken once per event
+
+    objects = models.Manager()
+
+    class Meta:
+        db_table = 'core_reserve_seats'
+        verbose_name = 'Reserved seat'
+        verbose_name_plural = 'Reserved seats'
+        unique_together = (('reserve', 'seat'), ('event', 'seat'))
+
+    def __unicode__(self):
+        return 'Reserved seat: {0} for: {1}'.format(self.seat, self.event)
+
+
+class SeatDelta(models.Model):
+    event_id = models.IntegerField(null=False)
+    state = models.CharField(max_length=10, null=False)  # claimed, released or paid
+    seats = models.TextField(null=False)  # json list of seat ids
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        verbose_name = 'Seat delta'
+        verbose_name_plural = 'Seat deltas'
+        indexes = [
+            models.Index(fields=['event_id', 'id'], name='core_seatdelta_event_idx'),  # deltas missed by a reconnecting watcher
+            models.Index(fields=['created_at'], name='core_seatdelta_created_idx'),  # pruning
+        ]
+
+    def __unicode__(self):
+        return 'Seat delta: {0} {1} for: {2}'.format(self.state, self.seats, self.event_id)
+
+
+class DoorRevocation(models.Model):
+    event_id = models.IntegerField(null=False)
+    code = models.CharField(max_length=10, null=False)  # code of a paid reserve deleted, sent to the door as a tombstone
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        verbose_name = 'Door revocation'
+        verbose_name_plural = 'Door revocations'
+        indexes = [
+            models.Index(fields=['event_id', 'created_at'], name='core_revocation_event_idx'),  # deltas
+            models.Index(fields=['created_at'], name='core_revocation_created_idx'),  # pruning
+        ]
+
+    def __unicode__(self):
+        return 'Door revocation: {0} for: {1}'.format(self.code, self.event_id)
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = 'db_primary'
+
+# seconds a PostgreSQL standby is behind, 0 on the primary or once it replayed everything it received
+POSTGRESQL_LAG = """
+    SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+
+_state = threading.local()  # routing of the request handled by this thread
+_lags = {}  # alias -> (checked at, lag in seconds or None when unreachable)
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+def reset(pinned=False):
+    _state.replica_reads = False
+    _state.pinned = pinned
+    _state.wrote = False
+
+
+def set_replica_reads(allowed):
+    """
+    let the next reads of this thread be served by a replica, see ReplicaRouter
+    """
+
+    _state.replica_reads = allowed
+
+
+@contextmanager
+def use_primary():
+    """
+    read from the primary inside the block, for data cached for every client
+    """
+
+    previous = getattr(_state, 'pinned', False)
+    _state.pinned = True
+    try:
+        yield
+    finally:
+        _state.pinned = previous
+
+
+def replica_lag(alias):
+    """Measure how far behind the primary a replica is
+
+    Arguments:
+        alias {string} -- alias of the replica on DATABASES
+
+    Returns:
+        float -- seconds of lag, 0 for backends that do not report it, None when the replica can not be reached
+    """
+
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor != 'postgresql':
+                return 0.0
+            cursor.execute(POSTGRESQL_LAG)
+            return float(cursor.fetchone()[0] or 0)
+    except DatabaseError as e:
+        logger.warning('replica %s unavailable: %s', alias, e)
+        return None
+
+
+def usable_replicas():
+    """
+    replicas within DATABASE_REPLICA_MAX_LAG of the primary, each lag checked once per DATABASE_REPLICA_LAG_CHECK seconds
+    """
+
+    max_lag = getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 5)
+    interval = getattr(settings, 'DATABASE_REPLICA_LAG_CHECK', 1)
+    now = time.monotonic()
+    usable = []
+
+    for alias in get_replicas():
+        checked, lag = _lags.get(alias, (None, None))
+        if checked is None or now - checked >= interval:
+            lag = replica_lag(alias)
+            _lags[alias] = (now, lag)
+        if lag is not None and lag <= max_lag:
+            usable.append(alias)
+
+    return usable
+
+
+class ReplicaRouter(object):
+    """Send the reads of the endpoints that allow it to the replicas on DATABASE_REPLICAS
+
+    Everything else goes to the primary: writes, reads inside transactions, reads
+    after the request wrote (read your writes) and reads of clients pinned by
+    PrimaryPinMiddleware. Without replicas the router leaves the routing to Django.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not get_replicas():
+            return None
+
+        if (not getattr(_state, 'replica_reads', False) or getattr(_state, 'pinned', False) or getattr(_state, 'wrote', False)
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+
+        replicas = usable_replicas()
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if not get_replicas():
+            return None
+
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema from the primary
+        return db not in get_replicas()
+
+
+class PrimaryPinMiddleware(object):
+    """Keep the reads of a client on the primary for a while after it wrote
+
+    Replicas may not have the writes of a request yet, so its response sets a cookie
+    sending the next requests of the client to the primary for DATABASE_REPLICA_MAX_LAG
+    seconds. Also clears the routing state left by the previous request of the thread.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reset(pinned=PIN_COOKIE in request.COOKIES)
+        try:
+            response = self.get_response(request)
+            wrote = _state.wrote
+        finally:
+            reset()
+
+        if wrote:
+            max_age = max(1, math.ceil(getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 5)))
+            response.set_cookie(PIN_COOKIE, '1', max_age=max_age, httponly=True)
+
+        return response
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import base64
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Min
+
+from core.models import Event, Reserve, Seat
+from core.routers import use_primary
+
+CACHE_KEY = 'seatmap:{0}'
+VERSION_KEY = 'seatmap:{0}:version'
+LOCK_KEY = 'seatmap:{0}:lock'
+CACHE_TIMEOUT = 60 * 10
+LOCK_TIMEOUT = 5
+
+
+class SeatMap(object):
+    """Availability index of the seats for one event
+
+    Each seat is a bit in ``bitmap`` at position ``seat_id - offset``, set when
+    the seat belongs to some reserve of the event.
+    """
+
+    def __init__(self, event_id, offset=0, length=0, bitmap=None):
+        self.event_id = event_id
+        self.offset = offset
+        self.length = length
+        self.bitmap = bytearray(bitmap) if bitmap is not None else bytearray((length + 7) // 8)
+
+    @classmethod
+    def build(cls, event_id):
+        """Build the seat map of an event
+
+        Costs two queries whatever the number of seats or reserves: one aggregate
+        over the seats and one over the ``Reserve.seats`` through table.
+
+        Returns:
+            SeatMap -- seat map of the event or None if the event does not exist
+        """
+
+        bounds = Seat.objects.aggregate(first=Min('id'), last=Max('id'))
+        offset = bounds['first'] or 0
+        length = bounds['last'] - offset + 1 if bounds['last'] is not None else 0
+
+        seat_map = cls(event_id, offset, length)
+        reserved = Reserve.seats.through.objects.filter(reserve__event_id=event_id).values_list('seat_id', flat=True)
+        for seat_id in reserved:
+            seat_map.set(seat_id, True)
+
+        if not any(seat_map.bitmap) and not Event.objects.filter(pk=event_id).exists():
+            return None
+
+        return seat_map
+
+    def _position(self, seat_id):
+        position = int(seat_id) - self.offset
+        if position < 0 or position >= self.length:
+            raise IndexError(seat_id)
+        return position
+
+    def set(self, seat_id, reserved):
+        position = self._position(seat_id)
+        if reserved:
+            self.bitmap[position >> 3] |= 1 << (position & 7)
+        else:
+            self.bitmap[position >> 3] &= ~(1 << (position & 7)) & 0xFF
+
+    def __contains__(self, seat_id):
+        try:
+            position = self._position(seat_id)
+        except (IndexError, TypeError, ValueError):
+            return False
+        return bool(self.bitmap[position >> 3] & (1 << (position & 7)))
+
+    def __iter__(self):
+        for position in range(self.length):
+            if self.bitmap[position >> 3] & (1 << (position & 7)):
+                yield self.offset + position
+
+    def to_dict(self):
+        return {
+            'event': self.event_id,
+            'offset': self.offset,
+            'length': self.length,
+            'reserved': sum(bin(byte).count('1') for byte in self.bitmap),
+            'bitmap': base64.b64encode(bytes(self.bitmap)).decode('ascii'),
+        }
+
+
+class ReservedSeats(object):
+    """Seats reserved for any event among ``seat_ids``, read with one query on the first lookup
+
+    ``seat_ids`` may be set after creating it, once the page of seats is known.
+    None reads every reserved seat.
+    """
+
+    def __init__(self, seat_ids=None):
+        self.seat_ids = seat_ids
+        self.reserved = None
+
+    def __contains__(self, seat_id):
+        if self.reserved is None:
+            rows = Reserve.seats.through.objects.all()
+            if self.seat_ids is not None:
+                rows = rows.filter(seat_id__in=self.seat_ids)
+            self.reserved = set(rows.values_list('seat_id', flat=True))
+        return seat_id in self.reserved
+
+
+def _dump(seat_map, version):
+    return version, seat_map.offset, seat_map.length, bytes(seat_map.bitmap)
+
+
+def _version(event_id):
+    # a lost version restarts from the clock, never matching the maps cached before
+    key = VERSION_KEY.format(event_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def _bump(event_id):
+    _version(event_id)
+    try:
+        return cache.incr(VERSION_KEY.format(event_id))
+    except ValueError:
+        return None
+
+
+def get_seat_map(event_id):
+    """Return the cached seat map of an event, building it on a miss
+
+    A cached map is used only when it carries the current version of the event,
+    every change of the seats bumps the version.
+    """
+
+    try:
+        event_id = int(event_id)
+    except (TypeError, ValueError):
+        return None
+
+    key, version_key = CACHE_KEY.format(event_id), VERSION_KEY.format(event_id)
+    values = cache.get_many([key, version_key])
+    cached, version = values.get(key), values.get(version_key)
+    if cached is not None and version is not None and cached[0] == version:
+        return SeatMap(event_id, *cached[1:])
+
+    # read before the seats, a change committed while building bumps it and drops the map
+    version = _version(event_id)
+
+    # kept up to date by the claims from here on, a lagging replica would miss some
+    with use_primary():
+        seat_map = SeatMap.build(event_id)
+    if seat_map is not None:
+        cache.set(key, _dump(seat_map, version), CACHE_TIMEOUT)
+
+    return seat_map
+
+
+def invalidate(event_id):
+    _bump(event_id)
+
+
+def update(event_id, seat_ids, reserved):
+    """Flip the bits of ``seat_ids`` in the cached seat map of an event
+
+    Every change bumps the version of the event, dropping the cached map unless
+    the change is applied to it. One process at a time applies its change, under a
+    lock; a change made by another process meanwhile, or seats out of the map range,
+    leave the map dropped and the next read builds it from the database.
+    """
+
+    key = CACHE_KEY.format(event_id)
+
+    if not cache.add(LOCK_KEY.format(event_id), True, LOCK_TIMEOUT):
+        _bump(event_id)
+        return
+
+    try:
+        version = _version(event_id)
+        cached = cache.get(key)
+        new_version = _bump(event_id)
+        if cached is None or cached[0] != version or new_version != version + 1:
+            return
+
+        seat_map = SeatMap(event_id, *cached[1:])
+        try:
+            for seat_id in seat_ids:
+                seat_map.set(seat_id, reserved)
+        except IndexError:
+            return
+
+        cache.set(key, _dump(seat_map, new_version), CACHE_TIMEOUT)
+    finally:
+        cache.delete(LOCK_KEY.format(event_id))
+
+
+def on_seats_claimed(sender, event_id, seat_ids, **kwargs):
+    if event_id is not None:
+        transaction.on_commit(lambda: update(event_id, seat_ids, True))
+
+
+def on_seats_released(sender, event_id, seat_ids, **kwargs):
+    if event_id is not None:
+        transaction.on_commit(lambda: update(event_id, seat_ids, False))
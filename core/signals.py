@@ -0,0 +1,19 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from django.dispatch import Signal
+
+# sent when seats of an event are added to a reserve
+seats_claimed = Signal(providing_args=['event_id', 'seat_ids', 'reserve_id'])
+
+# sent when seats of an event are given back (cancelled or expired reserves)
+seats_released = Signal(providing_args=['event_id', 'seat_ids'])
+
+# sent when reserves of an event are paid, the first time they are paid, with their seats
+seats_paid = Signal(providing_args=['event_id', 'seat_ids', 'reserve_ids'])
+
+# sent when reserves of an event are finished, the first time they are finished
+reserves_finished = Signal(providing_args=['event_id', 'reserve_ids'])
+
+# sent when reserves of an event are deleted, with how many of them were finished and paid
+reserves_released = Signal(providing_args=['event_id', 'reserves', 'finished', 'paid'])
@@ -0,0 +1,332 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import itertools
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from core.models import SeatDelta
+
+logger = logging.getLogger(__name__)
+
+CLAIMED = 'claimed'
+RELEASED = 'released'
+PAID = 'paid'
+
+
+class Subscription(object):
+
+    def __init__(self, broker, event_id, backlog):
+        self.broker = broker
+        self.event_id = event_id
+        self.queue = queue.Queue()
+        self.seen = set()
+        for delta in backlog:
+            self.put(delta)
+
+    def put(self, delta):
+        # a delta read again by the broker is sent once
+        if delta['id'] not in self.seen:
+            self.seen.add(delta['id'])
+            self.queue.put(delta)
+
+    def get(self, timeout=None):
+        """
+        next delta of the event, None when nothing changed before the timeout
+        """
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker(object):
+    """Fan out seat deltas to the watchers of an event living in this process
+
+    Only sees the deltas published by its own process, for a single process server
+    (runserver) and the tests. Each delta is published once and shared by every watcher, watchers never read
+    the database. The last deltas of each event are kept so a watcher reconnecting
+    with the id of the last delta it saw does not miss any change.
+    """
+
+    def __init__(self, history=256):
+        self.history = history
+        self.lock = threading.Lock()
+        self.sequence = itertools.count(1)
+        self.deltas = collections.defaultdict(lambda: collections.deque(maxlen=self.history))
+        self.subscriptions = collections.defaultdict(set)
+
+    def publish(self, event_id, state, seat_ids):
+        with self.lock:
+            delta = {'id': next(self.sequence), 'event': event_id, 'state': state, 'seats': list(seat_ids)}
+            self.deltas[event_id].append(delta)
+            subscriptions = list(self.subscriptions[event_id])
+
+        for subscription in subscriptions:
+            subscription.put(delta)
+
+        return delta
+
+    def subscribe(self, event_id, last_id=None):
+        with self.lock:
+            backlog = [delta for delta in self.deltas.get(event_id, ()) if last_id is not None and delta['id'] > last_id]
+            subscription = Subscription(self, event_id, backlog)
+            self.subscriptions[event_id].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions[subscription.event_id].discard(subscription)
+            if not self.subscriptions[subscription.event_id]:
+                del self.subscriptions[subscription.event_id]
+
+    def watchers(self, event_id):
+        return len(self.subscriptions.get(event_id, ()))
+
+
+def _to_dict(row):
+    return {'id': row.id, 'event': row.event_id, 'state': row.state, 'seats': json.loads(row.seats)}
+
+
+class DatabaseBroker(object):
+    """Fan out the seat deltas published by every process to the watchers living in this one
+
+    Each delta is a SeatDelta row, its id is the sequence every worker agrees on: a client
+    reconnecting to another worker with the id of the last delta it saw gets the ones it
+    missed, and the releases of the reaper process reach the watchers like the claims.
+    A thread per process reads the new rows, woken by NOTIFY on PostgreSQL and every
+    SEAT_STREAM_POLL seconds on other databases.
+
+    Ids are drawn before the inserts commit, so a row may show up after a higher one:
+    ids skipped by the thread are looked for again until SEAT_STREAM_GAP seconds passed,
+    the time a rolled back insert is given up.
+    """
+
+    channel = 'seat_deltas'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = collections.defaultdict(set)
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.floor = None  # every delta up to this id was read
+        self.top = 0  # highest id read
+        self.read_ids = set()  # ids read above the floor
+        self.missing = {}  # ids skipped above the floor, and when they were first missed
+        self.pruned = 0
+
+    def publish(self, event_id, state, seat_ids):
+        row = SeatDelta.objects.create(event_id=event_id, state=state, seats=json.dumps(list(seat_ids)))
+
+        connection = connections[SeatDelta.objects.db]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('NOTIFY {0}'.format(self.channel))
+        self.wakeup.set()
+
+        return _to_dict(row)
+
+    def subscribe(self, event_id, last_id=None):
+        self.start()
+
+        # taken with the lock, the deltas the thread hands out after it follow the backlog
+        with self.lock:
+            backlog = []
+            if last_id is not None:
+                rows = SeatDelta.objects.filter(event_id=event_id, id__gt=last_id).order_by('id')
+                backlog = [_to_dict(row) for row in rows[:getattr(settings, 'SEAT_STREAM_BACKLOG', 1000)]]
+            subscription = Subscription(self, event_id, backlog)
+            self.subscriptions[event_id].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions[subscription.event_id].discard(subscription)
+            if not self.subscriptions[subscription.event_id]:
+                del self.subscriptions[subscription.event_id]
+
+    def watchers(self, event_id):
+        return len(self.subscriptions.get(event_id, ()))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                # the deltas published from now on, the ones before are read by the reconnecting watchers
+                self.floor = SeatDelta.objects.order_by('-id').values_list('id', flat=True).first() or 0
+                self.thread = threading.Thread(target=self.listen, name='seat-deltas', daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def listen(self):
+        while not self.stopping.is_set():
+            connection = connections[SeatDelta.objects.db]
+            listener = None
+            try:
+                if connection.vendor == 'postgresql':
+                    listener = connection.get_new_connection(connection.get_connection_params())
+                    listener.autocommit = True
+                    listener.cursor().execute('LISTEN {0}'.format(self.channel))
+
+                while not self.stopping.is_set():
+                    self.read()
+                    self.prune()
+                    self.wait(listener)
+            except Exception:
+                logger.exception('seat deltas listener failed')
+                time.sleep(1)
+            finally:
+                connection.close()
+                if listener is not None:
+                    listener.close()
+
+    def wait(self, listener):
+        timeout = getattr(settings, 'SEAT_STREAM_POLL', 1)
+
+        if listener is not None:
+            if select.select([listener], [], [], timeout)[0]:
+                listener.poll()
+                del listener.notifies[:]
+            return
+
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    def read(self):
+        """
+        hand the new deltas to the watchers of their events, and move the floor over the ids read or given up
+        """
+
+        rows = list(SeatDelta.objects.filter(id__gt=self.floor).exclude(id__in=list(self.read_ids)).order_by('id')[:1000])
+        now = time.time()
+
+        if rows:
+            with self.lock:
+                for row in rows:
+                    delta = _to_dict(row)
+                    for subscription in list(self.subscriptions.get(row.event_id, ())):
+                        subscription.put(delta)
+
+            self.read_ids.update(row.id for row in rows)
+            for skipped in range(max(self.floor, self.top) + 1, rows[-1].id):
+                if skipped not in self.read_ids:
+                    self.missing[skipped] = now
+            self.top = max(self.top, rows[-1].id)
+
+        gap = getattr(settings, 'SEAT_STREAM_GAP', 5)
+        while True:
+            following = self.floor + 1
+            if following in self.read_ids:
+                self.read_ids.discard(following)
+            elif following in self.missing and now - self.missing[following] > gap:
+                pass
+            else:
+                break
+            self.missing.pop(following, None)
+            self.floor = following
+
+    def prune(self):
+        # every process prunes, deleting the same old rows twice is harmless
+        if time.time() - self.pruned < 60:
+            return
+        self.pruned = time.time()
+
+        history = getattr(settings, 'SEAT_STREAM_HISTORY', 60 * 10)
+        SeatDelta.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=history)).delete()
+
+
+_broker = None
+
+
+def get_broker():
+    """
+    broker set on SEAT_STREAM_BROKER, created once per process
+    """
+
+    global _broker
+
+    if _broker is None:
+        _broker = import_string(getattr(settings, 'SEAT_STREAM_BROKER', 'core.streams.DatabaseBroker'))()
+
+    return _broker
+
+
+def reset_broker(setting, **kwargs):
+    global _broker
+
+    if setting == 'SEAT_STREAM_BROKER':
+        _broker = None
+
+
+setting_changed.connect(reset_broker, dispatch_uid='streams_broker_setting')
+
+
+def publish(event_id, state, seat_ids):
+    if event_id is not None:
+        transaction.on_commit(lambda: get_broker().publish(event_id, state, seat_ids))
+
+
+def on_seats_claimed(sender, event_id, seat_ids, **kwargs):
+    publish(event_id, CLAIMED, seat_ids)
+
+
+def on_seats_released(sender, event_id, seat_ids, **kwargs):
+    publish(event_id, RELEASED, seat_ids)
+
+
+def on_seats_paid(sender, event_id, seat_ids, **kwargs):
+    publish(event_id, PAID, seat_ids)
+
+
+def event_stream(subscription, snapshot=None):
+    """Server-sent events with the seat deltas of an event
+
+    Arguments:
+        subscription {Subscription} -- subscription to the event, taken before reading the snapshot
+        snapshot {dict} -- current seat map, sent first to new clients
+
+    Returns:
+        generator -- text of the events, ends after SEAT_STREAM_TIMEOUT seconds and the client reconnects
+    """
+
+    keepalive = getattr(settings, 'SEAT_STREAM_KEEPALIVE', 15)
+    deadline = time.time() + getattr(settings, 'SEAT_STREAM_TIMEOUT', 300)
+
+    try:
+        yield 'retry: 1000\n\n'
+
+        if snapshot is not None:
+            yield 'event: snapshot\ndata: {0}\n\n'.format(json.dumps(snapshot))
+
+        while time.time() < deadline:
+            delta = subscription.get(timeout=min(keepalive, max(deadline - time.time(), 0)))
+            if delta is None:
+                yield ': keepalive\n\n'
+                continue
+
+            yield 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(delta['id'], delta['state'], json.dumps(delta))
+    finally:
+        subscription.close()
@@ -1,3 +1,886 @@
-from django.test import TestCase
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+import os
+import random
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+import pytz
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+
+from core import admission, bulk, seatmap
+from core.controllers import confirmation_contexts, get_confirmation_context, send_bulk_mail
+from core.claims import SeatTaken, TicketLimitReached, claim_seats
+from core.codes import save_with_code
+from core.counters import reconcile
+from core.door import build_snapshot
+from core.documents import PdfRenderer, PdfStore
+from core.doorcheck import DoorList, InvalidSnapshot
+from core.health import close_unusable_connections
+from core.mail import MailQueue, SMTPConnectionPool, build_message
+from core.models import Event, Reserve, ReserveSeat, Seat, Token, User
+from core.tokens import EXPIRED, NOT_FOUND, USED, VALID, redeem, redeem_many
+
+TZ = pytz.timezone('America/Sao_Paulo')
+
+
+def create_event(max_tickets=3):
+    return Event.objects.create(title='A princesa Peach no reino encantado do sapateado.',
+        date=datetime(2018, 12, 10, 20, tzinfo=TZ), max_seatings=100, max_tickets=max_tickets)
+
+
+def create_alumns(quantity):
+    return [User.objects.create_user(email='alumn{0}@tap.com'.format(i), username='alumn{0}'.format(i))
+            for i in range(quantity)]
+
+
+class ClaimSeatsTestCase(TestCase):
+
+    def setUp(self):
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 6)]
+        self.mario, self.luigi = create_alumns(2)
+
+    def test_claim_creates_reserve(self):
+        reserve, seats, available = claim_seats(self.mario, self.event.id, [self.seats[0].id])
+
+        self.assertEqual(reserve.alumn, self.mario)
+        self.assertEqual(list(reserve.seats.all()), [self.seats[0]])
+        self.assertEqual(available, 2)
+
+    def test_seat_is_claimed_once_per_event(self):
+        claim_seats(self.mario, self.event.id, [self.seats[0].id])
+
+        with self.assertRaises(SeatTaken) as raised:
+            claim_seats(self.luigi, self.event.id, [self.seats[1].id, self.seats[0].id])
+
+        self.assertEqual(raised.exception.seats, [self.seats[0].id])
+        self.assertFalse(ReserveSeat.objects.filter(reserve__alumn=self.luigi).exists())
+
+        # the same seat is free for other events
+        claim_seats(self.luigi, create_event().id, [self.seats[0].id])
+
+    def test_claim_is_idempotent_for_owned_seats(self):
+        claim_seats(self.mario, self.event.id, [self.seats[0].id])
+        _, _, available = claim_seats(self.mario, self.event.id, [self.seats[0].id])
+
+        self.assertEqual(available, 2)
+        self.assertEqual(ReserveSeat.objects.filter(event=self.event).count(), 1)
+
+    def test_claim_refreshes_the_session(self):
+        reserve, _, _ = claim_seats(self.mario, self.event.id, [self.seats[0].id])
+        Reserve.objects.filter(pk=reserve.pk).update(updated_at=timezone.now() - timedelta(minutes=10))
+
+        with CaptureQueriesContext(connection) as captured:
+            reserve, _, available = claim_seats(self.mario, self.event.id, [self.seats[0].id, self.seats[1].id])
+
+        self.assertEqual(available, 1)
+        self.assertGreater(Reserve.objects.get(pk=reserve.pk).updated_at, timezone.now() - timedelta(minutes=1))
+        # the owned seats are skipped by the insert, not read before it
+        self.assertFalse([query for query in captured.captured_queries if query['sql'].startswith('SELECT "core_reserve_seats"')])
+
+    def test_claim_respects_max_tickets(self):
+        claim_seats(self.mario, self.event.id, [seat.id for seat in self.seats[:2]])
+
+        with self.assertRaises(TicketLimitReached):
+            claim_seats(self.mario, self.event.id, [seat.id for seat in self.seats[2:4]])
+
+        self.assertEqual(ReserveSeat.objects.filter(reserve__alumn=self.mario).count(), 2)
+
+    def test_expired_session_releases_seats(self):
+        reserve, _, _ = claim_seats(self.mario, self.event.id, [self.seats[0].id])
+        Reserve.objects.filter(pk=reserve.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        with self.assertRaises(ValidationError):
+            claim_seats(self.mario, self.event.id, [self.seats[1].id])
+
+        self.assertFalse(Reserve.objects.filter(pk=reserve.pk).exists())
+
+    def test_seat_held_by_expired_session_is_claimed(self):
+        reserve, _, _ = claim_seats(self.mario, self.event.id, [self.seats[0].id])
+        Reserve.objects.filter(pk=reserve.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        claim_seats(self.luigi, self.event.id, [self.seats[0].id])
+
+        self.assertEqual(ReserveSeat.objects.get(event=self.event, seat=self.seats[0]).reserve.alumn, self.luigi)
+
+
+class ReleaseExpiredReservesTestCase(TestCase):
+
+    def setUp(self):
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 6)]
+        self.alumns = create_alumns(3)
+
+    def test_release_expired_reserves(self):
+        expired = []
+        for alumn, seats in zip(self.alumns, (self.seats[0:2], self.seats[2:3], self.seats[3:5])):
+            expired.append(claim_seats(alumn, self.event.id, [seat.id for seat in seats])[0])
+
+        # the last reserve is finished, it never expires
+        Reserve.objects.filter(pk=expired[2].pk).update(finished=True)
+        Reserve.objects.update(updated_at=timezone.now() - timedelta(minutes=21))
+
+        out = StringIO()
+        call_command('release_expired_reserves', batch_size=1, stdout=out)
+
+        self.assertIn('released_reserves=2 released_seats=3', out.getvalue())
+        self.assertEqual(list(Reserve.objects.all()), [expired[2]])
+        self.assertEqual(ReserveSeat.objects.count(), 2)
+
+    def test_loop_survives_database_errors(self):
+        out = StringIO()
+        released = mock.patch.object(Reserve.objects, 'release_expired', side_effect=[DatabaseError('gone'), (1, 2)])
+        # the second sleep stops the loop
+        sleep = mock.patch('core.management.commands.release_expired_reserves.time.sleep', side_effect=[None, KeyboardInterrupt])
+
+        with released as release_expired, sleep, self.assertLogs('core.management.commands.release_expired_reserves', 'ERROR'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('release_expired_reserves', loop=True, interval=0, stdout=out)
+
+        self.assertEqual(release_expired.call_count, 2)
+        self.assertIn('released_reserves=1 released_seats=2', out.getvalue())
+
+    def test_sessions_of_different_lengths(self):
+        reserves = [claim_seats(alumn, self.event.id, [seat.id])[0] for alumn, seat in zip(self.alumns, self.seats)]
+        for reserve, session in zip(reserves, (5, 30, 60)):
+            Reserve.objects.filter(pk=reserve.pk).update(session=timedelta(minutes=session), updated_at=timezone.now() - timedelta(minutes=10))
+
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(Reserve.objects.release_expired(), (1, 1))
+
+        # bounded on updated_at by the shortest session, for the expiry index
+        selects = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('SELECT "core_reserve"."id"')]
+        self.assertIn('"core_reserve"."updated_at" <', selects[0])
+        self.assertEqual(sorted(Reserve.objects.values_list('pk', flat=True)), [reserve.pk for reserve in reserves[1:]])
+
+
+class RedeemTokensTestCase(TestCase):
+
+    def setUp(self):
+        self.today = date(2018, 12, 10)
+        self.admin, = create_alumns(1)
+        Token.objects.create(hashcode='VALID', validity=self.today)
+        Token.objects.create(hashcode='EXPIRED', validity=self.today - timedelta(days=1))
+        Token.objects.create(hashcode='USED', validity=self.today, validate_in=self.today - timedelta(days=2))
+
+    def test_token_is_redeemed_once(self):
+        self.assertEqual(redeem('VALID', self.admin, today=self.today)['status'], VALID)
+        self.assertEqual(redeem('VALID', self.admin, today=self.today)['status'], USED)
+
+        token = Token.objects.get(hashcode='VALID')
+        self.assertEqual((token.validate_in, token.validate_by), (self.today, self.admin))
+
+    def test_redeem_tells_why_token_is_refused(self):
+        self.assertEqual(redeem('EXPIRED', self.admin, today=self.today)['status'], EXPIRED)
+        self.assertEqual(redeem('USED', self.admin, today=self.today)['status'], USED)
+        self.assertEqual(redeem('MISSING', self.admin, today=self.today)['status'], NOT_FOUND)
+        self.assertIsNone(Token.objects.get(hashcode='EXPIRED').validate_in)
+
+    def test_redeem_many(self):
+        with self.assertNumQueries(4):  # savepoint, read and lock, update, release
+            results = redeem_many(['VALID', 'EXPIRED', 'USED', 'MISSING', 'VALID'], self.admin, today=self.today)
+
+        self.assertEqual([result['status'] for result in results], [VALID, EXPIRED, USED, NOT_FOUND, USED])
+        self.assertEqual(Token.objects.get(hashcode='VALID').validate_by, self.admin)
+
+
+class EventCountersTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 4)]
+        self.mario, self.luigi = create_alumns(2)
+        self.admin = User.objects.create_superuser(email='admin@tap.com', username='admin', password='tapacademy')
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def assertCounters(self, claimed, finished, paid):
+        event = Event.objects.get(pk=self.event.pk)
+        self.assertEqual((event.claimed_seats, event.finished_reserves, event.paid_reserves), (claimed, finished, paid))
+        self.assertEqual(event.free_seats, event.max_seatings - claimed)
+
+    def test_counters_follow_reserves(self):
+        reserve, _, _ = claim_seats(self.mario, self.event.id, [self.seats[0].id, self.seats[1].id])
+        claim_seats(self.luigi, self.event.id, [self.seats[2].id])
+        self.assertCounters(3, 0, 0)
+
+        for _ in range(2):
+            self.client.post('/api/reservations/{0}/finish/'.format(reserve.pk), {'finished': True})
+            self.client.post('/api/reservations/{0}/paid/'.format(reserve.pk), {'paid': True})
+        self.assertCounters(3, 1, 1)
+
+        self.client.post('/api/reservations/{0}/cancel/'.format(reserve.pk), {'cancel': True})
+        self.assertCounters(1, 0, 0)
+
+        response = self.client.get('/api/events/{0}/stats/'.format(self.event.pk))
+        self.assertEqual(response.data['claimed_seats'], 1)
+        self.assertEqual(response.data['free_seats'], 99)
+
+    def test_reconcile_corrects_drift(self):
+        claim_seats(self.mario, self.event.id, [self.seats[0].id])
+        Event.objects.filter(pk=self.event.pk).update(claimed_seats=7, paid_reserves=2)
+
+        self.assertEqual(reconcile(), [self.event.pk])
+        self.assertEqual(reconcile(), [])
+        self.assertCounters(1, 0, 0)
+
+
+class BulkReserveActionsTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 5)]
+        self.reserves = [claim_seats(alumn, self.event.id, [seat.id])[0] for alumn, seat in zip(create_alumns(4), self.seats)]
+        self.pks = [reserve.pk for reserve in self.reserves]
+
+    def test_pay(self):
+        bulk.pay('id', self.pks[:1])
+
+        with self.assertNumQueries(8):  # begin, lock, update, seats, then counters and seat delta once committed
+            results = bulk.pay('id', self.pks[:3] + [0])
+
+        self.assertEqual([result['status'] for result in results], [bulk.ALREADY_PAID, bulk.PAID, bulk.PAID, bulk.NOT_FOUND])
+        self.assertEqual(Event.objects.get(pk=self.event.pk).paid_reserves, 3)
+
+    def test_finish(self):
+        Reserve.objects.filter(pk=self.pks[3]).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        results = bulk.finish('id', self.pks)
+
+        self.assertEqual([result['status'] for result in results], [bulk.FINISHED] * 3 + [bulk.EXPIRED])
+        codes = list(Reserve.objects.filter(pk__in=self.pks[:3]).values_list('code', flat=True))
+        self.assertEqual(len(set(codes)), 3)
+        self.assertNotIn(None, codes)
+        self.assertEqual(Event.objects.get(pk=self.event.pk).finished_reserves, 3)
+
+        results = bulk.finish('code', codes[:1])
+        self.assertEqual(results, [{'code': codes[0], 'status': bulk.ALREADY_FINISHED}])
+
+    def test_cancel(self):
+        results = bulk.cancel('id', self.pks[:2] + [0])
+
+        self.assertEqual([result['status'] for result in results], [bulk.CANCELLED, bulk.CANCELLED, bulk.NOT_FOUND])
+        self.assertEqual(ReserveSeat.objects.filter(event=self.event).count(), 2)
+        self.assertEqual(Event.objects.get(pk=self.event.pk).claimed_seats, 2)
+
+
+class AdmissionTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.now = 1000.0
+        patcher = mock.patch('core.admission.time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.clear)
+        self.event = create_event()
+
+    def test_closed(self):
+        ticket = admission.join(self.event.id, 2)
+
+        self.assertEqual((ticket.position, ticket.admitted), (0, True))
+        self.assertTrue(admission.check(ticket.token, self.event.id, 2).admitted)
+
+    def test_rate(self):
+        admission.set_rate(self.event.id, 2)
+        tickets = [admission.join(self.event.id, user_id) for user_id in range(10)]
+
+        self.assertEqual([ticket.position for ticket in tickets], list(range(1, 11)))
+        self.assertEqual([ticket.admitted for ticket in tickets], [True] + [False] * 9)
+        self.assertEqual(tickets[-1].wait, 4.5)
+
+        self.now += 2
+        self.assertEqual([admission.check(ticket.token, self.event.id).admitted for ticket in tickets], [True] * 5 + [False] * 5)
+        self.assertEqual(admission.get_status(self.event.id), {'event': self.event.id, 'rate': 2, 'issued': 10, 'admitted': 5})
+
+        # the admitted users stay admitted at a new rate
+        admission.set_rate(self.event.id, 1)
+        self.now += 1
+        self.assertEqual(admission.get_status(self.event.id)['admitted'], 6)
+
+    def test_idle_queue(self):
+        admission.set_rate(self.event.id, 1)
+        admission.join(self.event.id, 1)
+
+        # the idle time is not banked, a crowd after it still waits its turn
+        self.now += 3600
+        tickets = [admission.join(self.event.id, user_id) for user_id in range(2, 6)]
+
+        self.assertEqual([ticket.ahead for ticket in tickets], [0, 1, 2, 3])
+
+    def test_invalid_token(self):
+        admission.set_rate(self.event.id, 1)
+        token = admission.join(self.event.id, 2).token
+
+        for args in ((token + 'x', self.event.id, 2), (token, self.event.id + 1, 2), (token, self.event.id, 3)):
+            with self.assertRaises(admission.InvalidTicket):
+                admission.check(*args)
+
+        self.now += 10  # time.time is patched for the signatures too
+        with override_settings(ADMISSION_TOKEN_MAX_AGE=5), self.assertRaises(admission.InvalidTicket):
+            admission.check(token, self.event.id, 2)
+
+    def test_cache_lost(self):
+        admission.set_rate(self.event.id, 1)
+        tickets = [admission.join(self.event.id, user_id) for user_id in range(3)]
+
+        # the rate is kept on the event, losing the cache does not open the room
+        cache.clear()
+        self.assertEqual([admission.check(ticket.token, self.event.id).admitted for ticket in tickets], [True, False, False])
+        self.assertEqual(admission.join(self.event.id, 3).ahead, 0)
+        self.assertEqual(admission.join(self.event.id, 4).ahead, 1)
+
+    def test_idle_queue_joined_together(self):
+        admission.set_rate(self.event.id, 1)
+        admission.join(self.event.id, 1)
+        self.now += 3600
+
+        # the late user read the idle queue before another one restarted it
+        read, joined = admission._read, []
+
+        def racing_read(event_id):
+            room = read(event_id)
+            if not joined:
+                joined.append(event_id)
+                admission.join(event_id, 2)
+            return room
+
+        with mock.patch('core.admission._read', side_effect=racing_read):
+            late = admission.join(self.event.id, 3)
+        first = admission.check(admission.join(self.event.id, 4).token, self.event.id)
+
+        self.assertEqual((late.position, late.ahead), (3, 1))
+        self.assertEqual((first.position, first.ahead), (4, 2))
+
+
+class ReserveCodeTestCase(TestCase):
+
+    def test_code_drawn_twice_is_drawn_again(self):
+        event = create_event()
+        mario, luigi = [Reserve.objects.create(alumn=alumn, event=event) for alumn in create_alumns(2)]
+
+        with mock.patch('core.codes.generate_code', side_effect=['AAAAAAAAAA', 'AAAAAAAAAA', 'BBBBBBBBBB']):
+            save_with_code(mario)
+            save_with_code(luigi)
+
+        self.assertEqual(Reserve.objects.get(pk=mario.pk).code, 'AAAAAAAAAA')
+        self.assertEqual(Reserve.objects.get(pk=luigi.pk).code, 'BBBBBBBBBB')
+
+
+class SeatMapTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 4)]
+        self.reserve = Reserve.objects.create(event=self.event)
+
+    def claim(self, seat):
+        ReserveSeat.objects.create(reserve=self.reserve, seat=seat, event=self.event)
+
+    def test_update(self):
+        seatmap.get_seat_map(self.event.id)
+        self.claim(self.seats[0])
+        seatmap.update(self.event.id, [self.seats[0].id], True)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(seatmap.get_seat_map(self.event.id)), [self.seats[0].id])
+
+    def test_concurrent_update(self):
+        seatmap.get_seat_map(self.event.id)
+        self.claim(self.seats[0])
+        self.claim(self.seats[1])
+
+        # another process is flipping its seat, this change drops the map instead of racing it
+        cache.add(seatmap.LOCK_KEY.format(self.event.id), True)
+        seatmap.update(self.event.id, [self.seats[0].id], True)
+        cache.delete(seatmap.LOCK_KEY.format(self.event.id))
+        seatmap.update(self.event.id, [self.seats[1].id], True)
+
+        self.assertEqual(list(seatmap.get_seat_map(self.event.id)), [self.seats[0].id, self.seats[1].id])
+
+    def test_change_while_building(self):
+        build = seatmap.SeatMap.build
+
+        def racing_build(event_id):
+            seat_map = build(event_id)
+            self.claim(self.seats[2])
+            seatmap.update(event_id, [self.seats[2].id], True)
+            return seat_map
+
+        with mock.patch.object(seatmap.SeatMap, 'build', side_effect=racing_build):
+            self.assertEqual(list(seatmap.get_seat_map(self.event.id)), [])
+
+        self.assertEqual(list(seatmap.get_seat_map(self.event.id)), [self.seats[2].id])
+
+
+class ConfirmationContextTestCase(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.event = create_event()
+        self.alumn = create_alumns(1)[0]
+        self.reserve = Reserve.objects.create(alumn=self.alumn, event=self.event)
+
+    def test_warm(self):
+        with self.assertNumQueries(1):
+            get_confirmation_context(self.reserve.pk)
+        with self.assertNumQueries(0):
+            get_confirmation_context(self.reserve.pk)
+
+    def test_timeout(self):
+        with override_settings(CONFIRMATION_CACHE_TIMEOUT=60), mock.patch('core.controllers.cache.set') as cache_set:
+            get_confirmation_context(self.reserve.pk)
+
+        self.assertEqual(cache_set.call_args[0][2], 60)
+
+    def test_event_changed(self):
+        get_confirmation_context(self.reserve.pk)
+
+        self.event.title = 'Yoshi no castelo do Bowser'
+        self.event.save()
+
+        self.assertEqual(get_confirmation_context(self.reserve.pk)['event_title'], 'Yoshi no castelo do Bowser')
+
+    def test_user_changed(self):
+        get_confirmation_context(self.reserve.pk)
+
+        self.alumn.first_name, self.alumn.last_name, self.alumn.email = 'Luigi', 'Mario', 'luigi@tap.com'
+        self.alumn.save()
+        context = get_confirmation_context(self.reserve.pk)
+
+        self.assertEqual((context['alumn_name'], context['alumn_email']), ('Luigi Mario', 'luigi@tap.com'))
+
+        # a login keeps the context cached
+        self.alumn.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            get_confirmation_context(self.reserve.pk)
+
+    def test_deleted_reserve_is_skipped(self):
+        other = Reserve.objects.create(alumn=User.objects.create_user(email='luigi@tap.com', username='luigi'), event=self.event)
+        deleted = Reserve.objects.create(alumn=self.alumn, event=create_event())
+        deleted.delete()
+
+        with mock.patch('core.controllers.get_mail_queue') as get_mail_queue:
+            send_bulk_mail('emails/booking-confirmation.html', confirmation_contexts([self.reserve.pk, deleted.pk, other.pk]))
+        with self.assertLogs('core.controllers', 'WARNING'):
+            messages = list(get_mail_queue.return_value.send_bulk.call_args[0][0])
+
+        self.assertEqual([message['To'] for message in messages], [self.alumn.email, other.alumn.email])
+
+
+class DoorSnapshotTestCase(TestCase):
+
+    def setUp(self):
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=0, row='A', column=column) for column in range(1, 4)]
+        self.reserves = []
+        for alumn, seat, code in zip(create_alumns(3), self.seats, ('CODE1', 'CODE2', 'CODE3')):
+            reserve = Reserve.objects.create(alumn=alumn, event=self.event, finished=True, is_paid=code != 'CODE3', code=code)
+            ReserveSeat.objects.create(reserve=reserve, seat=seat, event=self.event)
+            self.reserves.append(reserve)
+
+    @override_settings(DOOR_SNAPSHOT_KEY='door')
+    def test_snapshot_and_delta(self):
+        door = DoorList('door')
+        snapshot = build_snapshot(self.event.id)
+        door.load(snapshot.content, snapshot.signature)
+
+        self.assertEqual(door.check('code1'), ['Balcão A1'])
+        self.assertIsNone(door.check('CODE3'))
+        self.assertTrue(door.complete)
+
+        # paying the third reserve only sends its code
+        self.reserves[2].is_paid = True
+        self.reserves[2].save()
+        delta = build_snapshot(self.event.id, since=door.version)
+        door.load(delta.content, delta.signature)
+
+        self.assertEqual(door.check('CODE3'), ['Balcão A3'])
+        self.assertEqual((door.version, door.total), (delta.version, 3))
+        self.assertGreater(delta.version, snapshot.version)
+
+        # a cancelled reserve is sent as a tombstone
+        Reserve.objects.filter(pk=self.reserves[0].pk).release()
+        delta = build_snapshot(self.event.id, since=door.version)
+        door.load(delta.content, delta.signature)
+
+        self.assertIsNone(door.check('CODE1'))
+        self.assertEqual(door.total, 2)
+        self.assertTrue(door.complete)
+
+    @override_settings(DOOR_SNAPSHOT_KEY='door', DOOR_SNAPSHOT_MARGIN=60)
+    def test_delta_goes_back_for_late_commits(self):
+        door = DoorList('door')
+        snapshot = build_snapshot(self.event.id)
+        door.load(snapshot.content, snapshot.signature)
+
+        # paid in a transaction stamped before the snapshot and committed after it
+        Reserve.objects.filter(pk=self.reserves[2].pk).update(is_paid=True, updated_at=timezone.now() - timedelta(seconds=30))
+        delta = build_snapshot(self.event.id, since=door.version)
+        door.load(delta.content, delta.signature)
+
+        self.assertEqual(door.check('CODE3'), ['Balcão A3'])
+
+    @override_settings(DOOR_SNAPSHOT_KEY='door', DOOR_SNAPSHOT_HISTORY=60)
+    def test_old_version_gets_the_whole_snapshot(self):
+        since = int((timezone.now() - timedelta(seconds=120)).timestamp() * 1000000)
+        door = DoorList('door')
+        door.version = since
+
+        snapshot = build_snapshot(self.event.id, since=since)
+        door.load(snapshot.content, snapshot.signature)
+
+        self.assertEqual((sorted(door.codes), door.total), (['CODE1', 'CODE2'], 2))
+
+    @override_settings(DOOR_SNAPSHOT_KEY='door')
+    def test_snapshot_signature_is_checked(self):
+        snapshot = build_snapshot(self.event.id)
+
+        with self.assertRaises(InvalidSnapshot):
+            DoorList('other key').load(snapshot.content, snapshot.signature)
+
+
+class ConnectionHealthTestCase(TestCase):
+
+    def stand_in(self, usable, in_atomic_block=False):
+        return mock.Mock(alias='default', connection=object(), in_atomic_block=in_atomic_block, is_usable=mock.Mock(return_value=usable),
+                         health_checked_at=None)
+
+    def test_close_unusable_connections(self):
+        usable, dropped, in_transaction = self.stand_in(True), self.stand_in(False), self.stand_in(False, in_atomic_block=True)
+
+        with mock.patch('core.health.connections') as connections:
+            connections.all.return_value = [usable, dropped, in_transaction]
+            with self.assertLogs('core.health', 'WARNING'):
+                close_unusable_connections()
+
+            with override_settings(DATABASE_HEALTH_CHECKS=False):
+                close_unusable_connections()
+
+        usable.close.assert_not_called()
+        dropped.close.assert_called_once_with()
+        in_transaction.is_usable.assert_not_called()
+
+    def test_checked_once_per_interval(self):
+        connection = self.stand_in(True)
+
+        with mock.patch('core.health.connections') as connections, mock.patch('core.health.time.monotonic') as monotonic:
+            connections.all.return_value = [connection]
+            for now in (100, 101, 109, 110):
+                monotonic.return_value = now
+                close_unusable_connections()
+
+        self.assertEqual(connection.is_usable.call_count, 2)
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    local SMTP server keeping the messages it receives, drops the first ``drop`` connections and defers the first ``defer`` messages
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, drop=0, defer=0):
+        self.messages = []
+        self.connections = 0
+        self.drop = drop
+        self.defer = defer
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPStandInHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.server.connections += 1
+        if self.server.connections <= self.server.drop:
+            return
+
+        self.reply('220 localhost stand-in')
+        for line in self.rfile:
+            command = line.decode('ascii').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 end with .')
+                data = []
+                for data_line in self.rfile:
+                    if data_line.rstrip(b'\r\n') == b'.':
+                        break
+                    data.append(data_line)
+                if self.server.defer:
+                    self.server.defer -= 1
+                    self.reply('451 try again later')
+                    continue
+                self.server.messages.append(b''.join(data))
+                self.reply('250 queued')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:  # MAIL, RCPT, NOOP and RSET
+                self.reply('250 ok')
+
+
+class MailQueueTestCase(TestCase):
+
+    def create_queue(self, server, workers=1):
+        pool = SMTPConnectionPool('127.0.0.1', server.port, use_tls=False, size=workers, timeout=5)
+        self.addCleanup(pool.close)
+        return MailQueue(pool, batch_size=10, max_retries=3, backoff=0.01, workers=workers)
+
+    def create_messages(self, quantity):
+        return [build_message('<p>{0}</p>'.format(i), 'no-reply@tap.com', 'alumn{0}@tap.com'.format(i))
+                for i in range(quantity)]
+
+    def test_bulk_job_reuses_connection(self):
+        server = SMTPStandIn()
+        self.addCleanup(server.shutdown)
+        mail_queue = self.create_queue(server)
+
+        mail_queue.send_bulk(iter(self.create_messages(25)))
+        mail_queue.send(self.create_messages(1)[0])
+        mail_queue.join()
+
+        self.assertEqual(len(server.messages), 26)
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(mail_queue.sent, 26)
+
+    def test_batches_sent_in_parallel(self):
+        server = SMTPStandIn()
+        self.addCleanup(server.shutdown)
+        mail_queue = self.create_queue(server, workers=2)
+        release = threading.Event()
+
+        def first_batch_held():
+            messages = self.create_messages(20)
+            yield from messages[:10]
+            release.wait(timeout=5)
+            yield from messages[10:]
+
+        mail_queue.send_bulk(first_batch_held())
+        mail_queue.send_bulk(self.create_messages(5))
+        # the second job is sent while the first one waits
+        deadline = time.time() + 5
+        while mail_queue.sent < 15 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(mail_queue.sent, 15)
+
+        release.set()
+        mail_queue.join()
+
+        self.assertEqual(len(server.messages), 25)
+        self.assertLessEqual(server.connections, 2)
+
+    def test_failed_job(self):
+        server = SMTPStandIn()
+        self.addCleanup(server.shutdown)
+        mail_queue = self.create_queue(server)
+
+        def broken_job():
+            yield from self.create_messages(10)
+            raise RuntimeError('broken')
+
+        with self.assertLogs('core.mail', 'ERROR'):
+            mail_queue.send_bulk(broken_job())
+            mail_queue.send_bulk(self.create_messages(1))
+            mail_queue.join()
+
+        self.assertEqual(len(server.messages), 11)
+
+    def test_delivery_is_retried(self):
+        server = SMTPStandIn(drop=2)
+        self.addCleanup(server.shutdown)
+        mail_queue = self.create_queue(server)
+
+        with self.assertLogs('core.mail', 'WARNING'):
+            mail_queue.send_bulk(self.create_messages(3))
+            mail_queue.join()
+
+        self.assertEqual(len(server.messages), 3)
+        self.assertEqual(mail_queue.failed, 0)
+
+    def test_deferred_message_is_retried(self):
+        server = SMTPStandIn(defer=2)
+        self.addCleanup(server.shutdown)
+        mail_queue = self.create_queue(server)
+
+        with self.assertLogs('core.mail', 'WARNING'):
+            mail_queue.send_bulk(self.create_messages(3))
+            mail_queue.join()
+
+        self.assertEqual(len(server.messages), 3)
+        self.assertEqual((mail_queue.sent, mail_queue.failed), (3, 0))
+
+    def test_flush(self):
+        server = SMTPStandIn()
+        self.addCleanup(server.shutdown)
+        mail_queue = self.create_queue(server)
+        release = threading.Event()
+
+        def slow_job():
+            release.wait()
+            yield from self.create_messages(2)
+
+        mail_queue.send_bulk(slow_job())
+        with self.assertLogs('core.mail', 'ERROR'):
+            self.assertEqual(mail_queue.flush(0.1), 1)
+
+        release.set()
+        self.assertEqual(mail_queue.flush(5), 0)
+        self.assertEqual(len(server.messages), 2)
+
+
+class PdfStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_least_recently_used_are_evicted(self):
+        store = PdfStore(self.root, max_bytes=35)
+        for index, digest in enumerate(('a', 'b', 'c')):
+            store.put(digest, b'x' * 10)
+            os.utime(store.path(digest), (index, index))
+
+        store.get('a')  # used again, b is now the oldest
+        store.put('d', b'x' * 10)
+
+        self.assertEqual(sorted(os.listdir(self.root)), ['a.pdf', 'c.pdf', 'd.pdf'])
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a'), b'x' * 10)
+
+    def test_directory_is_not_scanned_on_every_put(self):
+        store = PdfStore(self.root, max_bytes=1000)
+
+        with mock.patch('core.documents.os.scandir', wraps=os.scandir) as scandir:
+            for digest in 'abcde':
+                store.put(digest, b'x' * 10)
+
+        self.assertEqual(scandir.call_count, 1)
+
+
+class PdfRendererTestCase(TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.renderer = PdfRenderer(PdfStore(root, max_bytes=1024 * 1024), workers=1)
+        self.addCleanup(self.renderer.executor.shutdown)
+
+    def wait(self):
+        # the done callbacks run before shutdown returns
+        self.renderer.executor.shutdown(wait=True)
+
+    def test_render_once(self):
+        submitted = threading.Event()
+
+        def render(*args, **kwargs):
+            # still rendering while the second call comes in
+            submitted.wait(timeout=5)
+            return b'%PDF'
+
+        with mock.patch('core.documents.pdfkit.from_string', side_effect=render) as from_string:
+            self.assertIsNone(self.renderer.get_or_submit('<p>Peach</p>'))
+            self.assertIsNone(self.renderer.get_or_submit('<p>Peach</p>'))
+            submitted.set()
+            self.wait()
+
+            self.assertEqual(self.renderer.jobs, {})
+            self.assertEqual(self.renderer.get_or_submit('<p>Peach</p>'), b'%PDF')
+
+        self.assertEqual(from_string.call_count, 1)
+
+    def test_failed_job(self):
+        with mock.patch('core.documents.pdfkit.from_string', side_effect=OSError('wkhtmltopdf')):
+            self.renderer.get_or_submit('<p>Peach</p>')
+            self.wait()
+
+        # the error is raised once, the next call renders again
+        with self.assertRaises(OSError):
+            self.renderer.get_or_submit('<p>Peach</p>')
+        self.assertEqual(self.renderer.jobs, {})
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ClaimSeatsLoadTestCase(TransactionTestCase):
+    """
+    fire concurrent claims at a few hot seats, requires a database with row locks (PostgreSQL)
+    """
+
+    CLAIMS = 2000
+    WORKERS = 32
+    HOT_SEATS = 10
+
+    def setUp(self):
+        self.event = create_event(max_tickets=2)
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, self.HOT_SEATS + 1)]
+        self.alumns = create_alumns(200)
+
+    def claim(self, alumn, seat_ids):
+        try:
+            claim_seats(alumn, self.event.id, seat_ids)
+            return True
+        except (SeatTaken, TicketLimitReached):
+            return False
+        finally:
+            connection.close()
+
+    def test_no_double_booking(self):
+        rand = random.Random(42)
+        claims = [(rand.choice(self.alumns), [seat.id for seat in rand.sample(self.seats, rand.randint(1, 2))])
+                  for _ in range(self.CLAIMS)]
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            results = list(executor.map(lambda claim: self.claim(*claim), claims))
+        elapsed = time.time() - started
+
+        booked = ReserveSeat.objects.filter(event=self.event)
+        self.assertFalse(booked.values('seat').annotate(total=Count('id')).filter(total__gt=1).exists())
+        self.assertFalse(booked.values('reserve').annotate(total=Count('id')).filter(total__gt=2).exists())
+        self.assertLessEqual(booked.count(), self.HOT_SEATS)
+        self.assertGreater(sum(results), 0)
+
+        print('\n{0} claims ({1} won) in {2:.2f}s: {3:.0f} claims/s'.format(
+            self.CLAIMS, sum(results), elapsed, self.CLAIMS / elapsed))
+
+    def test_parallel_clicks_of_one_alumn(self):
+        alumn = self.alumns[0]
+        claim_seats(alumn, self.event.id, [self.seats[0].id])
+
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            results = list(executor.map(lambda seat: self.claim(alumn, [seat.id]), self.seats[1:]))
+
+        # the tickets are counted after the lock, the seat of each winner is seen by the next claim
+        self.assertEqual(sum(results), 1)
+        self.assertEqual(ReserveSeat.objects.filter(reserve__alumn=alumn).count(), 2)
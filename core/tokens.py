@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from core.models import Token
+
+VALID = 'valid'
+EXPIRED = 'expired'
+USED = 'used'
+NOT_FOUND = 'not_found'
+
+
+def _today(today):
+    return today or timezone.localdate()
+
+
+def _status(token, today):
+    if token is None:
+        return NOT_FOUND
+    if token.validate_in is not None:
+        return USED
+    if token.validity is not None and token.validity < today:
+        return EXPIRED
+    return VALID
+
+
+def _result(hashcode, token, status):
+    result = {'hashcode': hashcode, 'status': status}
+    if status == USED:
+        result['validate_in'] = token.validate_in
+    return result
+
+
+def redeem(hashcode, user, today=None):
+    """Validate a token and mark it as used by ``user``
+
+    Validating and marking are a single UPDATE on the unique ``hashcode``, a token scanned
+    twice at the same time is accepted only once.
+
+    Arguments:
+        hashcode {string} -- code printed on the token
+        user {User} -- user validating the token
+
+    Returns:
+        dict -- hashcode and status of the token (valid, expired, used or not_found)
+    """
+
+    today = _today(today)
+
+    redeemed = Token.objects.filter(Q(validity__isnull=True) | Q(validity__gte=today),
+                                    hashcode=hashcode, validate_in__isnull=True).update(validate_in=today, validate_by=user)
+    if redeemed:
+        return _result(hashcode, None, VALID)
+
+    # not redeemed, read the token only to tell why
+    token = Token.objects.filter(hashcode=hashcode).only('validity', 'validate_in').first()
+    return _result(hashcode, token, _status(token, today))
+
+
+def redeem_many(hashcodes, user, today=None):
+    """Validate a batch of tokens and mark the valid ones as used by ``user``
+
+    The whole batch costs two queries: the tokens are read and locked by their unique
+    ``hashcode`` and the valid ones are marked together. A code repeated in the batch is
+    valid only the first time.
+
+    Arguments:
+        hashcodes {list} -- codes printed on the tokens, in scanning order
+        user {User} -- user validating the tokens
+
+    Returns:
+        list -- hashcode and status of each code, in the order of ``hashcodes``
+    """
+
+    today = _today(today)
+    results = []
+
+    with transaction.atomic():
+        tokens = {token.hashcode: token for token in Token.objects.select_for_update()
+                  .filter(hashcode__in=set(hashcodes)).only('hashcode', 'validity', 'validate_in')}
+
+        redeemed = []
+        for hashcode in hashcodes:
+            token = tokens.get(hashcode)
+            status = _status(token, today)
+            results.append(_result(hashcode, token, status))
+
+            if status == VALID:
+                token.validate_in = today
+                redeemed.append(token.pk)
+
+        if redeemed:
+            Token.objects.filter(pk__in=redeemed).update(validate_in=today, validate_by=user)
+
+    return results
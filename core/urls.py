@@ -3,6 +3,9 @@
 
 from django.conf.urls import include, url
 
+from core import views
+
 urlpatterns = [
     url(r'^api/', include('rest.urls')),
+    url(r'^metrics$', views.metrics, name='metrics'),
 ]
@@ -1,3 +1,23 @@
-from django.shortcuts import render
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
 
-# Create your views here.
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+
+from core.metrics import collect, exposition
+
+
+@require_GET
+def metrics(request):
+    """
+    metrics of every worker in the Prometheus text format, behind METRICS_TOKEN as a bearer token, closed while it is not set
+    """
+
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if not token or not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer {0}'.format(token)):
+        return HttpResponseForbidden()
+
+    return HttpResponse(exposition(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Gunicorn settings of the web process, every value can be changed from the environment.
+
+    gunicorn api.wsgi --config gunicorn.conf.py
+
+Worker classes:
+
+    gthread (default) - WEB_CONCURRENCY processes of GUNICORN_THREADS threads each. Every thread
+                        keeps its own database connection open for DATABASE_CONN_MAX_AGE seconds,
+                        so PostgreSQL sees up to processes x threads connections per dyno.
+    gevent            - GUNICORN_WORKER_CONNECTIONS greenlets per process, for many slow clients
+                        (seat streams), with gevent and psycogreen from requirements.txt. Greenlets do not
+                        outlive their request, so connections are closed after each request
+                        (DATABASE_CONN_MAX_AGE=0): put pgbouncer in transaction mode in front of
+                        PostgreSQL (DATABASE_POOLER=pgbouncer) to keep the server connections pooled.
+    sync              - one request at a time per process, the gunicorn default.
+
+Compare the profiles with loadtest.py against a database filled by populate.py.
+"""
+
+import multiprocessing
+import os
+
+bind = '0.0.0.0:{0}'.format(os.environ.get('PORT', '8000'))
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+# restart workers now and then, the caches kept in process memory stay bounded
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+
+# the app is loaded by each worker, no database connection is shared between forks
+preload_app = False
+
+if worker_class == 'gevent':
+    os.environ.setdefault('DATABASE_CONN_MAX_AGE', '0')
+
+
+def on_starting(server):
+    # the throttles count the calls of every worker in the cache, a cache per worker multiplies the limits
+    backend = os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+    if workers > 1 and backend.endswith(('LocMemCache', 'DummyCache')):
+        raise RuntimeError('CACHE_BACKEND must point to a cache shared by the {0} workers, see api/settings.py'.format(workers))
+
+
+def worker_exit(server, worker):
+    # the mail queue sends from a daemon thread of the worker, dying with it
+    from django.conf import settings
+    from core.mail import flush_mail_queue
+    flush_mail_queue(settings.MAIL_FLUSH_TIMEOUT)
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 waits on the hub instead of blocking the whole worker
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Measure the requests per second and the latency of the web process under concurrent clients.
+
+Fill the database first, then compare the serving profiles one after the other:
+
+    python populate.py --alumns 5000 --events 10 --reserves 2000
+
+    # before: sync workers, a new database connection per request
+    DATABASE_CONN_MAX_AGE=0 gunicorn api.wsgi --workers 4
+    python loadtest.py --scenario events --label before
+    python loadtest.py --scenario add-seat --alumns 5000 --label before
+
+    # after: gthread workers, persistent connections (see gunicorn.conf.py)
+    WEB_CONCURRENCY=4 gunicorn api.wsgi --config gunicorn.conf.py
+    python loadtest.py --scenario events --label after
+    python loadtest.py --scenario add-seat --alumns 5000 --label after
+
+Run populate.py again between add-seat runs, the claimed seats stay claimed.
+
+Large list pages, rendered from model instances and from .values() rows:
+
+    python populate.py --alumns 10000 --events 10000 --reserves 10000
+
+    SERIALIZE_FROM_VALUES=0 WEB_CONCURRENCY=4 gunicorn api.wsgi --config gunicorn.conf.py
+    python loadtest.py --scenario reservations --limit 10000 --concurrency 4 --label instances
+
+    WEB_CONCURRENCY=4 gunicorn api.wsgi --config gunicorn.conf.py
+    python loadtest.py --scenario reservations --limit 10000 --concurrency 4 --label values
+
+The rows per second of the list scenarios are the requests per second times --limit.
+"""
+
+import argparse
+import collections
+import http.client
+import itertools
+import json
+import random
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+FIRST_ALUMN = 6  # id of the first alumn generated by populate.py
+HALL_SEATS = 896  # seats created by populate.py, ids 1 to 896
+
+
+class Client(object):
+    """
+    keep-alive connection to the server with the cookies of one user
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.connection = None
+        self.cookies = {}
+
+    def request(self, method, path, data=None):
+        headers = {'Accept': 'application/json'}
+        body = None
+        if data is not None:
+            body = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        if self.cookies:
+            headers['Cookie'] = '; '.join('{0}={1}'.format(name, value) for name, value in self.cookies.items())
+        if 'csrftoken' in self.cookies:
+            headers['X-CSRFToken'] = self.cookies['csrftoken']
+
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # the server closed the idle connection, retry once on a new one
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+        for header in response.msg.get_all('Set-Cookie') or ():
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+
+        return response.status
+
+
+def timed(client, method, path, data=None):
+    started = time.perf_counter()
+    status = client.request(method, path, data)
+    return status, time.perf_counter() - started
+
+
+def list_events(client, args, rng, index):
+    while True:
+        yield timed(client, 'GET', '/api/events/?limit={0}'.format(args.limit))
+
+
+def list_reservations(client, args, rng, index):
+    while True:
+        yield timed(client, 'GET', '/api/reservations/?limit={0}'.format(args.limit))
+
+
+def add_seat(client, args, rng, index):
+    """
+    claim random seats of the event as the generated alumns, each worker logs in the next alumn of its own once one holds the max tickets
+    """
+
+    alumns = itertools.cycle(range(FIRST_ALUMN + index, FIRST_ALUMN + max(args.alumns, index + 1), args.concurrency))
+
+    while True:
+        # logging in hashes the password, it is left out of the measures
+        client.cookies.clear()
+        client.request('POST', '/api/rest-auth/login/', {'email': 'alumn{0}@tap.com'.format(next(alumns)), 'password': 'alumn123'})
+
+        while True:
+            status, elapsed = timed(client, 'POST', '/api/reservations/add-seat/', {'event': args.event, 'seat': rng.randint(1, HALL_SEATS)})
+            yield status, elapsed
+            if status == 300:  # the alumn reached the max tickets of the event
+                break
+
+
+SCENARIOS = {
+    'events': list_events,
+    'reservations': list_reservations,
+    'add-seat': add_seat,
+}
+
+
+def worker(args, index, deadline, latencies, statuses, lock):
+    rng = random.Random(args.seed + index)
+    client = Client(args.url)
+    measures = []
+    counts = collections.Counter()
+
+    for status, elapsed in SCENARIOS[args.scenario](client, args, rng, index):
+        measures.append(elapsed)
+        counts[status] += 1
+        if time.time() >= deadline:
+            break
+
+    with lock:
+        latencies.extend(measures)
+        statuses.update(counts)
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+def run(args):
+    latencies = []
+    statuses = collections.Counter()
+    lock = threading.Lock()
+
+    started = time.time()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=worker, args=(args, index, deadline, latencies, statuses, lock)) for index in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    print('{0} {1}: {2} requests in {3:.1f}s, {4:.1f} req/s, p50 {5:.1f}ms, p95 {6:.1f}ms, p99 {7:.1f}ms, status {8}'.format(
+        args.label, args.scenario, len(latencies), elapsed, len(latencies) / elapsed, percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.95) * 1000, percentile(latencies, 0.99) * 1000, dict(sorted(statuses.items()))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the requests per second of the web process.')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='Address of the server.')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='events', help='Requests to send.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Clients sending requests at the same time.')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to send requests for.')
+    parser.add_argument('--limit', type=int, default=20, help='Rows per page of the list scenarios.')
+    parser.add_argument('--event', type=int, default=1, help='Event of the add-seat requests.')
+    parser.add_argument('--alumns', type=int, default=1000, help='Alumns generated by populate.py, logged in by add-seat.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the seats chosen by add-seat.')
+    parser.add_argument('--label', default='', help='Name of the profile under test, printed with the results.')
+
+    run(parser.parse_args())
@@ -7,29 +7,41 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+import argparse
+import csv
+import io
+import itertools
 import random
 import string
-from datetime import datetime
+import time
+from datetime import date, datetime, timedelta
 
 import pytz
-from dateutil.relativedelta import relativedelta
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.management.color import no_style
+from django.db import connection, transaction
 
-from core.models import Event, Reserve, Seat, Token, User
+from core import layout
+from core.counters import reconcile
+from core.models import Event, Reserve, ReserveSeat, Seat, Token, User
 
 TZ = pytz.timezone('America/Sao_Paulo')
 
+ALUMNS = (('Luigi', 'luigi123'), ('Mario', 'mario123'), ('Peach', 'peach123'), ('Yoshi', 'yoshi123'))
 
-def create_tokens(quantity=100):
-    for token in range(0, quantity):
-        hashcode = random.getrandbits(32)
-        validity = (datetime.now() + relativedelta(days=15)).date()
-        Token.objects.create(hashcode=hashcode, validity=validity)
-        print('{0} token created: {1} validity until {2}'.format(token, hashcode, validity))
+EVENTS = ('A princesa Peach no reino encantado do sapateado.', 'Mario e Luigi salvam a princesa Peach sapateando.')
 
+COPY_NULL = '\\N'
 
-def create_seats():
-    # create seats for stage
-    print('seats for stage')
+
+def hall_seats():
+    """
+    yield (type, row, column) for every seat of the hall
+    """
+
+    # seats for stage
     for row in string.ascii_letters.upper()[0:20]:
         if row == 'A':
             columns = list(range(1, 27))
@@ -38,11 +50,9 @@ def create_seats():
         else:
             columns = list(range(1, 29))
         for column in columns:
-            print('seat {0}{1}'.format(row, column))
-            Seat.objects.create(type=1, row=row, column=column)
+            yield 1, row, column
 
-    # create seats for balcon
-    print('seats for balcon')
+    # seats for balcon
     for row in string.ascii_letters.upper()[0:14]:
         columns = list(range(1, 30))
         if row in ('A', 'B', 'C', 'D', 'E', 'F'):
@@ -61,62 +71,219 @@ def create_seats():
             columns.remove(24)
             columns.remove(22)
         for column in columns:
-            print('seat {0}{1}'.format(row, column))
-            Seat.objects.create(type=0, row=row, column=column)
-
-def populate():
-    # clearing database
-    User.objects.all().delete()
-    Token.objects.all().delete()
-    Event.objects.all().delete()
-    Seat.objects.all().delete()
-    Reserve.objects.all().delete()
-
-    # create tokens
-    print('creating some tokens')
-    create_tokens()
-
-    # create seats
-    print('creating some seats')
-    create_seats()
-
-    # create a superuser
-    print('creating a superuser admin@tap.com / tapacademy')
-    admin = User.objects.create_superuser(email='admin@tap.com', password='tapacademy', first_name='Admin', username='admin')
-
-    # create alumns
-    print('creating some alumns with passwords <name>123')
-    luigi = User.objects.create_user(first_name='Luigi', password='luigi123', email='luigi@tap.com', username='luigi')
-    mario = User.objects.create_user(first_name='Mario', password='mario123', email='mario@tap.com', username='mario')
-    User.objects.create_user(first_name='Peach', password='peach123', email='peach@tap.com', username='peach')
-    User.objects.create_user(first_name='Yoshi', password='yoshi123', email='yoshi@tap.com', username='yoshi')
-
-    # create events
-    print('creating some events')
-    event_1 = Event.objects.create(title='A princesa Peach no reino encantado do sapateado.',
-        date=datetime(2018, 12, 10, 20, tzinfo=TZ), max_seatings=100, max_tickets=3)
-
-    print('%s created' % event_1.title)
-
-    event_2 = Event.objects.create(title='Mario e Luigi salvam a princesa Peach sapateando.',
-        date=datetime(2018, 12, 10, 20, tzinfo=TZ), max_seatings=100, max_tickets=3)
-
-    print('%s created' % event_2.title)
-
-    # create reservations
-    print('creating some reservations')
-
-    reserve = Reserve.objects.create(alumn=mario, event=event_1)
-    reserve.seats.add(Seat.objects.filter(row='A', column='9', type='0').get())
-    reserve.seats.add(Seat.objects.filter(row='A', column='11', type='0').get())
-    reserve.seats.add(Seat.objects.filter(row='A', column='13', type='0').get())
-    reserve.save()
-
-    reserve = Reserve.objects.create(alumn=luigi, event=event_2)
-    reserve.seats.add(Seat.objects.filter(row='F', column='18', type='1').get())
-    reserve.seats.add(Seat.objects.filter(row='F', column='16', type='1').get())
-    reserve.seats.add(Seat.objects.filter(row='F', column='14', type='1').get())
-    reserve.save()
+            yield 0, row, column
+
+
+def reset():
+    """
+    empty the tables of the core models and restart their ids, with TRUNCATE on PostgreSQL
+    """
+
+    tables = [model._meta.db_table for model in apps.get_app_config('core').get_models(include_auto_created=True)]
+    sequences = [sequence for sequence in connection.introspection.sequence_list() if sequence['table'] in tables]
+
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sql_flush(no_style(), tables, sequences, allow_cascade=True):
+            cursor.execute(sql)
+
+
+def copy(model, objects):
+    """
+    insert the objects with a single COPY statement, PostgreSQL only
+    """
+
+    fields = model._meta.concrete_fields
+    quote = connection.ops.quote_name
+
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for obj in objects:
+        values = (field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields)
+        writer.writerow([COPY_NULL if value is None else value for value in values])
+    data.seek(0)
+
+    sql = 'COPY {0} ({1}) FROM STDIN WITH (FORMAT csv, NULL \'{2}\')'.format(
+        quote(model._meta.db_table), ', '.join(quote(field.column) for field in fields), COPY_NULL)
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert(sql, data)
+
+
+def load(model, objects, batch_size):
+    """Insert objects built with their ids, in batches
+
+    Arguments:
+        model {Model} -- model of the objects
+        objects {iterable} -- objects to insert, consumed one batch at a time
+        batch_size {int} -- objects per COPY or bulk_create
+
+    Returns:
+        int -- rows inserted
+    """
+
+    started = time.time()
+    objects = iter(objects)
+    rows = 0
+
+    while True:
+        batch = list(itertools.islice(objects, batch_size))
+        if not batch:
+            break
+
+        if connection.vendor == 'postgresql':
+            copy(model, batch)
+        else:
+            model.objects.bulk_create(batch)
+        rows += len(batch)
+
+    if model is Seat and rows:
+        # the bulk inserts bypass the signals bumping the layout version
+        layout.invalidate()
+
+    elapsed = time.time() - started
+    print('{0}: {1} rows in {2:.2f}s ({3:.0f} rows/s)'.format(model._meta.db_table, rows, elapsed, rows / max(elapsed, 1e-6)))
+
+    return rows
+
+
+def create_users(rng, alumns):
+    # hashing is the slow part of creating users, generated alumns share a single hash
+    yield User(id=1, email='admin@tap.com', username='admin', first_name='Admin', phone='', password=make_password('tapacademy'),
+               is_staff=True, is_superuser=True, is_admin=True)
+
+    for pk, (name, password) in enumerate(ALUMNS, 2):
+        yield User(id=pk, email='{0}@tap.com'.format(name.lower()), username=name.lower(), first_name=name, phone='',
+                   password=make_password(password))
+
+    password = make_password('alumn123')
+    for pk in range(len(ALUMNS) + 2, len(ALUMNS) + 2 + alumns):
+        yield User(id=pk, email='alumn{0}@tap.com'.format(pk), username='alumn{0}'.format(pk), first_name='Alumn',
+                   last_name=str(pk), phone='119{0:08d}'.format(rng.randrange(10 ** 8)), password=password)
+
+
+def create_tokens(rng, quantity):
+    validity = date.today() + timedelta(days=15)
+
+    for pk, hashcode in enumerate(rng.sample(range(2 ** 32), quantity), 1):
+        yield Token(id=pk, hashcode=str(hashcode), validity=validity)
+
+
+def create_events(rng, quantity):
+    for pk, title in enumerate(EVENTS, 1):
+        yield Event(id=pk, title=title, date=datetime(2018, 12, 10, 20, tzinfo=TZ), max_seatings=100, max_tickets=3)
+
+    for pk in range(len(EVENTS) + 1, len(EVENTS) + 1 + quantity):
+        yield Event(id=pk, title='Espetáculo de sapateado {0}'.format(pk),
+                    date=TZ.localize(datetime(2018, 12, 10, 20) + timedelta(days=rng.randrange(365))), max_seatings=100, max_tickets=3)
+
+
+def plan_reserves(rng, events, alumns, quantity, seat_ids):
+    """Choose the alumn and the seats of every reserve
+
+    Besides the reserves of Mario and Luigi, ``quantity`` reserves are spread over the
+    events, each alumn holding one reserve and each seat taken once per event.
+
+    Returns:
+        list -- (reserve id, event id, alumn id, seat ids) tuples
+    """
+
+    samples = [(1, 1, 3, [seat_ids[0, 'A', 9], seat_ids[0, 'A', 11], seat_ids[0, 'A', 13]]),
+            (2, 2, 2, [seat_ids[1, 'F', 18], seat_ids[1, 'F', 16], seat_ids[1, 'F', 14]])]
+    plan = list(samples)
+    alumn_ids = list(range(2, len(ALUMNS) + 2 + alumns))
+    event_ids = list(range(1, len(EVENTS) + 1 + events))
+
+    for index, event_id in enumerate(event_ids):
+        wanted = quantity // len(event_ids) + (1 if index < quantity % len(event_ids) else 0)
+        if not wanted:
+            continue
+
+        taken_alumns = {reserve[2] for reserve in samples if reserve[1] == event_id}
+        taken_seats = {seat for reserve in samples if reserve[1] == event_id for seat in reserve[3]}
+        event_alumns = [pk for pk in rng.sample(alumn_ids, min(wanted + len(taken_alumns), len(alumn_ids)))
+                        if pk not in taken_alumns]
+        event_seats = [pk for pk in seat_ids.values() if pk not in taken_seats]
+        rng.shuffle(event_seats)
+
+        for alumn_id in event_alumns[:wanted]:
+            seats = [event_seats.pop() for _ in range(min(rng.randint(1, 3), len(event_seats)))]
+            if not seats:
+                break
+            plan.append((len(plan) + 1, event_id, alumn_id, seats))
+
+    return plan
+
+
+def create_reserves(rng, plan):
+    codes = set()
+
+    for pk, event_id, alumn_id, _ in plan:
+        finished = rng.random() < 0.6
+        code = None
+        while finished and (code is None or code in codes):
+            code = '{0:010X}'.format(rng.getrandbits(40))  # Reserve.code is unique
+        codes.add(code)
+        yield Reserve(id=pk, event_id=event_id, alumn_id=alumn_id, finished=finished, is_paid=finished and rng.random() < 0.5, code=code)
+
+
+def create_reserve_seats(plan):
+    pk = itertools.count(1)
+    for reserve_id, event_id, _, seats in plan:
+        for seat_id in seats:
+            yield ReserveSeat(id=next(pk), reserve_id=reserve_id, event_id=event_id, seat_id=seat_id)
+
+
+def populate(seed=0, alumns=0, events=0, reserves=0, tokens=100, batch_size=5000):
+    """Replace the data of the database with a generated dataset
+
+    The same arguments always generate the same dataset. Besides the admin, Luigi, Mario,
+    Peach and Yoshi, the two events and their reserves, ``alumns``, ``events`` and
+    ``reserves`` add generated rows for load tests.
+    """
+
+    rng = random.Random(seed)
+    started = time.time()
+
+    seat_ids = {seat: pk for pk, seat in enumerate(hall_seats(), 1)}
+
+    with transaction.atomic():
+        print('clearing database')
+        reset()
+
+        rows = load(Seat, (Seat(id=pk, type=seat_type, row=row, column=column) for (seat_type, row, column), pk in seat_ids.items()),
+                    batch_size)
+        rows += load(Token, create_tokens(rng, tokens), batch_size)
+        rows += load(User, create_users(rng, alumns), batch_size)
+        rows += load(Event, create_events(rng, events), batch_size)
+
+        plan = plan_reserves(rng, events, alumns, reserves, seat_ids)
+        rows += load(Reserve, create_reserves(rng, plan), batch_size)
+        rows += load(ReserveSeat, create_reserve_seats(plan), batch_size)
+
+        # rows were inserted with their ids, move the sequences past them
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Seat, Token, User, Event, Reserve, ReserveSeat]):
+                cursor.execute(sql)
+
+        # the event counters are kept by signals, bypassed by the bulk inserts
+        reconcile()
+
+    # the seat maps, layout and confirmations cached for the old data are stale
+    cache.clear()
+
+    elapsed = time.time() - started
+    print('total: {0} rows in {1:.2f}s ({2:.0f} rows/s)'.format(rows, elapsed, rows / max(elapsed, 1e-6)))
+    print('superuser admin@tap.com / tapacademy, alumns <name>@tap.com / <name>123, generated alumns / alumn123')
+
 
 if __name__ == "__main__":
-    populate()
+    parser = argparse.ArgumentParser(description='Replace the data of the database with a generated dataset.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated data, the same seed gives the same dataset.')
+    parser.add_argument('--alumns', type=int, default=0, help='Generated alumns, besides Luigi, Mario, Peach and Yoshi.')
+    parser.add_argument('--events', type=int, default=0, help='Generated events, besides the two sample events.')
+    parser.add_argument('--reserves', type=int, default=0, help='Generated reserves, spread over the events.')
+    parser.add_argument('--tokens', type=int, default=100, help='Generated tokens.')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Rows per COPY or bulk insert.')
+    args = parser.parse_args()
+
+    populate(seed=args.seed, alumns=args.alumns, events=args.events, reserves=args.reserves, tokens=args.tokens,
+             batch_size=args.batch_size)
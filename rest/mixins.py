@@ -0,0 +1,360 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import math
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+from rest_framework import status
+from rest_framework.exceptions import APIException, PermissionDenied, ValidationError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from core import admission, idempotency, routers
+from core.metrics import timed
+
+
+class SparseFieldsMixin(object):
+    """Read only the columns of the fields asked with ?fields= or left by ?fields!=
+
+    The serializers drop the other fields (drf-queryfields), the view set drops their
+    columns from the query. Fields computed from other columns list them on
+    ``field_columns``; without it the query is left untouched.
+    """
+
+    field_columns = {}
+
+    def get_requested_fields(self):
+        """
+        names of the serializer fields to render, None for all of them
+        """
+
+        request = getattr(self, 'request', None)
+        if request is None or request.method != 'GET':
+            return None
+
+        params = request.query_params
+        includes = {name for names in params.getlist('fields') for name in names.split(',') if name}
+        excludes = {name for names in params.getlist('fields!') for name in names.split(',') if name}
+        if not includes and not excludes:
+            return None
+
+        fields = set(self.get_serializer_class().Meta.fields) - excludes
+        return fields & includes if includes else fields
+
+    def get_queryset(self):
+        queryset = super(SparseFieldsMixin, self).get_queryset()
+
+        fields = self.get_requested_fields()
+        if fields is None or self.action not in ('list', 'retrieve'):
+            return queryset
+
+        meta = queryset.model._meta
+        columns = {meta.pk.name}
+        params = self.request.query_params
+        if params.get('pagination') == 'cursor' or 'cursor' in params:
+            # cursor pages read the position of the last row
+            columns.update(getattr(self, 'cursor_ordering_fields', ()))
+        relations = False
+
+        for name in fields - {'url'}:
+            if name in self.field_columns:
+                columns.update(self.field_columns[name])
+                continue
+
+            try:
+                field = meta.get_field(name)
+            except FieldDoesNotExist:
+                return queryset
+
+            if field.many_to_many:
+                relations = True
+            elif field.concrete:
+                columns.add(name)
+
+        if not relations:
+            queryset = queryset.prefetch_related(None)
+
+        return queryset.only(*columns)
+
+
+class ValuesListMixin(object):
+    """List from ``.values()`` rows when the list serializer renders them, see rest.serializers.ValuesListSerializer
+
+    The page is read as dicts of the columns of the rendered fields, ``field_columns``
+    naming the columns of the computed ones. Serializers that can not render rows list
+    instances as usual, and so does every view set when SERIALIZE_FROM_VALUES is off.
+    """
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer([], many=True)
+        get_row_fields = getattr(serializer, 'get_row_fields', None)
+        if not settings.SERIALIZE_FROM_VALUES or get_row_fields is None:
+            return super(ValuesListMixin, self).list(request, *args, **kwargs)
+
+        plan = get_row_fields(getattr(self, 'field_columns', {}))
+        if plan is None:
+            return super(ValuesListMixin, self).list(request, *args, **kwargs)
+
+        columns = set(plan[0])
+        params = request.query_params
+        if params.get('pagination') == 'cursor' or 'cursor' in params:
+            # cursor pages read the position of the last row
+            columns.update(getattr(self, 'cursor_ordering_fields', ()))
+
+        queryset = self.filter_queryset(self.get_queryset()).prefetch_related(None).values(*columns)
+        serializer.row_fields = plan
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer.instance = list(page)
+            return self.get_paginated_response(serializer.data)
+
+        serializer.instance = list(queryset)
+        return Response(serializer.data)
+
+    def paginate_queryset(self, queryset):
+        # the database reads an unordered query in the order of the index it picks, which changes with the columns read
+        if not queryset.ordered:
+            queryset = queryset.order_by(queryset.model._meta.pk.name)
+        return super(ValuesListMixin, self).paginate_queryset(queryset)
+
+
+class ReplicaReadsMixin(object):
+    """Serve the ``replica_actions`` of the view set from the replicas, see core.routers
+
+    Authentication and permissions are checked on the primary, only the reads of the
+    action itself may go to a replica.
+    """
+
+    replica_actions = ('list', 'retrieve')
+
+    def initial(self, request, *args, **kwargs):
+        super(ReplicaReadsMixin, self).initial(request, *args, **kwargs)
+
+        if request.method in SAFE_METHODS and self.action in self.replica_actions:
+            routers.set_replica_reads(True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        routers.set_replica_reads(False)
+        return super(ReplicaReadsMixin, self).finalize_response(request, response, *args, **kwargs)
+
+
+class QueueWaiting(APIException):
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+    default_code = 'queue_waiting'
+
+    def __init__(self, ticket):
+        super(QueueWaiting, self).__init__('Aguarde sua vez na fila do evento, há {0} pessoas na sua frente.'.format(ticket.ahead))
+        self.wait = max(math.ceil(ticket.wait), 1)  # sent on Retry-After
+
+
+class AdmissionMixin(object):
+    """Let the ``admission_actions`` through only for users admitted by the waiting room of the event
+
+    The queue token given by POST /api/events/id/queue goes on the X-Queue-Token header,
+    see core.admission. Events without a waiting room do not ask for it, checking
+    costs one cache read and a query once a minute.
+    """
+
+    admission_actions = ()
+
+    def get_admission_event(self, request):
+        """
+        id of the event the request claims seats of, given as an id or as the hyperlink of the event
+        """
+
+        event = request.data.get('event')
+        if isinstance(event, str) and '/' in event:
+            try:
+                return resolve(urlsplit(event).path).kwargs.get('pk')
+            except Resolver404:
+                return None
+        return event
+
+    def initial(self, request, *args, **kwargs):
+        super(AdmissionMixin, self).initial(request, *args, **kwargs)
+
+        if self.action not in self.admission_actions or request.method in SAFE_METHODS:
+            return
+
+        try:
+            event_id = int(self.get_admission_event(request))
+        except (TypeError, ValueError):
+            return  # left to the action to refuse
+
+        if not admission.get_rate(event_id):
+            return
+
+        try:
+            ticket = admission.check(request.META.get('HTTP_X_QUEUE_TOKEN', ''), event_id, request.user.id)
+        except admission.InvalidTicket:
+            raise PermissionDenied('Entre na fila do evento para reservar seus assentos.')
+
+        if not ticket.admitted:
+            raise QueueWaiting(ticket)
+
+
+class IdempotencyConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Uma requisição com a mesma Idempotency-Key ainda está em andamento.'
+    default_code = 'idempotency_conflict'
+    wait = 1  # sent on Retry-After
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = 422
+    default_detail = 'Idempotency-Key já usada em uma requisição diferente.'
+    default_code = 'idempotency_key_reused'
+
+
+class IdempotentReplay(Exception):
+
+    def __init__(self, result):
+        super(IdempotentReplay, self).__init__()
+        self.result = result
+
+
+class IdempotencyMixin(object):
+    """Run the POST actions sent with an Idempotency-Key header once
+
+    The response is kept for IDEMPOTENCY_TTL seconds and replayed to the retries of the
+    same user with the same key on the same path, from any network, without running
+    the action again nor touching the database. Retries are looked up before the
+    throttles and the waiting room, a call that ran gets its response back even when
+    it would be refused now. Duplicates arriving while the first call runs wait for its
+    response. Refused calls and server errors are not kept, the call may be retried.
+    ``idempotent_actions`` names the actions taking the header, None for every POST action.
+    """
+
+    idempotent_actions = None
+    replayed_headers = ('Content-Type', 'Location', 'Retry-After')
+
+    idempotency_key = None
+    idempotency_fingerprint = None
+    idempotency_request = None
+
+    def get_idempotency_request(self, request):
+        """
+        scoped key and fingerprint of the call, None when it runs without an Idempotency-Key
+        """
+
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not key or request.method != 'POST':
+            return None
+        if self.idempotent_actions is not None and self.action not in self.idempotent_actions:
+            return None
+        if len(key) > 255:
+            raise ValidationError('Idempotency-Key inválida.')
+
+        scoped_key = idempotency.make_key(request.user.pk, request.path, key)
+        data = dict(request.data.lists()) if hasattr(request.data, 'lists') else request.data  # every value of form fields
+        fingerprint = hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        return scoped_key, fingerprint
+
+    def check_throttles(self, request):
+        self.idempotency_request = self.get_idempotency_request(request)
+
+        if self.idempotency_request is not None:
+            try:
+                result = idempotency.get(*self.idempotency_request)
+            except idempotency.KeyReused:
+                raise IdempotencyKeyReused()
+            if result is not None:
+                raise IdempotentReplay(result)
+
+        super(IdempotencyMixin, self).check_throttles(request)
+
+    def initial(self, request, *args, **kwargs):
+        super(IdempotencyMixin, self).initial(request, *args, **kwargs)
+
+        if self.idempotency_request is None:
+            return
+        scoped_key, fingerprint = self.idempotency_request
+
+        try:
+            if idempotency.acquire(scoped_key):
+                # the first call may have finished since the lookup
+                result = idempotency.get(scoped_key, fingerprint)
+                if result is None:
+                    self.idempotency_key, self.idempotency_fingerprint = scoped_key, fingerprint
+                    return
+                idempotency.release(scoped_key)
+            else:
+                result = idempotency.wait(scoped_key, fingerprint, settings.IDEMPOTENCY_WAIT)
+        except idempotency.KeyReused:
+            raise IdempotencyKeyReused()
+
+        if result is None:
+            raise IdempotencyConflict()
+
+        raise IdempotentReplay(result)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, IdempotentReplay):
+            response = HttpResponse(exc.result['content'], status=exc.result['status'])
+            for header, value in exc.result['headers'].items():
+                response[header] = value
+            response['Idempotent-Replayed'] = 'true'
+            return response
+
+        return super(IdempotencyMixin, self).handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(IdempotencyMixin, self).finalize_response(request, response, *args, **kwargs)
+
+        if self.idempotency_key is not None and response.status_code < 500 and not response.streaming:
+            if hasattr(response, 'render'):
+                response.render()
+            headers = {header: response[header] for header in self.replayed_headers if response.has_header(header)}
+            idempotency.save(self.idempotency_key, self.idempotency_fingerprint, response.status_code, response.content, headers)
+            self.idempotency_key = None
+
+        return response
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(IdempotencyMixin, self).dispatch(request, *args, **kwargs)
+        finally:
+            # server errors and unhandled exceptions let the key go for the retries
+            if self.idempotency_key is not None:
+                idempotency.release(self.idempotency_key)
+                self.idempotency_key = None
+
+
+class InstrumentedMixin(object):
+    """
+    time the authentication, permission and throttle checks of the view set, see core.metrics
+    """
+
+    def perform_authentication(self, request):
+        with timed('auth'):
+            super(InstrumentedMixin, self).perform_authentication(request)
+
+    def check_permissions(self, request):
+        with timed('permissions'):
+            super(InstrumentedMixin, self).check_permissions(request)
+
+    def check_object_permissions(self, request, obj):
+        with timed('permissions'):
+            super(InstrumentedMixin, self).check_object_permissions(request, obj)
+
+    def check_throttles(self, request):
+        with timed('throttles'):
+            super(InstrumentedMixin, self).check_throttles(request)
+
+
+class InstrumentedSerializerMixin(object):
+    """
+    time the serialization of the objects, see core.metrics
+    """
+
+    def to_representation(self, instance):
+        with timed('serialize'):
+            return super(InstrumentedSerializerMixin, self).to_representation(instance)
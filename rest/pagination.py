@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from rest_framework import pagination
+from rest_framework.exceptions import ValidationError
+
+
+class CursorPagination(pagination.CursorPagination):
+    """Pages keyed on an indexed column, each page costs the same however deep it is
+
+    The view lists the columns it may be ordered by on ``cursor_ordering_fields``, the
+    first one being the default. ?ordering= picks another one, prefixed by - for the
+    descending order, ties are broken by id.
+    """
+
+    page_size_query_param = 'limit'
+    max_page_size = 500
+
+    def get_ordering(self, request, queryset, view):
+        fields = getattr(view, 'cursor_ordering_fields', ('id', ))
+        ordering = request.query_params.get('ordering') or fields[0]
+
+        field = ordering.lstrip('-')
+        if field not in fields:
+            raise ValidationError('Ordenação inválida, use um dos campos: {0}.'.format(', '.join(fields)))
+
+        if field == 'id':
+            return (ordering, )
+        return (ordering, '-id' if ordering.startswith('-') else 'id')
+
+
+class LimitOffsetOrCursorPagination(pagination.LimitOffsetPagination):
+    """
+    limit/offset pages by default, cursor pages with ?pagination=cursor and the next and previous links they return
+    """
+
+    cursor_class = CursorPagination
+    cursor = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get('pagination') == 'cursor' or self.cursor_class.cursor_query_param in request.query_params:
+            self.cursor = self.cursor_class()
+            return self.cursor.paginate_queryset(queryset, request, view)
+
+        self.cursor = None
+        return super(LimitOffsetOrCursorPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor is not None:
+            return self.cursor.get_paginated_response(data)
+        return super(LimitOffsetOrCursorPagination, self).get_paginated_response(data)
+
+    def to_html(self):
+        if self.cursor is not None:
+            return self.cursor.to_html()
+        return super(LimitOffsetOrCursorPagination, self).to_html()
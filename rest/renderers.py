@@ -0,0 +1,32 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from core.metrics import timed
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """
+    json renderer counting its time in the render phase of the request, see core.metrics
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timed('render'):
+            return super(TimedJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    accepts text/event-stream requests, the views stream the events themselves
+    """
+
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # errors raised before the stream starts are sent as a single event
+        return 'event: error\ndata: {0}\n\n'.format(json.dumps(data)).encode(self.charset)
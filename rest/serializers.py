@@ -1,12 +1,127 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+from drf_queryfields import QueryFieldsMixin
 from rest_framework import serializers
+from rest_framework.relations import PKOnlyObject
 
+from core.metrics import timed
 from core.models import User, Token, Event, Seat, Reserve
+from rest.mixins import InstrumentedSerializerMixin
 
 
-class UserSerializer(serializers.HyperlinkedModelSerializer):
+class ValuesListSerializer(serializers.ListSerializer):
+    """Render the rows of a ``.values()`` queryset as the child serializer renders instances
+
+    No model instance is built: the hyperlinks come from a url reversed once per page,
+    the fields computed from other columns are rendered by the ``row_<field>`` methods
+    of the child serializer, and the ids of many to many fields are read with one query
+    per page. Lists of instances go through the child serializer as usual.
+    """
+
+    url_marker = 'ROWPK'
+
+    def get_url_template(self, field):
+        """
+        function building the url of a hyperlinked field from a pk, None when the reversed url can not be split around it
+        """
+
+        url = str(field.to_representation(PKOnlyObject(pk=self.url_marker)))
+        if url.count(self.url_marker) != 1:
+            return None
+
+        prefix, suffix = url.split(self.url_marker)
+        return lambda pk: '{0}{1}{2}'.format(prefix, pk, suffix)
+
+    def get_row_fields(self, field_columns):
+        """Plan the rendering of the readable fields of the child serializer from rows
+
+        Arguments:
+            field_columns {dict} -- columns read by the fields computed from other columns, as on SparseFieldsMixin
+
+        Returns:
+            tuple -- columns to read and (field, render) pairs, render taking a row, None when a field can not be rendered from rows
+        """
+
+        meta = self.child.Meta.model._meta
+        columns, fields = {meta.pk.name}, []
+
+        for field in self.child._readable_fields:
+            name = field.field_name
+            row_method = getattr(self.child, 'row_{0}'.format(name), None)
+
+            if row_method is not None:
+                if name not in field_columns:
+                    return None
+                columns.update(field_columns[name])
+                fields.append((name, row_method))
+
+            elif isinstance(field, serializers.HyperlinkedIdentityField):
+                url = self.get_url_template(field)
+                if url is None:
+                    return None
+                fields.append((name, lambda row, url=url, pk=meta.pk.name: url(row[pk])))
+
+            elif isinstance(field, serializers.ManyRelatedField):
+                url = self.get_url_template(field.child_relation) if isinstance(
+                    field.child_relation, serializers.HyperlinkedRelatedField) else None
+                if url is None or not meta.get_field(field.source).many_to_many:
+                    return None
+                fields.append((name, lambda row, url=url, source=field.source: [url(pk) for pk in row[source]]))
+
+            elif isinstance(field, serializers.HyperlinkedRelatedField):
+                url = self.get_url_template(field) if field.lookup_field == 'pk' else None
+                if url is None or '.' in field.source:
+                    return None
+                columns.add(field.source)
+                fields.append((name, lambda row, url=url, source=field.source: None if row[source] is None else url(row[source])))
+
+            elif isinstance(field, (serializers.RelatedField, serializers.SerializerMethodField, serializers.BaseSerializer)) \
+                    or field.source == '*' or '.' in field.source:
+                return None
+
+            else:
+                columns.add(field.source)
+                fields.append((name, lambda row, render=field.to_representation, source=field.source:
+                               None if row[source] is None else render(row[source])))
+
+        return columns, fields
+
+    def get_related_ids(self, rows, source):
+        """
+        ids of the objects related to each row by the many to many field ``source``, in the order prefetch_related reads them
+        """
+
+        field = self.child.Meta.model._meta.get_field(source)
+        pk = self.child.Meta.model._meta.pk.name
+        related = {row[pk]: [] for row in rows}
+
+        lookup = field.related_query_name()
+        for row_pk, related_pk in field.related_model._default_manager.filter(
+                **{'{0}__in'.format(lookup): list(related)}).values_list(lookup, 'pk'):
+            related[row_pk].append(related_pk)
+
+        return related
+
+    def to_representation(self, data):
+        plan = getattr(self, 'row_fields', None)
+        if plan is None or not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+            return super(ValuesListSerializer, self).to_representation(data)
+
+        _, fields = plan
+        pk = self.child.Meta.model._meta.pk.name
+
+        with timed('serialize'):
+            for field in self.child._readable_fields:
+                if isinstance(field, serializers.ManyRelatedField):
+                    related = self.get_related_ids(data, field.source)
+                    for row in data:
+                        row[field.source] = related[row[pk]]
+
+            return [{name: render(row) for name, render in fields} for row in data]
+
+
+class UserSerializer(InstrumentedSerializerMixin, QueryFieldsMixin, serializers.HyperlinkedModelSerializer):
     first_name = serializers.CharField()
     last_name = serializers.CharField()
     email = serializers.EmailField()
@@ -21,7 +136,7 @@ class UserSerializer(serializers.HyperlinkedModelSerializer):
         depth = 2
 
 
-class TokenSerializer(serializers.HyperlinkedModelSerializer):
+class TokenSerializer(InstrumentedSerializerMixin, QueryFieldsMixin, serializers.HyperlinkedModelSerializer):
     hashcode = serializers.CharField()
     validity = serializers.DateField(format='%d/%m/%Y')
     validate_in = serializers.DateField(format='%d/%m/%Y')
@@ -34,36 +149,70 @@ class TokenSerializer(serializers.HyperlinkedModelSerializer):
         depth = 1
 
 
-class EventSerializer(serializers.HyperlinkedModelSerializer):
+class EventSerializer(InstrumentedSerializerMixin, QueryFieldsMixin, serializers.HyperlinkedModelSerializer):
     title = serializers.CharField()
     date = serializers.DateTimeField(format='%d/%m/%Y %H:%M')
     max_seatings = serializers.IntegerField()
     max_tickets = serializers.IntegerField()
+    claimed_seats = serializers.IntegerField(read_only=True)
+    free_seats = serializers.IntegerField(read_only=True)
+    finished_reserves = serializers.IntegerField(read_only=True)
+    paid_reserves = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Event
-        fields = ('url', 'title', 'date', 'max_seatings', 'max_tickets')
+        fields = ('url', 'title', 'date', 'max_seatings', 'max_tickets', 'claimed_seats', 'free_seats', 'finished_reserves',
+                  'paid_reserves')
         depth = 1
+        list_serializer_class = ValuesListSerializer
+
+    def row_free_seats(self, row):
+        return Event.count_free_seats(row['max_seatings'], row['claimed_seats'])
 
-class SeatSerializer(serializers.HyperlinkedModelSerializer):
+class SeatSerializer(InstrumentedSerializerMixin, QueryFieldsMixin, serializers.HyperlinkedModelSerializer):
     row = serializers.CharField()
     column = serializers.IntegerField()
     type = serializers.ChoiceField(choices=((0, 'Balcão'), (1, 'Palco')))
-    slug = serializers.CharField()
-    is_reserved = serializers.BooleanField()
+    slug = serializers.CharField(read_only=True)
+    is_reserved = serializers.SerializerMethodField()
 
     class Meta:
         model = Seat
         fields = ('url', 'row', 'column', 'type', 'slug', 'is_reserved')
         depth = 1
+        list_serializer_class = ValuesListSerializer
+
+    def get_is_reserved(self, seat):
+        # the view set shares the reserved seats of the whole page, avoiding a query per seat
+        reserved = self.context.get('reserved_seats')
+        if reserved is None:
+            return seat.is_reserved
+        return seat.id in reserved
+
+    def row_slug(self, row):
+        return Seat.make_slug(row['type'], row['row'], row['column'])
+
+    def row_is_reserved(self, row):
+        reserved = self.context.get('reserved_seats')
+        if reserved is None:
+            return Reserve.objects.filter(seats__id=row['id']).exists()
+        return row['id'] in reserved
 
 
-class ReserveSerializer(serializers.HyperlinkedModelSerializer):
+class ReserveSerializer(InstrumentedSerializerMixin, QueryFieldsMixin, serializers.HyperlinkedModelSerializer):
     alumn = serializers.HyperlinkedRelatedField(required=False, allow_null=True, queryset=User.objects.all(), view_name='user-detail')
     event = serializers.HyperlinkedRelatedField(required=False, allow_null=True, queryset=Event.objects.all(), view_name='event-detail')
-    seats = serializers.HyperlinkedRelatedField(many=True, queryset=Seat.objects.all(), view_name='seat-detail')
+    seats = serializers.HyperlinkedRelatedField(many=True, read_only=True, view_name='seat-detail')  # claimed through add-seat
 
     class Meta:
         model = Reserve
         fields = ('url', 'alumn', 'event', 'seats')
         depth = 2
+        list_serializer_class = ValuesListSerializer
+
+    def get_fields(self):
+        fields = super(ReserveSerializer, self).get_fields()
+        if self.instance is not None and 'event' in fields:
+            # set on create only, the seats of the reserve were claimed for its event
+            fields['event'].read_only = True
+        return fields
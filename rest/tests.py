@@ -1,3 +1,1131 @@
-from django.test import TestCase
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+import hashlib
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+from io import StringIO
+from itertools import islice
+from unittest import mock
+
+import pytz
+from django.contrib.auth.hashers import make_password
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from core import idempotency, layout, routers
+from core.checks import check_shared_cache
+from core.claims import claim_seats
+from core.metrics import FLOOR_KEY, SNAPSHOT_KEY, Registry, RequestStats, collect, registry, timed
+from core.models import Event, Reserve, ReserveSeat, Seat, SeatDelta, Token, User
+from core.seatmap import get_seat_map
+from core.streams import DatabaseBroker, InMemoryBroker, Subscription, get_broker
+from populate import hall_seats, load
+from rest.throttles import EventActionThrottle, SlidingWindowThrottle, UserActionThrottle
+
+TZ = pytz.timezone('America/Sao_Paulo')
+
+
+def create_event(max_tickets=3):
+    return Event.objects.create(title='Mario e Luigi salvam a princesa Peach sapateando.',
+        date=datetime(2018, 12, 10, 20, tzinfo=TZ), max_seatings=100, max_tickets=max_tickets)
+
+
+def read_events(response, count):
+    events = []
+    for chunk in response.streaming_content:
+        chunk = chunk.decode('utf-8')
+        if chunk.startswith(('retry', ':')):
+            continue
+        fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+        events.append((fields['event'], json.loads(fields['data'])))
+        if len(events) == count:
+            break
+    return events
+
+
+class InMemoryBrokerTestCase(TestCase):
+
+    def test_publish_fans_out_to_watchers(self):
+        broker = InMemoryBroker()
+        watchers = [broker.subscribe(1) for _ in range(3)]
+        other = broker.subscribe(2)
+
+        delta = broker.publish(1, 'claimed', [10, 11])
+
+        for watcher in watchers:
+            self.assertEqual(watcher.get(timeout=0), delta)
+        self.assertIsNone(other.get(timeout=0))
+
+    def test_reconnecting_watcher_gets_missed_deltas(self):
+        broker = InMemoryBroker()
+        first = broker.publish(1, 'claimed', [10])
+        second = broker.publish(1, 'released', [10])
+
+        watcher = broker.subscribe(1, last_id=first['id'])
+
+        self.assertEqual(watcher.get(timeout=0), second)
+        self.assertIsNone(watcher.get(timeout=0))
+
+    def test_closed_watcher_is_removed(self):
+        broker = InMemoryBroker()
+        watcher = broker.subscribe(1)
+        watcher.close()
+
+        self.assertEqual(broker.watchers(1), 0)
+
+
+@override_settings(SEAT_STREAM_BROKER='core.streams.DatabaseBroker', SEAT_STREAM_POLL=0.05)
+class DatabaseBrokerTestCase(TransactionTestCase):
+
+    def broker(self):
+        broker = DatabaseBroker()
+        self.addCleanup(broker.stop)
+        return broker
+
+    def test_deltas_of_other_processes(self):
+        web, reaper = self.broker(), self.broker()
+        watcher = web.subscribe(1)
+
+        delta = reaper.publish(1, 'released', [10, 11])
+
+        self.assertEqual(watcher.get(timeout=2), delta)
+        self.assertEqual(delta['seats'], [10, 11])
+
+    def test_reconnect_to_another_process(self):
+        first = self.broker().publish(1, 'claimed', [10])
+        second = self.broker().publish(1, 'released', [10])
+        self.broker().publish(2, 'claimed', [10])
+
+        watcher = self.broker().subscribe(1, last_id=first['id'])
+
+        self.assertEqual(watcher.get(timeout=0), second)
+        self.assertIsNone(watcher.get(timeout=0.2))
+
+    def test_late_commits(self):
+        broker = DatabaseBroker()
+        broker.floor = 0
+        watcher = Subscription(broker, 1, ())
+        broker.subscriptions[1].add(watcher)
+
+        SeatDelta.objects.create(id=1, event_id=1, state='claimed', seats='[1]')
+        SeatDelta.objects.create(id=3, event_id=1, state='claimed', seats='[3]')
+        broker.read()
+        self.assertEqual([watcher.get(timeout=0)['id'] for _ in range(2)], [1, 3])
+        self.assertEqual(broker.floor, 1)
+
+        # id 2 was drawn first and committed last
+        SeatDelta.objects.create(id=2, event_id=1, state='claimed', seats='[2]')
+        broker.read()
+        self.assertEqual(watcher.get(timeout=0)['id'], 2)
+        self.assertEqual(broker.floor, 3)
+
+        # an id never committed is given up
+        SeatDelta.objects.create(id=5, event_id=1, state='claimed', seats='[5]')
+        broker.read()
+        with override_settings(SEAT_STREAM_GAP=0):
+            broker.read()
+        self.assertEqual(broker.floor, 5)
+
+    def test_reaper_releases_reach_the_watchers(self):
+        event = create_event()
+        seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 3)]
+        alumn = User.objects.create_user(email='mario@tap.com', username='mario')
+        claim_seats(alumn, event.id, [seat.id for seat in seats])
+        Reserve.objects.update(updated_at=timezone.now() - timedelta(minutes=21))
+
+        broker = get_broker()
+        self.addCleanup(broker.stop)
+        watcher = broker.subscribe(event.id)
+
+        call_command('release_expired_reserves', stdout=StringIO())
+
+        delta = watcher.get(timeout=2)
+        self.assertEqual((delta['state'], sorted(delta['seats'])), ('released', [seat.id for seat in seats]))
+
+
+@override_settings(SEAT_STREAM_BROKER='core.streams.InMemoryBroker', SEAT_STREAM_TIMEOUT=2, SEAT_STREAM_KEEPALIVE=0.1)
+class SeatStreamTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 4)]
+        self.alumn = User.objects.create_user(email='mario@tap.com', username='mario')
+        self.admin = User.objects.create_user(email='admin@tap.com', username='admin', is_staff=True)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.alumn)
+
+    def test_stream_seat_changes(self):
+        stream = self.client.get('/api/events/{0}/seat-stream/'.format(self.event.id), HTTP_ACCEPT='text/event-stream')
+
+        self.assertEqual(stream['Content-Type'], 'text/event-stream')
+        self.assertEqual(read_events(stream, 1)[0][1]['reserved'], 0)
+
+        self.client.post('/api/reservations/add-seats/', {'event': self.event.id, 'seats': [self.seats[0].id, self.seats[1].id]}, format='json')
+        reserve = self.alumn.reserve_set.get()
+
+        self.client.force_authenticate(self.admin)
+        self.client.post('/api/reservations/{0}/paid/'.format(reserve.id), {'paid': True})
+        self.client.post('/api/reservations/{0}/cancel/'.format(reserve.id), {'cancel': True})
+
+        events = read_events(stream, 3)
+
+        self.assertEqual([state for state, _ in events], ['claimed', 'paid', 'released'])
+        self.assertEqual(sorted(events[0][1]['seats']), [self.seats[0].id, self.seats[1].id])
+
+    def test_delta_published_while_reading_the_seat_map(self):
+        def read_after_a_claim(event_id):
+            get_broker().publish(event_id, 'claimed', [self.seats[2].id])
+            return get_seat_map(event_id)
+
+        with mock.patch('rest.views.get_seat_map', side_effect=read_after_a_claim):
+            stream = self.client.get('/api/events/{0}/seat-stream/'.format(self.event.id), HTTP_ACCEPT='text/event-stream')
+
+        events = read_events(stream, 2)
+
+        self.assertEqual([state for state, _ in events], ['snapshot', 'claimed'])
+        self.assertEqual(events[1][1]['seats'], [self.seats[2].id])
+
+    def test_stream_unknown_event(self):
+        response = self.client.get('/api/events/0/seat-stream/', HTTP_ACCEPT='text/event-stream')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(get_broker().watchers(0), 0)
+
+
+class ListPaginationTestCase(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(email='admin@tap.com', username='admin', password='tapacademy')
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 26)]
+        for seat, alumn in zip(self.seats, [User.objects.create(email='alumn{0}@tap.com'.format(i), username='alumn{0}'.format(i))
+                                            for i in range(25)]):
+            reserve = Reserve.objects.create(alumn=alumn, event=self.event)
+            ReserveSeat.objects.create(reserve=reserve, seat=seat, event=self.event)
+
+    def test_cursor_pages(self):
+        urls, url = [], '/api/reservations/?pagination=cursor&ordering=-updated_at&limit=10'
+        while url:
+            response = self.client.get(url)
+            urls.extend(reserve['url'] for reserve in response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual(len(urls), 25)
+        self.assertEqual(len(set(urls)), 25)
+        self.assertNotIn('count', response.data)
+
+        self.assertEqual(self.client.get('/api/reservations/?pagination=cursor&ordering=code').status_code, 400)
+
+    def test_limit_offset_pages_by_default(self):
+        response = self.client.get('/api/reservations/?limit=10&offset=20')
+
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_sparse_fields(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get('/api/reservations/?fields=url,event')
+
+        self.assertEqual(set(response.data['results'][0]), {'url', 'event'})
+        self.assertNotIn('alumn_id', captured.captured_queries[-1]['sql'])
+        self.assertNotIn('core_reserve_seats', captured.captured_queries[-1]['sql'])
+
+        response = self.client.get('/api/seats/?fields!=is_reserved,url')
+        self.assertEqual(set(response.data['results'][0]), {'row', 'column', 'type', 'slug'})
+
+    def test_reserved_seats_of_the_page(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get('/api/seats/?limit=2&offset=1')
+
+        # reserved for any event, looked up for the seats of the page only
+        self.assertEqual([seat['is_reserved'] for seat in response.data['results']], [True, True])
+        self.assertIn('"seat_id" IN', captured.captured_queries[-1]['sql'])
+
+
+class ReserveUpdateTestCase(TestCase):
+
+    def test_event_is_kept(self):
+        admin = User.objects.create_superuser(email='admin@tap.com', username='admin', password='tapacademy')
+        client = APIClient()
+        client.force_authenticate(admin)
+        event, other = create_event(), create_event()
+        seat = Seat.objects.create(type=1, row='A', column=1)
+        reserve, _, _ = claim_seats(admin, event.id, [seat.id])
+
+        response = client.put('/api/reservations/{0}/'.format(reserve.pk), {'event': 'http://testserver/api/events/{0}/'.format(other.pk)})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Reserve.objects.get(pk=reserve.pk).event_id, event.id)
+        self.assertEqual(ReserveSeat.objects.get(reserve=reserve).event_id, event.id)
+
+
+class AddSeatsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.event = create_event(max_tickets=3)
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 6)]
+        self.alumn = User.objects.create_user(email='mario@tap.com', username='mario')
+        self.other = User.objects.create_user(email='luigi@tap.com', username='luigi')
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.alumn)
+
+    def add_seats(self, seats):
+        return self.client.post('/api/reservations/add-seats/', {'event': self.event.id, 'seats': [seat.id for seat in seats]}, format='json')
+
+    def reserved(self, alumn):
+        return sorted(ReserveSeat.objects.filter(reserve__alumn=alumn).values_list('seat_id', flat=True))
+
+    def test_all_seats_added(self):
+        response = self.add_seats(self.seats[:2])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['seats'], [{'seat': seat.id, 'slug': seat.slug, 'status': 'reserved'} for seat in self.seats[:2]])
+        self.assertEqual(response.data['available_tickets'], 1)
+        self.assertEqual(self.reserved(self.alumn), [seat.id for seat in self.seats[:2]])
+
+    def test_taken_seat_adds_none(self):
+        claim_seats(self.other, self.event.id, [self.seats[1].id])
+
+        response = self.add_seats(self.seats[:3])
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['seats'], [{'seat': self.seats[0].id, 'status': 'not_reserved'},
+                                                  {'seat': self.seats[1].id, 'status': 'taken'},
+                                                  {'seat': self.seats[2].id, 'status': 'not_reserved'}])
+        self.assertEqual(self.reserved(self.alumn), [])
+        self.assertEqual(self.reserved(self.other), [self.seats[1].id])
+
+    def test_ticket_limit_adds_none(self):
+        self.add_seats(self.seats[:2])
+
+        response = self.add_seats(self.seats[2:4])
+
+        self.assertEqual(response.status_code, 300)
+        self.assertEqual(response.data['seats'], [{'seat': seat.id, 'status': 'not_reserved'} for seat in self.seats[2:4]])
+        self.assertEqual(self.reserved(self.alumn), [seat.id for seat in self.seats[:2]])
+
+
+class SeatLayoutTestCase(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.seat = Seat.objects.create(type=1, row='A', column=1)
+
+    def get(self, **headers):
+        return APIClient().get('/api/seats/layout/', **headers)
+
+    def test_not_modified(self):
+        response = self.get()
+        etag = response['ETag']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['sections'][0]['rows'], [{'row': 'A', 'seats': [[self.seat.id, 1]]}])
+
+        for if_none_match in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+            response = self.get(HTTP_IF_NONE_MATCH=if_none_match)
+            self.assertEqual((response.status_code, response['ETag']), (304, etag))
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_seat_changes_invalidate(self):
+        etag = self.get()['ETag']
+
+        self.seat.row = 'B'
+        self.seat.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'"row":"B"', response.content)
+
+        etag = response['ETag']
+        self.seat.delete()
+        self.assertNotEqual(self.get()['ETag'], etag)
+
+    def test_bumped_on_commit(self):
+        etag = self.get()['ETag']
+        version = cache.get(layout.VERSION_KEY)
+
+        with transaction.atomic():
+            self.seat.row = 'B'
+            self.seat.save()
+            self.assertEqual(cache.get(layout.VERSION_KEY), version)
+
+        self.assertNotEqual(self.get()['ETag'], etag)
+
+    def test_bulk_load_invalidates(self):
+        etag = self.get()['ETag']
+
+        with transaction.atomic(), redirect_stdout(StringIO()):
+            load(Seat, [Seat(id=self.seat.id + 1, type=0, row='C', column=2)], batch_size=10)
+
+        self.assertNotEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class ReserveExportTestCase(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(email='admin@tap.com', username='admin', password='tapacademy')
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+        self.event = create_event()
+        seats = [Seat.objects.create(type=0, row='A', column=column) for column in range(1, 4)]
+        for i, alumn in enumerate(User.objects.create(email='alumn{0}@tap.com'.format(i), username='alumn{0}'.format(i))
+                                  for i in range(3)):
+            reserve = Reserve.objects.create(alumn=alumn, event=self.event, is_paid=i > 0)
+            ReserveSeat.objects.create(reserve=reserve, seat=seats[i], event=self.event)
+
+    def export(self, query):
+        response = self.client.get('/api/reservations/export/' + query)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8').splitlines()
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_export_ndjson(self):
+        rows = [json.loads(line) for line in self.export('?event={0}'.format(self.event.pk))]
+
+        self.assertEqual([row['alumn_email'] for row in rows], ['alumn0@tap.com', 'alumn1@tap.com', 'alumn2@tap.com'])
+        self.assertEqual([row['seats'] for row in rows], [['Balcão A1'], ['Balcão A2'], ['Balcão A3']])
+
+    def test_export_csv(self):
+        lines = self.export('?output=csv&paid=false')
+
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('id,code,is_paid'))
+        self.assertIn('alumn0@tap.com', lines[1])
+
+
+class WaitingRoomTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 3)]
+        self.alumns = [User.objects.create_user(email='alumn{0}@tap.com'.format(i), username='alumn{0}'.format(i)) for i in range(2)]
+        admin = User.objects.create_user(email='admin@tap.com', username='admin', is_staff=True)
+
+        client = APIClient()
+        client.force_authenticate(admin)
+        response = client.post('/api/events/{0}/admission/'.format(self.event.id), {'rate': 1})
+        self.assertEqual(response.data['rate'], 1)
+
+        self.clients = []
+        for alumn in self.alumns:
+            self.clients.append(APIClient())
+            self.clients[-1].force_authenticate(alumn)
+
+    def add_seat(self, client, seat, token=None):
+        headers = {'HTTP_X_QUEUE_TOKEN': token} if token else {}
+        return client.post('/api/reservations/add-seat/', {'event': self.event.id, 'seat': seat.id}, **headers)
+
+    def test_waiting_room(self):
+        self.assertEqual(self.add_seat(self.clients[0], self.seats[0]).status_code, 403)
+
+        first, second = [client.post('/api/events/{0}/queue/'.format(self.event.id)).data for client in self.clients]
+        self.assertEqual((first['position'], first['admitted']), (1, True))
+        self.assertEqual((second['position'], second['ahead'], second['admitted']), (2, 1, False))
+
+        self.assertEqual(self.add_seat(self.clients[0], self.seats[0], first['token']).status_code, 200)
+        self.assertEqual(self.add_seat(self.clients[1], self.seats[1], first['token']).status_code, 403)
+
+        response = self.add_seat(self.clients[1], self.seats[1], second['token'])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+
+        # waiting users poll without touching the database
+        with self.assertNumQueries(0):
+            response = APIClient().get('/api/events/{0}/queue-position/'.format(self.event.id), {'token': second['token']})
+        self.assertEqual(response.data['ahead'], 1)
+
+        with mock.patch('core.admission.time.time', return_value=time.time() + 2):
+            self.assertEqual(self.add_seat(self.clients[1], self.seats[1], second['token']).status_code, 200)
+
+    def test_invalid_token(self):
+        response = APIClient().get('/api/events/{0}/queue-position/'.format(self.event.id), {'token': 'x'})
+
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES={
+    'claim': '2/min', 'claim-event': '3/min', 'finish': '10/min', 'confirmation': '10/min'}))
+class ThrottleTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 6)]
+        self.alumns = [User.objects.create_user(email='alumn{0}@tap.com'.format(i), username='alumn{0}'.format(i)) for i in range(2)]
+
+    def add_seat(self, alumn, seat):
+        client = APIClient()
+        client.force_authenticate(alumn)
+        return client.post('/api/reservations/add-seat/', {'event': self.event.id, 'seat': seat.id})
+
+    def test_claims(self):
+        self.assertEqual([self.add_seat(self.alumns[0], seat).status_code for seat in self.seats[:2]], [200, 200])
+
+        response = self.add_seat(self.alumns[0], self.seats[2])
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(1 <= int(response['Retry-After']) <= 120)  # up to the end of the next window
+        self.assertIn('Tente novamente em', response.data['detail'])
+
+        # the other user has its own limit, the event one is shared
+        self.assertEqual([self.add_seat(self.alumns[1], seat).status_code for seat in self.seats[3:]], [200, 429])
+
+        admin = User.objects.create_user(email='admin@tap.com', username='admin', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(admin)
+        stats = client.get('/api/reservations/throttles/').data
+        self.assertEqual(stats['claim'], {'rate': '2/min', 'rejected': 1})
+        self.assertEqual(stats['claim-event']['rejected'], 1)
+
+    def test_sliding_window(self):
+        request = mock.Mock(user=mock.Mock(pk=1, is_authenticated=True))
+        view = mock.Mock(action='finish', throttle_scopes={'finish': 'finish'}, get_admission_event=mock.Mock(return_value=None))
+
+        def allow(now):
+            throttle = UserActionThrottle()
+            with mock.patch.object(SlidingWindowThrottle, 'timer', mock.Mock(return_value=now)):
+                return throttle.allow_request(request, view), throttle
+
+        self.assertEqual([allow(6000 + second)[0] for second in range(10)], [True] * 10)
+        self.assertFalse(allow(6059)[0])
+
+        # half of the previous window still counts, 11 calls weigh 5.5
+        self.assertEqual([allow(6090)[0] for _ in range(4)], [True] * 4)
+        allowed, throttle = allow(6090)
+        self.assertFalse(allowed)
+        # the refused call counts, a retry goes through once the 11 calls of the previous window weigh 4
+        self.assertAlmostEqual(throttle.wait(), 60 * 3 / 22)
+        self.assertFalse(allow(6090 + 60 * 3 / 22 - 0.1)[0])
+
+    def test_shared_cache_check(self):
+        self.assertEqual([error.id for error in check_shared_cache(None)], ['core.E001'])
+
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+                                                   'LOCATION': '127.0.0.1:11211'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_event_spike(self):
+        request = mock.Mock(user=mock.Mock(pk=1, is_authenticated=True))
+        view = mock.Mock(action='add_seat', throttle_scopes={'add_seat': 'claim'}, get_admission_event=mock.Mock(return_value=7))
+
+        def allowed(second):
+            # 1000 calls in the second against the 100/s limit
+            calls = 0
+            for call in range(1000):
+                with mock.patch.object(SlidingWindowThrottle, 'timer', mock.Mock(return_value=second + call / 1000)):
+                    calls += EventActionThrottle().allow_request(request, view)
+            return calls
+
+        with override_settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES={'claim-event': '100/s'})):
+            # refused calls do not shut the claims of the event, they go on at about the rate
+            calls = [allowed(5000 + second) for second in range(4)]
+        self.assertEqual(calls[0], 100)
+        self.assertTrue(all(95 <= second <= 100 for second in calls[1:]), calls)
+
+
+class IdempotencyTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.event = create_event()
+        self.seats = [Seat.objects.create(type=1, row='A', column=column) for column in range(1, 3)]
+        self.alumn = User.objects.create_user(email='mario@tap.com', username='mario')
+        self.admin = User.objects.create_user(email='admin@tap.com', username='admin', is_staff=True)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.alumn)
+
+    def add_seat(self, seat, key):
+        return self.client.post('/api/reservations/add-seat/', {'event': self.event.id, 'seat': seat.id}, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay(self):
+        first = self.add_seat(self.seats[0], 'a')
+
+        with self.assertNumQueries(0):
+            retry = self.add_seat(self.seats[0], 'a')
+
+        self.assertEqual((retry.status_code, retry.content), (first.status_code, first.content))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+        self.assertEqual(ReserveSeat.objects.count(), 1)
+
+        # a key belongs to one request, a new key runs again
+        self.assertEqual(self.add_seat(self.seats[1], 'a').status_code, 422)
+        self.assertEqual(self.add_seat(self.seats[1], 'b').status_code, 200)
+        self.assertEqual(ReserveSeat.objects.count(), 2)
+
+    def test_retry_from_another_network(self):
+        first = self.add_seat(self.seats[0], 'a')
+        retry = self.client.post('/api/reservations/add-seat/', {'event': self.event.id, 'seat': self.seats[0].id},
+                                 HTTP_IDEMPOTENCY_KEY='a', REMOTE_ADDR='10.0.0.7')
+
+        self.assertEqual((retry.status_code, retry.content), (first.status_code, first.content))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+    @override_settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES={'claim': '1/min'}))
+    def test_replay_before_throttles(self):
+        first = self.add_seat(self.seats[0], 'a')
+
+        # the retry of the call that ran is not refused, a new call is and is not kept
+        self.assertEqual(self.add_seat(self.seats[0], 'a').content, first.content)
+        self.assertEqual(self.add_seat(self.seats[1], 'b').status_code, 429)
+        key = idempotency.make_key(self.alumn.pk, '/api/reservations/add-seat/', 'b')
+        self.assertIsNone(idempotency.get(key, ''))
+
+    def test_finish_keeps_code(self):
+        self.add_seat(self.seats[0], 'a')
+        reserve = Reserve.objects.get()
+        self.client.force_authenticate(self.admin)
+
+        self.client.post('/api/reservations/{0}/finish/'.format(reserve.pk), {'finished': True}, HTTP_IDEMPOTENCY_KEY='f')
+        code = Reserve.objects.get().code
+        self.client.post('/api/reservations/{0}/finish/'.format(reserve.pk), {'finished': True}, HTTP_IDEMPOTENCY_KEY='g')
+
+        self.assertEqual(Reserve.objects.get().code, code)
+
+    def test_clone(self):
+        self.client.force_authenticate(self.admin)
+
+        for _ in range(2):
+            response = self.client.post('/api/events/{0}/clone/'.format(self.event.id), {'date': '2018-12-11T20:00:00-02:00'},
+                                        HTTP_IDEMPOTENCY_KEY='c')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Event.objects.count(), 2)
+
+    @override_settings(IDEMPOTENCY_WAIT=5)
+    def test_concurrent_duplicate(self):
+        fingerprint = hashlib.sha256(json.dumps({'event': [str(self.event.id)], 'seat': [str(self.seats[0].id)]}, sort_keys=True).encode('utf-8')).hexdigest()
+        key = idempotency.make_key(self.alumn.pk, '/api/reservations/add-seat/', 'a')
+        self.assertTrue(idempotency.acquire(key))
+
+        # the duplicate waits for the call holding the key and gets its response
+        timer = threading.Timer(0.2, idempotency.save, (key, fingerprint, 200, b'{"success":"first"}', {'Content-Type': 'application/json'}))
+        timer.start()
+        response = self.add_seat(self.seats[0], 'a')
+        timer.join()
+
+        self.assertEqual(response.content, b'{"success":"first"}')
+        self.assertFalse(ReserveSeat.objects.exists())
+
+        self.assertTrue(idempotency.acquire(idempotency.make_key(self.alumn.pk, '/api/reservations/add-seat/', 'b')))
+        with override_settings(IDEMPOTENCY_WAIT=0.1):
+            response = self.add_seat(self.seats[0], 'b')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class InstrumentationTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        patcher = mock.patch.object(registry, 'worker', None)  # takes a number again from the cleared cache
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.event = create_event()
+
+    @override_settings(METRICS_SERVER_TIMING=True)
+    def test_server_timing(self):
+        response = APIClient().get('/api/events/')
+
+        phases = dict(metric.split(';', 1) for metric in response['Server-Timing'].split(', '))
+        self.assertTrue({'total', 'sql', 'auth', 'permissions', 'serialize', 'render'} <= set(phases))
+        self.assertIn('desc="2 queries"', phases['sql'])
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics(self):
+        APIClient().get('/api/events/{0}/'.format(self.event.id))
+        with timed('smtp'):
+            pass
+
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode('utf-8')
+        worker = registry.worker
+        self.assertIn('tap_requests_total{{route="event-detail",method="GET",status="200",worker="{0}"}}'.format(worker), content)
+        self.assertIn('tap_request_duration_seconds_bucket{{route="event-detail",le="+Inf",worker="{0}"}}'.format(worker), content)
+        self.assertIn('tap_request_phase_seconds_total{{route="event-detail",phase="serialize",worker="{0}"}}'.format(worker), content)
+        self.assertIn('tap_sql_queries_total{{route="event-detail",worker="{0}"}}'.format(worker), content)
+        self.assertIn('tap_external_calls_total{{service="smtp",worker="{0}"}}'.format(worker), content)
+
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    def test_metrics_of_every_worker(self):
+        stats = RequestStats()
+        workers = [Registry() for _ in range(2)]
+        for worker in workers:
+            worker.observe('event-list', 'GET', 200, 0.01, stats)
+            worker.flush(force=True)
+        workers[1].observe('event-list', 'GET', 200, 0.01, stats)
+        workers[1].flush(force=True)
+
+        # one series per worker, the series of a stopped worker stays until its snapshot expires
+        requests = {worker: snapshot['requests'].get(('event-list', 'GET', '200')) for worker, snapshot in collect()}
+        self.assertEqual((requests[workers[0].worker], requests[workers[1].worker]), (1, 2))
+
+        cache.delete(SNAPSHOT_KEY.format(workers[0].worker))
+        self.assertNotIn(workers[0].worker, dict(collect()))
+        self.assertEqual(cache.get(FLOOR_KEY), workers[1].worker)
+
+    def test_profile_slow_requests(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        with override_settings(PROFILE_SAMPLE_RATE=1, PROFILE_SLOW_SECONDS=0, PROFILE_ROOT=directory, PROFILE_MAX_FILES=2):
+            for _ in range(3):
+                APIClient().get('/api/events/')
+
+        profiles = os.listdir(directory)
+        self.assertEqual(len(profiles), 2)
+        self.assertIn('event-list', profiles[0])
+        pstats.Stats(os.path.join(directory, profiles[0]))
+
+
+class ValuesListTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.admin = User.objects.create_superuser(email='admin@tap.com', username='admin', password='tapacademy')
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+        self.event = create_event()
+        Event.objects.create(title='Sem lugares marcados', date=datetime(2018, 12, 11, 9, 30, tzinfo=pytz.utc))
+        seats = [Seat.objects.create(type=seat_type, row=row, column=column) for seat_type, row, column in islice(hall_seats(), 30)]
+
+        alumns = [User.objects.create(email='alumn{0}@tap.com'.format(i), username='alumn{0}'.format(i)) for i in range(10)]
+        for i, alumn in enumerate(alumns):
+            reserve = Reserve.objects.create(alumn=alumn if i % 3 else None, event=self.event if i % 4 else None)
+            for seat in seats[i * 2:i * 2 + i % 3]:
+                ReserveSeat.objects.create(reserve=reserve, seat=seat, event=self.event)
+
+    def test_same_content(self):
+        paths = ['/api/events/', '/api/events/?fields=url,free_seats', '/api/events/?pagination=cursor&ordering=-date&limit=1',
+                 '/api/seats/', '/api/seats/?event={0}&limit=50'.format(self.event.id), '/api/seats/?fields!=is_reserved',
+                 '/api/reservations/', '/api/reservations/?fields=url,seats&limit=4&offset=2',
+                 '/api/reservations/?pagination=cursor&ordering=-updated_at&limit=3', '/api/reservations/?format=json']
+
+        for path in paths:
+            with override_settings(SERIALIZE_FROM_VALUES=False):
+                expected = self.client.get(path)
+            # no model instance is built from the rows
+            with mock.patch.object(Event, 'from_db') as events, mock.patch.object(Seat, 'from_db') as seats, \
+                    mock.patch.object(Reserve, 'from_db') as reserves:
+                response = self.client.get(path)
+
+            self.assertEqual(response.status_code, 200, path)
+            self.assertEqual(response.content, expected.content, path)
+            self.assertFalse(events.called or seats.called or reserves.called, path)
+
+        # the cursor positions read from the rows lead to the same pages
+        next_page = self.client.get('/api/reservations/?pagination=cursor&ordering=-updated_at&limit=3').data['next']
+        with override_settings(SERIALIZE_FROM_VALUES=False):
+            expected = self.client.get(next_page)
+        self.assertEqual(self.client.get(next_page).content, expected.content)
+        self.assertEqual(len(expected.data['results']), 3)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    a second SQLite database stands in for the replica, holding rows the primary does not have
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReplicaRoutingTestCase, cls).setUpClass()
+
+        cls.directory = tempfile.mkdtemp()
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(cls.directory, 'replica.sqlite3')}
+        connections.ensure_defaults('replica')
+        connections.prepare_test_settings('replica')
+        with connections['replica'].schema_editor() as editor:
+            for model in apps.get_app_config('core').get_models():
+                editor.create_model(model)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+        shutil.rmtree(cls.directory)
+
+        super(ReplicaRoutingTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        routers._lags.clear()
+        cache.clear()
+
+        self.event = create_event()
+        Event.objects.using('replica').create(id=self.event.id, title='Cópia da réplica', date=self.event.date, max_seatings=100,
+                                              max_tickets=3, claimed_seats=7)
+        self.seat = Seat.objects.create(type=1, row='A', column=1)
+        self.alumn = User.objects.create_user(email='mario@tap.com', username='mario')
+        routers.reset()  # forget the writes of the fixtures, done outside of a request
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.alumn)
+
+    def tearDown(self):
+        Event.objects.using('replica').all().delete()
+        routers.reset()
+        cache.clear()
+
+    def test_reads_from_replica(self):
+        event = '/api/events/{0}/'.format(self.event.id)
+
+        self.assertEqual(self.client.get(event).data['title'], 'Cópia da réplica')
+        self.assertEqual(self.client.get('/api/events/').data['results'][0]['title'], 'Cópia da réplica')
+        self.assertEqual(self.client.get(event + 'stats/').data['claimed_seats'], 7)
+
+        # the seat map is cached for every client, it is built from the primary
+        self.assertEqual(self.client.get(event + 'seat-map/').data['reserved'], 0)
+
+    def test_read_your_writes(self):
+        response = self.client.post('/api/reservations/add-seat/', {'event': self.event.id, 'seat': self.seat.id})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        self.assertEqual(self.client.get('/api/events/{0}/stats/'.format(self.event.id)).data['claimed_seats'], 1)
+
+        del self.client.cookies[routers.PIN_COOKIE]
+        self.assertEqual(self.client.get('/api/events/{0}/stats/'.format(self.event.id)).data['claimed_seats'], 7)
+
+    def test_router(self):
+        router = routers.ReplicaRouter()
+
+        self.assertEqual(router.db_for_read(Event), 'default')
+
+        routers.set_replica_reads(True)
+        self.assertEqual(router.db_for_read(Event), 'replica')
+
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(Event), 'default')
+
+        with routers.use_primary():
+            self.assertEqual(router.db_for_read(Event), 'default')
+
+        self.assertEqual(router.db_for_write(Event), 'default')
+        self.assertEqual(router.db_for_read(Event), 'default')
+
+    def test_lagging_replica(self):
+        with mock.patch('core.routers.replica_lag', return_value=60.0) as replica_lag:
+            for _ in range(3):
+                self.assertEqual(self.client.get('/api/events/{0}/'.format(self.event.id)).data['title'], self.event.title)
+
+        # the lag is checked once per DATABASE_REPLICA_LAG_CHECK seconds
+        self.assertEqual(replica_lag.call_count, 1)
+
+        routers._lags.clear()
+        with override_settings(DATABASE_REPLICA_MAX_LAG=120), mock.patch('core.routers.replica_lag', return_value=60.0):
+            self.assertEqual(self.client.get('/api/events/{0}/'.format(self.event.id)).data['title'], 'Cópia da réplica')
+
+
+# most queries each route may run, raise a budget only for a reviewed reason
+QUERY_BUDGETS = {
+    'event-clone': 2,
+    'event-create': 1,
+    'event-delete': 4,
+    'event-detail': 1,
+    'event-door-snapshot': 2,
+    'event-list': 2,
+    'event-partial-update': 2,
+    'event-seat-map': 2,
+    'event-seat-stream': 1,
+    'event-send-confirmations': 2,
+    'event-stats': 1,
+    'event-update': 2,
+    'reserve-add-seat': 12,
+    'reserve-add-seats': 12,
+    'reserve-bulk-cancel': 10,
+    'reserve-bulk-finish': 8,
+    'reserve-bulk-paid': 6,
+    'reserve-by-code': 2,
+    'reserve-cancel': 7,
+    'reserve-create': 6,  # the waiting room of the event is read once a minute
+    'reserve-delete': 9,
+    'reserve-detail': 2,
+    'reserve-list-cursor': 2,
+    'reserve-list-fields': 2,
+    'reserve-export': 3,  # a seats query per EXPORT_CHUNK_SIZE reserves, the 3000 reserves take two
+    'reserve-export-csv': 2,
+    'reserve-finish': 7,
+    'reserve-list': 3,
+    'reserve-paid': 6,
+    'reserve-partial-update': 7,
+    'reserve-send-confirmation': 1,
+    'reserve-update': 7,
+    'reserve-view-confirmation': 1,
+    'seat-create': 2,
+    'seat-delete': 3,
+    'seat-detail': 2,
+    'seat-layout': 1,
+    'seat-list': 3,
+    'seat-list-event': 4,  # the seat map of the event is built on the first call
+    'seat-list-fields': 2,
+    'seat-partial-update': 3,
+    'seat-update': 3,
+    'token-create': 1,
+    'token-delete': 2,
+    'token-detail': 1,
+    'token-list': 2,
+    'token-partial-update': 2,
+    'token-update': 2,
+    'token-validate': 1,
+    'token-validate-batch': 4,
+    'user-create': 1,
+    'user-delete': 8,
+    'user-detail': 1,
+    'user-list-cursor': 1,
+    'user-list': 2,
+    'user-partial-update': 2,
+    'user-update': 2,
+}
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    run every route of the API over a large dataset, failing when a route runs more queries than its budget
+
+    Set QUERY_BUDGET_REPORT to a file path to also write the queries, latency percentiles and response
+    size of each route as json.
+    """
+
+    ALUMNS = 3000
+    RESERVES = 600  # per event, the hall has 896 seats
+    PAST_EVENTS = 4  # events with as many reserves, 3000 reserves in all
+    TOKENS = 2000
+    REPEAT = 10
+
+    report = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        # the seeding below bypasses the signals keeping the cached seat maps and layout fresh
+        cache.clear()
+
+        password = make_password('tapacademy')
+        cls.admin = User.objects.create(email='admin@tap.com', username='admin', password=password, first_name='Admin',
+            is_staff=True, is_superuser=True, is_admin=True)
+        User.objects.bulk_create([User(email='alumn{0}@tap.com'.format(i), username='alumn{0}'.format(i), password=password,
+                                       first_name='Alumn', last_name=str(i), phone='11999999999') for i in range(cls.ALUMNS)])
+        cls.alumns = list(User.objects.filter(is_staff=False).order_by('pk'))
+
+        Seat.objects.bulk_create([Seat(type=seat_type, row=row, column=column) for seat_type, row, column in hall_seats()])
+        cls.seats = list(Seat.objects.order_by('pk'))
+
+        validity = date.today() + timedelta(days=15)
+        Token.objects.bulk_create([Token(hashcode='{0:010d}'.format(i), validity=validity) for i in range(cls.TOKENS)])
+        cls.token = Token.objects.order_by('pk').first()
+
+        cls.event, cls.other_event = [create_event() for _ in range(2)]
+
+        for index, event in enumerate([cls.event] + [create_event() for _ in range(cls.PAST_EVENTS)]):
+            Reserve.objects.bulk_create([Reserve(alumn=alumn, event=event, finished=i % 2 == 0, is_paid=i % 4 == 0,
+                                                 code='CODE{0}{1:05d}'.format(index, i) if i % 2 == 0 else None)
+                                         for i, alumn in enumerate(cls.alumns[:cls.RESERVES])])
+            ReserveSeat.objects.bulk_create([ReserveSeat(reserve=reserve, seat=seat, event=event)
+                                             for reserve, seat in zip(Reserve.objects.filter(event=event).order_by('pk'), cls.seats)])
+        cls.reserves = list(Reserve.objects.filter(event=cls.event).order_by('pk'))
+
+    @classmethod
+    def tearDownClass(cls):
+        super(QueryBudgetTestCase, cls).tearDownClass()
+        cache.clear()
+
+        path = os.environ.get('QUERY_BUDGET_REPORT')
+        if path:
+            with open(path, 'w') as report:
+                json.dump(cls.report, report, indent=2, sort_keys=True)
+
+    def setUp(self):
+        # every route is measured from a cold cache, the cached reads are not counted otherwise
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.client = APIClient()
+        self.free_alumns = iter(self.alumns[self.RESERVES:])
+        self.free_seats = iter(self.seats[self.RESERVES:])
+
+        mail_queue = mock.patch('core.controllers.get_mail_queue')
+        mail_queue.start()
+        self.addCleanup(mail_queue.stop)
+
+        renderer = mock.patch('core.controllers.get_renderer')
+        renderer.start().return_value.get_or_submit.return_value = b'%PDF-1.4'
+        self.addCleanup(renderer.stop)
+
+    def assertBudget(self, name, method, path, data=None, user=None, repeat=REPEAT, stream=False):
+        """
+        call a route ``repeat`` times, ``path``, ``data`` and ``user`` may be functions of the call number
+
+        Streamed responses are read within the budget when ``stream`` is set.
+        """
+
+        queries, executed, latencies, size, statuses = 0, [], [], 0, set()
+
+        for i in range(repeat):
+            call_user = user(i) if callable(user) else (user or self.admin)
+            self.client.force_authenticate(call_user)
+
+            with CaptureQueriesContext(connection) as captured:
+                started = time.time()
+                response = getattr(self.client, method)(path(i) if callable(path) else path,
+                    data(i) if callable(data) else data, format='json')
+                if stream:
+                    size = len(b''.join(response.streaming_content))
+                latencies.append(time.time() - started)
+
+            self.assertLess(response.status_code, 400, '{0}: {1}'.format(name, getattr(response, 'data', None)))
+            statuses.add(response.status_code)
+            if not response.streaming:
+                size = len(response.content)
+
+            if len(captured) > queries:
+                queries, executed = len(captured), [query['sql'] for query in captured.captured_queries]
+
+        latencies.sort()
+        self.report[name] = {'queries': queries, 'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+                             'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2), 'bytes': size,
+                             'status': sorted(statuses)}
+
+        self.assertIn(name, QUERY_BUDGETS, '{0} has no query budget, it runs {1} queries'.format(name, queries))
+        self.assertLessEqual(queries, QUERY_BUDGETS[name], '{0} runs {1} queries, over its budget of {2}:\n{3}'.format(
+            name, queries, QUERY_BUDGETS[name], '\n'.join(executed)))
+
+    def test_user_routes(self):
+        user = self.alumns[-1]
+
+        self.assertBudget('user-list', 'get', '/api/users/')
+        self.assertBudget('user-list-cursor', 'get', '/api/users/?pagination=cursor')
+        self.assertBudget('user-detail', 'get', '/api/users/{0}/'.format(user.pk))
+        self.assertBudget('user-create', 'post', '/api/users/', repeat=1, data={
+            'first_name': 'Peach', 'last_name': 'Toadstool', 'email': 'peach@tap.com', 'phone': '11999999999',
+            'is_admin': False, 'is_active': True, 'last_login': '2018-12-10T20:00:00-02:00'})
+        self.assertBudget('user-update', 'put', '/api/users/{0}/'.format(user.pk), data={
+            'first_name': 'Yoshi', 'last_name': 'Dino', 'email': user.email, 'phone': '11999999999',
+            'is_admin': False, 'is_active': True, 'last_login': '2018-12-10T20:00:00-02:00'})
+        self.assertBudget('user-partial-update', 'patch', '/api/users/{0}/'.format(user.pk), data={'first_name': 'Yoshi'})
+        self.assertBudget('user-delete', 'delete', lambda i: '/api/users/{0}/'.format(self.alumns[-2 - i].pk))
+
+    def test_token_routes(self):
+        token = '/api/tokens/{0}/'.format(self.token.pk)
+
+        self.assertBudget('token-list', 'get', '/api/tokens/')
+        self.assertBudget('token-detail', 'get', token)
+        self.assertBudget('token-create', 'post', '/api/tokens/', data=lambda i: {
+            'hashcode': 'NEW{0:07d}'.format(i), 'validity': '2018-12-10', 'validate_in': '2018-12-10'})
+        self.assertBudget('token-update', 'put', token, data={
+            'hashcode': self.token.hashcode, 'validity': '2018-12-10', 'validate_in': '2018-12-10'})
+        self.assertBudget('token-partial-update', 'patch', token, data={'validity': '2018-12-11'})
+        self.assertBudget('token-delete', 'delete', lambda i: '/api/tokens/{0}/'.format(self.token.pk + 1 + i))
+        self.assertBudget('token-validate', 'post', '/api/tokens/validate/', data=lambda i: {'hashcode': '{0:010d}'.format(100 + i)})
+        self.assertBudget('token-validate-batch', 'post', '/api/tokens/validate-batch/', data=lambda i: {
+            'hashcodes': ['{0:010d}'.format(code) for code in range(200 + i * 100, 300 + i * 100)]})
+
+    def test_event_routes(self):
+        event = '/api/events/{0}/'.format(self.event.pk)
+        data = {'title': 'Yoshi sapateando.', 'date': '2018-12-10T20:00:00-02:00', 'max_seatings': 100, 'max_tickets': 3}
+
+        self.assertBudget('event-list', 'get', '/api/events/')
+        self.assertBudget('event-detail', 'get', event)
+        self.assertBudget('event-create', 'post', '/api/events/', data=data)
+        self.assertBudget('event-update', 'put', event, data=data)
+        self.assertBudget('event-partial-update', 'patch', event, data={'max_tickets': 3})
+        self.assertBudget('event-clone', 'post', event + 'clone/', data={'date': '2018-12-11T20:00:00-02:00'})
+        self.assertBudget('event-stats', 'get', event + 'stats/')
+        self.assertBudget('event-seat-map', 'get', event + 'seat-map/')
+        # the reads of the broker thread run out of the request, and out of the test transaction
+        with override_settings(SEAT_STREAM_BROKER='core.streams.DatabaseBroker'), mock.patch.object(DatabaseBroker, 'listen'):
+            self.assertBudget('event-seat-stream', 'get', event + 'seat-stream/')
+        self.assertBudget('event-door-snapshot', 'get', event + 'door-snapshot/')
+        self.assertBudget('event-send-confirmations', 'post', event + 'send-confirmations/')
+        self.assertBudget('event-delete', 'delete', '/api/events/{0}/'.format(self.other_event.pk), repeat=1)
+
+    def test_seat_routes(self):
+        seat = '/api/seats/{0}/'.format(self.seats[-1].pk)
+        data = {'row': 'Z', 'column': 1, 'type': 1, 'slug': 'Palco Z1', 'is_reserved': False}
+
+        self.assertBudget('seat-list', 'get', '/api/seats/')
+        self.assertBudget('seat-list-fields', 'get', '/api/seats/?fields=url,slug')
+        self.assertBudget('seat-list-event', 'get', '/api/seats/?event={0}'.format(self.event.pk))
+        self.assertBudget('seat-detail', 'get', seat)
+        self.assertBudget('seat-layout', 'get', '/api/seats/layout/')
+        self.assertBudget('seat-create', 'post', '/api/seats/', data=data)
+        self.assertBudget('seat-update', 'put', seat, data=data)
+        self.assertBudget('seat-partial-update', 'patch', seat, data={'row': 'Y'})
+        self.assertBudget('seat-delete', 'delete', lambda i: '/api/seats/{0}/'.format(self.seats[-2 - i].pk))
+
+    def test_reserve_routes(self):
+        reserve = '/api/reservations/{0}/'.format(self.reserves[0].pk)
+        unfinished = [reserve for reserve in self.reserves if not reserve.finished]
+
+        self.assertBudget('reserve-list', 'get', '/api/reservations/')
+        self.assertBudget('reserve-list-cursor', 'get', '/api/reservations/?pagination=cursor&ordering=-updated_at')
+        self.assertBudget('reserve-list-fields', 'get', '/api/reservations/?fields=url,event')
+        self.assertBudget('reserve-detail', 'get', reserve)
+        self.assertBudget('reserve-create', 'post', '/api/reservations/', data=lambda i: {
+            'alumn': 'http://testserver/api/users/{0}/'.format(next(self.free_alumns).pk),
+            'event': 'http://testserver/api/events/{0}/'.format(self.other_event.pk)})
+        self.assertBudget('reserve-update', 'put', reserve, data={})
+        self.assertBudget('reserve-partial-update', 'patch', reserve, data={})
+        self.assertBudget('reserve-add-seat', 'post', '/api/reservations/add-seat/', user=lambda i: next(self.free_alumns),
+            data=lambda i: {'event': self.event.pk, 'seat': next(self.free_seats).pk})
+        self.assertBudget('reserve-add-seats', 'post', '/api/reservations/add-seats/', user=lambda i: next(self.free_alumns),
+            data=lambda i: {'event': self.event.pk, 'seats': [next(self.free_seats).pk, next(self.free_seats).pk]})
+        self.assertBudget('reserve-finish', 'post', lambda i: '/api/reservations/{0}/finish/'.format(unfinished[i].pk),
+            data={'finished': True})
+        self.assertBudget('reserve-paid', 'post', lambda i: '/api/reservations/{0}/paid/'.format(self.reserves[i].pk),
+            data={'paid': True})
+        self.assertBudget('reserve-by-code', 'get', lambda i: '/api/reservations/by-code/{0}/'.format(self.reserves[2 * i].code.lower()))
+        self.assertBudget('reserve-export', 'get', '/api/reservations/export/', stream=True)
+        self.assertBudget('reserve-export-csv', 'get', '/api/reservations/export/?output=csv&paid=true', stream=True)
+        self.assertBudget('reserve-bulk-paid', 'post', '/api/reservations/bulk-paid/', data=lambda i: {
+            'ids': [reserve.pk for reserve in self.reserves[100 + i * 20:120 + i * 20]]})
+        self.assertBudget('reserve-bulk-finish', 'post', '/api/reservations/bulk-finish/', data=lambda i: {
+            'ids': [reserve.pk for reserve in self.reserves[100 + i * 20:120 + i * 20]]})
+        self.assertBudget('reserve-bulk-cancel', 'post', '/api/reservations/bulk-cancel/', data=lambda i: {
+            'codes': [reserve.code for reserve in self.reserves[300 + i * 20:320 + i * 20] if reserve.code]})
+        self.assertBudget('reserve-view-confirmation', 'get', reserve + 'view-confirmation/')
+        # another reserve, the context read by view-confirmation stays in the cache
+        self.assertBudget('reserve-send-confirmation', 'get', '/api/reservations/{0}/send-confirmation/'.format(self.reserves[2].pk))
+        self.assertBudget('reserve-cancel', 'post', lambda i: '/api/reservations/{0}/cancel/'.format(self.reserves[-1 - i].pk),
+            data={'cancel': True})
+        self.assertBudget('reserve-delete', 'delete', lambda i: '/api/reservations/{0}/'.format(self.reserves[-20 - i].pk))
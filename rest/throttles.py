@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from django.core.cache import cache
+from rest_framework import exceptions
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+logger = logging.getLogger(__name__)
+
+REJECTED_KEY = 'throttle:rejected:{0}'
+
+
+class Throttled(exceptions.Throttled):
+    default_detail = 'Muitas requisições seguidas.'
+    extra_detail_singular = 'Tente novamente em {wait} segundo.'
+    extra_detail_plural = 'Tente novamente em {wait} segundos.'
+
+
+def get_stats():
+    """
+    rate of each scope of DEFAULT_THROTTLE_RATES and the calls it refused so far, counted by every worker in the shared cache
+    """
+
+    rates = api_settings.DEFAULT_THROTTLE_RATES
+    counts = cache.get_many([REJECTED_KEY.format(scope) for scope in rates])
+    return {scope: {'rate': rate, 'rejected': counts.get(REJECTED_KEY.format(scope), 0)} for scope, rate in rates.items()}
+
+
+def get_event(request, view):
+    get_event_id = getattr(view, 'get_admission_event', None)
+    event_id = get_event_id(request) if get_event_id is not None else None
+
+    try:
+        return int(event_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class SlidingWindowThrottle(SimpleRateThrottle):
+    """Limit the calls of the scopes named on ``throttle_scopes`` of the view, by action
+
+    Counts the calls of the current and of the previous window with atomic cache
+    increments and weighs the previous window by the part of it still inside the
+    sliding window. The counts are shared by the workers only through a shared cache
+    (memcached, see CACHES), the per process default limits each worker on its own.
+    With ``count_refused`` refused calls count too, a client retrying in a loop stays
+    refused until it slows down.
+    """
+
+    scope_suffix = ''
+    count_refused = True
+
+    def __init__(self):
+        # the scope depends on the action, known in allow_request
+        pass
+
+    def get_scope(self, view):
+        scope = getattr(view, 'throttle_scopes', {}).get(getattr(view, 'action', None))
+        return scope + self.scope_suffix if scope else None
+
+    def allow_request(self, request, view):
+        self.scope = self.get_scope(view)
+        if self.scope is None:
+            return True
+
+        # read on each call, the rates of a scope without a limit are left out
+        self.rate = api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+        if self.rate is None:
+            return True
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        now = self.timer()
+        window, elapsed = divmod(now / self.duration, 1)
+        current_key = '{0}:{1}'.format(self.key, int(window))
+
+        cache.add(current_key, 0, self.duration * 2)
+        try:
+            current = cache.incr(current_key)
+        except ValueError:
+            current = 1  # evicted between add and incr
+        previous = cache.get('{0}:{1}'.format(self.key, int(window) - 1), 0)
+
+        if previous * (1 - elapsed) + current <= self.num_requests:
+            return True
+
+        if not self.count_refused:
+            try:
+                current = cache.decr(current_key)
+            except ValueError:
+                current = 0
+
+        self.wait_seconds = self.get_wait(previous, current, elapsed) * self.duration
+
+        return self.throttle_failure()
+
+    def get_wait(self, previous, current, elapsed):
+        """
+        windows until a retry is let through, counting the retry itself and, when refused calls count, the call refused
+        """
+
+        if previous and current + 1 <= self.num_requests:
+            # the previous window weighs less as it slides out
+            position = 1 - (self.num_requests - current - 1) / previous
+            if position < 1:
+                return position - elapsed
+
+        # in the next window the current one is the previous
+        return 1 - elapsed + (max(1 - (self.num_requests - 1) / current, 0) if current else 0)
+
+    def throttle_failure(self):
+        key = REJECTED_KEY.format(self.scope)
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            pass
+        logger.info('throttled %s', self.key)
+
+        return False
+
+    def wait(self):
+        return max(self.wait_seconds, 0)
+
+
+class UserActionThrottle(SlidingWindowThrottle):
+    """
+    calls of each user, per action and event
+    """
+
+    def get_cache_key(self, request, view):
+        ident = request.user.pk if request.user and request.user.is_authenticated else self.get_ident(request)
+        return 'throttle:{0}:{1}:{2}'.format(self.scope, ident, get_event(request, view) or '-')
+
+
+class EventActionThrottle(SlidingWindowThrottle):
+    """
+    calls of every user together, per action and event, caps the load one event puts on the claims
+
+    Refused calls do not count, a spike of calls keeps the claims going at the rate of the scope.
+    """
+
+    scope_suffix = '-event'
+    count_refused = False
+
+    def get_cache_key(self, request, view):
+        event_id = get_event(request, view)
+        return 'throttle:{0}:{1}'.format(self.scope, event_id) if event_id else None
+
@@ -1,69 +1,154 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import hashlib
 import locale
-from datetime import datetime
 
 import pytz
-from django.utils import timezone
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
 from rest_framework import permissions as rf_permissions
 from rest_framework import status, viewsets
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
-from core.controllers import render, render_to_pdf, send_mail
+from core import admission, bulk
+from core.claims import SeatTaken, TicketLimitReached, claim_seats
+from core.codes import save_with_code
+from core.controllers import confirmation_contexts, get_confirmation_context, render, render_to_pdf, send_bulk_mail, send_mail
+from core.door import MAX_VERSION, build_snapshot
+from core.exports import reserve_rows, to_csv, to_ndjson
+from core.layout import get_layout
 from core.models import Event, Reserve, Seat, Token, User
+from core.seatmap import ReservedSeats, get_seat_map
+from core.signals import reserves_finished, seats_paid
+from core.streams import event_stream, get_broker
+from core.tokens import EXPIRED, NOT_FOUND, USED, VALID, redeem, redeem_many
+from rest.mixins import (AdmissionMixin, IdempotencyMixin, InstrumentedMixin, ReplicaReadsMixin, SparseFieldsMixin,
+                         ValuesListMixin)
+from rest.renderers import EventStreamRenderer
 from rest.serializers import (EventSerializer, ReserveSerializer,
                               SeatSerializer, TokenSerializer, UserSerializer)
+from rest.throttles import EventActionThrottle, Throttled, UserActionThrottle, get_stats
 
 TZ = pytz.timezone('America/Sao_Paulo')
 locale.setlocale(locale.LC_TIME, 'pt_BR.utf8')
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(InstrumentedMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     """
     API view set to handle users.
 
     Examples:
 
-        GET /api/users/ - show all users
+        GET /api/users/                    - show all users
+        GET /api/users/?pagination=cursor  - show all users by pages of constant cost, following the next link
+        GET /api/users/?fields=url,email   - show only some fields, on every list
     """
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = (rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser)
+    cursor_ordering_fields = ('id', )
 
 
-class TokenViewSet(viewsets.ModelViewSet):
+class TokenViewSet(InstrumentedMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     """
     API view set to handle tokens.
 
     Examples:
 
-        GET /api/tokens/ - show all tokens
+        GET  /api/tokens/                    - show all tokens
+        GET  /api/tokens/?pagination=cursor  - show all tokens by pages of constant cost, following the next link
+        GET  /api/tokens/?fields=hashcode    - show only some fields, on every list
+
+    Extra actions:
+
+        POST /api/tokens/validate            - validate a token at the door, marking it as used
+        POST /api/tokens/validate-batch      - validate a list of tokens at once, with the status of each one
     """
     queryset = Token.objects.all()
     serializer_class = TokenSerializer
     permission_classes = (rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser)
+    cursor_ordering_fields = ('id', )
+
+    @list_route(methods=['post'], url_path='validate')
+    def validate(self, request):
+        """
+        validate a token and mark it as used, a token is valid once
+        """
+
+        hashcode = request.data.get('hashcode')
+
+        if not hashcode:
+            raise ValidationError('Parâmetro \'hashcode\' não informado.')
+
+        result = redeem(str(hashcode), request.user)
+
+        if result['status'] == NOT_FOUND:
+            raise NotFound('Token não encontrado.')
+        if result['status'] == USED:
+            return Response(data=dict(result, error='Token já utilizado.'), status=status.HTTP_409_CONFLICT)
+        if result['status'] == EXPIRED:
+            return Response(data=dict(result, error='Token expirado.'), status=status.HTTP_409_CONFLICT)
+
+        return Response(data=dict(result, success='Token validado.'), status=status.HTTP_200_OK)
 
+    @list_route(methods=['post'], url_path='validate-batch')
+    def validate_batch(self, request):
+        """
+        validate a list of tokens, each one gets its own status: valid, expired, used or not_found
+        """
+
+        if hasattr(request.data, 'getlist'):
+            hashcodes = request.data.getlist('hashcodes')
+        else:
+            hashcodes = request.data.get('hashcodes') or []
+
+        if not isinstance(hashcodes, list) or not hashcodes:
+            raise ValidationError('Parâmetro \'hashcodes\' não informado.')
+
+        if len(hashcodes) > settings.TOKEN_VALIDATE_MAX_BATCH:
+            raise ValidationError('Envie no máximo {0} tokens por vez.'.format(settings.TOKEN_VALIDATE_MAX_BATCH))
+
+        results = redeem_many([str(hashcode) for hashcode in hashcodes], request.user)
 
-class EventViewSet(viewsets.ModelViewSet):
+        return Response(data={'valid': sum(1 for result in results if result['status'] == VALID), 'results': results},
+                        status=status.HTTP_200_OK)
+
+
+class EventViewSet(InstrumentedMixin, IdempotencyMixin, ReplicaReadsMixin, ValuesListMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     """
     API view set to handle events.
 
     Examples:
 
-        GET  /api/events/         - show all events
+        GET  /api/events/                      - show all events
+        GET  /api/events/?pagination=cursor    - show all events by pages of constant cost, ?ordering=-date for the latest first
 
     Extra actions:
 
-        POST /api/events/id/clone - clone an event for other date
+        POST /api/events/id/clone              - clone an event for other date, once per Idempotency-Key header
+        POST /api/events/id/send-confirmations - send the confirmation of every paid reserve of an event
+        GET  /api/events/id/seat-map           - show the reserved seats bitmap of an event
+        GET  /api/events/id/stats              - show the claimed and free seats and the finished and paid reserves of an event
+        GET  /api/events/id/seat-stream        - stream the seats claimed, released and paid for an event (server-sent events)
+        GET  /api/events/id/door-snapshot      - download the signed paid codes of an event to check at the door, ?since=version for changes only
+        POST /api/events/id/queue              - join the waiting room of an event, gives the queue token to claim seats with
+        GET  /api/events/id/queue-position     - show the place of ?token= in the waiting room, served from the cache only
+        POST /api/events/id/admission          - open (rate > 0), change or close (rate 0) the waiting room, users let through per second
     """
 
 
     queryset = Event.objects.all()
     serializer_class = EventSerializer
     permission_classes = (rf_permissions.IsAuthenticatedOrReadOnly, )
+    cursor_ordering_fields = ('id', 'date')
+    field_columns = {'free_seats': ('max_seatings', 'claimed_seats')}
+    replica_actions = ('list', 'retrieve', 'stats')
+    idempotent_actions = ('clone',)
 
     @detail_route(methods=['post', 'get'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='clone')
     def clone(self, request, pk):
@@ -90,95 +175,317 @@ class EventViewSet(viewsets.ModelViewSet):
 
         return Response(data={'success': 'Evento clonado com sucesso.'}, status=status.HTTP_201_CREATED)
 
+    @detail_route(methods=['post'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='send-confirmations')
+    def send_confirmations(self, request, pk):
+        """
+        queue the confirmation mails of every paid reserve of the event as a single job
+        """
+
+        if not Event.objects.filter(pk=pk).exists():
+            raise NotFound('Evento não encontrado ou não existe.')
+
+        reserves = list(Reserve.objects.filter(event_id=pk, is_paid=True).values_list('pk', flat=True))
+
+        send_bulk_mail(template_src='emails/booking-confirmation.html', mail_from='no-reply@gmail.com',
+            contexts=confirmation_contexts(reserves))
+
+        return Response(data={'success': 'Envio de {0} confirmações de reserva iniciado.'.format(len(reserves))},
+                        status=status.HTTP_202_ACCEPTED)
+
+    @detail_route(methods=['get'], url_path='stats')
+    def stats(self, request, pk):
+        """
+        show the seat and reserve counters of the event
+        """
+
+        try:
+            event = Event.objects.only('id', 'max_seatings', 'claimed_seats', 'finished_reserves', 'paid_reserves').get(pk=pk)
+        except Event.DoesNotExist:
+            raise NotFound('Evento não encontrado ou não existe.')
+
+        return Response(data={'event': event.id, 'max_seatings': event.max_seatings, 'claimed_seats': event.claimed_seats,
+                              'free_seats': event.free_seats, 'finished_reserves': event.finished_reserves,
+                              'paid_reserves': event.paid_reserves},
+                        status=status.HTTP_200_OK)
+
+    @detail_route(methods=['get'], url_path='seat-map')
+    def seat_map(self, request, pk):
+        """
+        show which seats are reserved for the event, bit (seat id - offset) of the bitmap is set for reserved seats
+        """
+
+        seat_map = get_seat_map(pk)
+
+        if seat_map is None:
+            raise NotFound('Evento não encontrado ou não existe.')
+
+        return Response(data=seat_map.to_dict(), status=status.HTTP_200_OK)
+
+    @detail_route(methods=['get'], renderer_classes=[EventStreamRenderer, JSONRenderer], url_path='seat-stream')
+    def seat_stream(self, request, pk):
+        """
+        stream the seat changes of the event, new clients get the seat map first and reconnecting clients the changes they missed
+        """
+
+        try:
+            last_id = int(request.META['HTTP_LAST_EVENT_ID'])
+        except (KeyError, ValueError):
+            last_id = None
+
+        try:
+            event_id = int(pk)
+        except ValueError:
+            raise NotFound('Evento não encontrado ou não existe.')
+
+        # subscribed before the seat map is read, a delta published in between is sent after the snapshot
+        subscription = get_broker().subscribe(event_id, last_id)
+
+        seat_map = get_seat_map(event_id)
+        if seat_map is None:
+            subscription.close()
+            raise NotFound('Evento não encontrado ou não existe.')
+
+        snapshot = seat_map.to_dict() if last_id is None else None
+
+        response = StreamingHttpResponse(event_stream(subscription, snapshot), content_type=EventStreamRenderer.media_type)
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+
+        return response
+
+
+    @detail_route(methods=['get'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='door-snapshot')
+    def door_snapshot(self, request, pk):
+        """
+        gzip json with the paid reserve codes of the event and their seats, signed on X-Snapshot-Signature
+        """
+
+        since = request.query_params.get('since')
+        try:
+            since = int(since) if since else None
+            if since is not None and not 0 <= since < MAX_VERSION:
+                raise ValueError(since)
+        except ValueError:
+            raise ValidationError('Parâmetro \'since\' inválido.')
+
+        if not Event.objects.filter(pk=pk).exists():
+            raise NotFound('Evento não encontrado ou não existe.')
+
+        snapshot = build_snapshot(pk, since=since)
+
+        response = HttpResponse(snapshot.content, content_type='application/gzip')
+        response['X-Snapshot-Version'] = snapshot.version
+        response['X-Snapshot-Signature'] = snapshot.signature
+        response['Cache-Control'] = 'no-store'
+
+        return response
+
+
+    @detail_route(methods=['post'], permission_classes=[rf_permissions.IsAuthenticated], url_path='queue')
+    def queue(self, request, pk):
+        """
+        give the user a place in the waiting room of the event and its queue token
+        """
+
+        ticket = admission.join(int(pk), request.user.id)
+
+        return Response(data=ticket.to_dict(), status=status.HTTP_201_CREATED)
+
+    @detail_route(methods=['get'], authentication_classes=[], permission_classes=[rf_permissions.AllowAny], url_path='queue-position')
+    def queue_position(self, request, pk):
+        """
+        show the place of a queue token in the waiting room, polled by waiting users so it reads the cache only
+        """
+
+        try:
+            ticket = admission.check(request.query_params.get('token', ''), pk)
+        except admission.InvalidTicket:
+            raise ValidationError('Ficha da fila inválida ou expirada.')
+
+        response = Response(data=ticket.to_dict(), status=status.HTTP_200_OK)
+        response['Cache-Control'] = 'no-store'
+
+        return response
+
+    @detail_route(methods=['post', 'get'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='admission')
+    def set_admission(self, request, pk):
+        """
+        set the users let through per second by the waiting room of the event, 0 to close it
+        """
+
+        if not Event.objects.filter(pk=pk).exists():
+            raise NotFound('Evento não encontrado ou não existe.')
+
+        if request.method == 'POST':
+            try:
+                rate = float(request.data.get('rate'))
+            except (TypeError, ValueError):
+                rate = -1
+            if rate < 0:
+                raise ValidationError('Taxa de entrada inválida.')
+            admission.set_rate(int(pk), rate)
+
+        return Response(data=admission.get_status(int(pk)), status=status.HTTP_200_OK)
 
-class SeatViewSet(viewsets.ModelViewSet):
+
+class SeatViewSet(InstrumentedMixin, ReplicaReadsMixin, ValuesListMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     """
     API view set to handle seats.
 
     Examples:
 
-        GET /api/seats/ - show all seats
+        GET /api/seats/          - show all seats
+        GET /api/seats/?event=id - show all seats, flagging the ones reserved for the event
+
+    Extra actions:
+
+        GET /api/seats/layout    - show the whole hall grouped by section and row
     """
     queryset = Seat.objects.all()
     serializer_class = SeatSerializer
     permission_classes = (rf_permissions.IsAuthenticatedOrReadOnly, )
+    field_columns = {'slug': ('type', 'row', 'column'), 'is_reserved': ()}
+
+    def get_serializer_context(self):
+        context = super(SeatViewSet, self).get_serializer_context()
+
+        fields = self.get_requested_fields()
+        if fields is not None and 'is_reserved' not in fields:
+            return context
+
+        event_id = self.request.query_params.get('event')
+        if event_id:
+            seat_map = get_seat_map(event_id)
+            if seat_map is None:
+                raise NotFound('Evento não encontrado ou não existe.')
+            context['reserved_seats'] = seat_map
+        elif self.action == 'list':
+            # reserved for any event, read for the seats of the page only
+            self.reserved_seats = context['reserved_seats'] = ReservedSeats(self.page_seat_ids)
+
+        return context
+
+    reserved_seats = None
+    page_seat_ids = None
+
+    def paginate_queryset(self, queryset):
+        page = super(SeatViewSet, self).paginate_queryset(queryset)
+        if page is not None:
+            self.page_seat_ids = [seat['id'] if isinstance(seat, dict) else seat.id for seat in page]
+            if self.reserved_seats is not None:
+                self.reserved_seats.seat_ids = self.page_seat_ids
+        return page
+
+    @list_route(methods=['get'], url_path='layout')
+    def layout(self, request):
+        """
+        show the seats of the hall grouped by section and row, each seat as [id, column]
+        """
+
+        layout = get_layout()
+
+        # weak comparison, a compressing proxy may mark the etag weak
+        etags = [etag[2:] if etag.startswith('W/') else etag for etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+        if '*' in etags or layout.etag in etags:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(layout.content, content_type='application/json; charset=utf-8')
 
+        response['ETag'] = layout.etag
+        patch_cache_control(response, public=True, max_age=settings.SEAT_LAYOUT_MAX_AGE)
 
-class ReserveViewSet(viewsets.ModelViewSet):
+        return response
+
+
+class ReserveViewSet(InstrumentedMixin, IdempotencyMixin, AdmissionMixin, ValuesListMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     """
     API view set to handle reservations.
 
     Examples:
 
         GET  /api/reservations/                       - show all reservations
+        GET  /api/reservations/?pagination=cursor     - show all reservations by pages of constant cost, ?ordering=-updated_at for the latest first
 
     Extra actions:
 
-        POST /api/reservations/add-seat               - add seats to reserve
+        POST /api/reservations/add-seat               - add seats to reserve, X-Queue-Token header when the event has a waiting room
+        POST /api/reservations/add-seats              - add a list of seats to reserve, all or none, X-Queue-Token header as add-seat
         POST /api/reservations/id/cancel              - cancel a reserve
         POST /api/reservations/id/finish              - finish a reserve
         POST /api/reservations/id/paid                - confirm a reserve was paid
         POST /api/reservations/id/send-confirmation   - send a reserve confirmation
         GET  /api/reservations/id/view-confirmation   - view a reserve confirmation
+        GET  /api/reservations/by-code/code           - show the reserve of a code
+        GET  /api/reservations/export                 - stream every reserve as ndjson, ?output=csv for csv, ?event=id&paid=true to filter
+        POST /api/reservations/bulk-paid              - confirm a list of reserves were paid, by ids or codes
+        POST /api/reservations/bulk-finish            - finish a list of reserves, by ids or codes
+        POST /api/reservations/bulk-cancel            - cancel a list of reserves, by ids or codes
+        GET  /api/reservations/throttles              - show the rate limits of the reservation actions and the calls they refused
+
+    Claims, finish and send-confirmation are rate limited per user and event, claims also per event,
+    see DEFAULT_THROTTLE_RATES. Refused calls get 429 with Retry-After.
+
+    POST actions sent with an Idempotency-Key header run once, retries with the same key get the
+    first response back (Idempotent-Replayed: true).
     """
-    queryset = Reserve.objects.all()
+    queryset = Reserve.objects.prefetch_related('seats')
     serializer_class = ReserveSerializer
     permission_classes = (rf_permissions.IsAuthenticatedOrReadOnly, )
+    cursor_ordering_fields = ('id', 'updated_at')
+    admission_actions = ('create', 'add_seat', 'add_seats')
+    throttle_classes = (UserActionThrottle, EventActionThrottle)
+    throttle_scopes = {'create': 'claim', 'add_seat': 'claim', 'add_seats': 'claim', 'finish': 'finish',
+                       'send_confirmation_mail': 'confirmation'}
+
+    def throttled(self, request, wait):
+        raise Throttled(wait)
 
     @staticmethod
-    def check_available_tickets(reserve, max_tickets):
+    def get_bulk_reserves(data):
         """
-        check if has available tickets for this alumn
+        field and values of the reserves of a bulk action, given as a list of ids or of codes
         """
 
-        tickets = reserve.seats.count()
-        check = tickets < max_tickets
+        ids, codes = data.get('ids'), data.get('codes')
 
-        if check:
-            available = max_tickets - tickets
-            return check, available
+        if bool(ids) == bool(codes):
+            raise ValidationError('Informe a lista \'ids\' ou a lista \'codes\' das reservas.')
 
-        return check, 0
+        values = ids or codes
+        if not isinstance(values, list):
+            raise ValidationError('As reservas devem ser informadas em uma lista.')
 
-    @staticmethod
-    def is_session_valid(reserve):
-        limit = reserve.updated_at.minute + (int(reserve.session.total_seconds() / 60) % 60)
-        now = timezone.localtime(timezone.now(), timezone=TZ).minute
+        if len(values) > settings.RESERVE_BULK_MAX_BATCH:
+            raise ValidationError('Informe no máximo {0} reservas por vez.'.format(settings.RESERVE_BULK_MAX_BATCH))
 
-        # if limit is not greater than now, the reserve should be deleted and seats released
-        if limit < now:
-            reserve.delete()
-            raise ValidationError('Sua sessão expirou e sua reserva não foi finalizada. Escolha novos assentos para continuar.')
+        if codes:
+            return 'code', [str(code).upper() for code in codes]
 
-        # if limit is greater than now the session is available
-        return True
+        try:
+            return 'id', [int(pk) for pk in ids]
+        except (TypeError, ValueError):
+            raise ValidationError('Lista \'ids\' inválida.')
 
     @staticmethod
-    def create_hash():
-        code = hashlib.sha1()
-        code.update(str(datetime.now()))
-        return code.hexdigest()[:10].upper()
+    def bulk_response(results):
+        summary = {}
+        for result in results:
+            summary[result['status']] = summary.get(result['status'], 0) + 1
 
-    @staticmethod
-    def get_confirmation_context(pk):
-        try:
-            reserve = Reserve.objects.get(pk=pk)
-        except Reserve.DoesNotExist:
-            raise NotFound('Reserva não encontrada')
+        return Response(data={'summary': summary, 'results': results}, status=status.HTTP_200_OK)
+
+    def perform_destroy(self, instance):
+        # releasing keeps the seat map, the seat stream and the counters of the event current
+        Reserve.objects.filter(pk=instance.pk).release()
 
-        seats = []
-        for seat in reserve.seats.all():
-            seats.append(seat.slug)
+    @staticmethod
+    def is_session_valid(reserve):
+        # expired reserves and their seats are released by the release_expired_reserves command
+        if reserve.is_expired:
+            raise ValidationError('Sua sessão expirou e sua reserva não foi finalizada. Escolha novos assentos para continuar.')
 
-        return {
-            'alumn_name': reserve.alumn.get_full_name,
-            'alumn_email': reserve.alumn.email,
-            'event_title': reserve.event.title,
-            'event_date': reserve.event.slug_date,
-            'event_hour': reserve.event.slug_hour,
-            'seats': seats,
-            'code': reserve.code
-        }
+        # the session is still available
+        return True
 
     @list_route(methods=['post', 'get'], permission_classes=[rf_permissions.IsAuthenticated], url_path='add-seat')
     def add_seat(self, request):
@@ -192,38 +499,103 @@ class ReserveViewSet(viewsets.ModelViewSet):
 
         seat_id = request.data.get('seat')
         event_id = request.data.get('event')
-        alumn = request.user
 
         try:
-            event = Event.objects.get(pk=event_id)
-        except Event.DoesNotExist:
-            raise NotFound('Evento não encontrado.')
+            reserve, seats, available = claim_seats(request.user, event_id, [seat_id])
+        except TicketLimitReached as e:
+            return Response(data={'error': 'Você selecionou o máximo de assentos disponíveis ({0}) para sua reserva.'.format(e.max_tickets),
+                                  'info': 'Você deve finalizar sua reserva para confirmá-la e garantir seus assentos ou desmarcar um dos assentos selecionados.'},
+                            status=status.HTTP_300_MULTIPLE_CHOICES)
+
+        return Response(data={'success': 'O assento {0} foi adicionado a sua reserva.'.format(seats[0].slug),
+                              'info': 'Tempo de sessão atualizado para 20 minutos.',
+                              'available_tickets': available},
+                        status=status.HTTP_200_OK)
+
+    @list_route(methods=['get'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser],
+                url_path='by-code/(?P<code>[0-9A-Za-z]+)')
+    def by_code(self, request, code):
+        """
+        show the reserve of a code, looked up by the unique index on code
+        """
 
         try:
-            seat = Seat.objects.get(pk=seat_id)
-        except Seat.DoesNotExist:
+            reserve = self.get_queryset().get(code=code.upper())
+        except Reserve.DoesNotExist:
+            raise NotFound('Reserva não encontrada')
+
+        return Response(data=self.get_serializer(reserve).data, status=status.HTTP_200_OK)
+
+    @list_route(methods=['get'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='export')
+    def export(self, request):
+        """
+        stream every reserve with its alumn, event and seats, one line per reserve
+        """
+
+        params = request.query_params
+
+        output = params.get('output', 'ndjson')
+        if output not in ('ndjson', 'csv'):
+            raise ValidationError('Parâmetro \'output\' deve ser ndjson ou csv.')
+
+        try:
+            event_id = int(params['event']) if params.get('event') else None
+        except ValueError:
+            raise ValidationError('Parâmetro \'event\' inválido.')
+
+        paid = params.get('paid')
+        if paid not in (None, '', 'true', 'false'):
+            raise ValidationError('Parâmetro \'paid\' deve ser true ou false.')
+        is_paid = {'true': True, 'false': False}.get(paid)
+
+        rows = reserve_rows(event_id=event_id, is_paid=is_paid, chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+        if output == 'csv':
+            response = StreamingHttpResponse(to_csv(rows), content_type='text/csv; charset=utf-8')
+        else:
+            response = StreamingHttpResponse(to_ndjson(rows), content_type='application/x-ndjson; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="reservations{0}.{1}"'.format(
+            '-{0}'.format(event_id) if event_id else '', output)
+
+        return response
+
+    @list_route(methods=['post'], permission_classes=[rf_permissions.IsAuthenticated], url_path='add-seats')
+    def add_seats(self, request):
+        """
+        create reserve or add a list of seats to exist reserve, no seat is added if any of them is not available
+        """
+
+        if hasattr(request.data, 'getlist'):
+            seat_ids = request.data.getlist('seats')
+        else:
+            seat_ids = request.data.get('seats') or []
+        event_id = request.data.get('event')
+
+        if not isinstance(seat_ids, list) or not seat_ids:
+            raise ValidationError('Parâmetro \'seats\' não informado.')
+
+        try:
+            seat_ids = [int(seat_id) for seat_id in seat_ids]
+        except (TypeError, ValueError):
             raise NotFound('Assento não encontrado.')
 
-        reserve = Reserve.objects.filter(event_id=event_id, alumn=alumn)
-        if reserve.exists():  # add seat to reserve
-            reserve = reserve.get()
-            self.is_session_valid(reserve)
-            available = self.check_available_tickets(reserve, event.max_tickets)
-            if available[0]:
-                reserve.seats.add(seat)
-                reserve.save()
-            else:
-                return Response(data={'error': 'Você selecionou o máximo de assentos disponíveis ({0}) para sua reserva.'.format(event.max_tickets),
-                                      'info': 'Você deve finalizar sua reserva para confirmá-la e garantir seus assentos ou desmarcar um dos assentos selecionados.'},
-                                status=status.HTTP_300_MULTIPLE_CHOICES)
-        else:  # create the reserve
-            created = Reserve.objects.create(alumn=alumn, event=event)
-            created.seats.add(seat)
-            created.save()
-
-        return Response(data={'success': 'O assento {0} foi adicionado a sua reserva.'.format(seat.slug),
+        try:
+            reserve, seats, available = claim_seats(request.user, event_id, seat_ids)
+        except TicketLimitReached as e:
+            return Response(data={'error': 'Você selecionou o máximo de assentos disponíveis ({0}) para sua reserva.'.format(e.max_tickets),
+                                  'info': 'Você deve finalizar sua reserva para confirmá-la e garantir seus assentos ou desmarcar um dos assentos selecionados.',
+                                  'seats': [{'seat': seat_id, 'status': 'not_reserved'} for seat_id in seat_ids]},
+                            status=status.HTTP_300_MULTIPLE_CHOICES)
+        except SeatTaken as e:
+            return Response(data={'error': 'Alguns dos assentos selecionados já foram reservados. Nenhum assento foi adicionado a sua reserva.',
+                                  'seats': [{'seat': seat_id, 'status': 'taken' if seat_id in e.seats else 'not_reserved'}
+                                            for seat_id in seat_ids]},
+                            status=status.HTTP_409_CONFLICT)
+
+        return Response(data={'success': 'Os assentos {0} foram adicionados a sua reserva.'.format(', '.join(seat.slug for seat in seats)),
                               'info': 'Tempo de sessão atualizado para 20 minutos.',
-                              'available_tickets': available[1] - 1},
+                              'seats': [{'seat': seat.id, 'slug': seat.slug, 'status': 'reserved'} for seat in seats],
+                              'available_tickets': available},
                         status=status.HTTP_200_OK)
 
     @detail_route(methods=['post', 'get'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='cancel')
@@ -241,9 +613,8 @@ class ReserveViewSet(viewsets.ModelViewSet):
         if not cancel:
             raise ValidationError('Parâmetro \'cancel\' não informado.')
 
-        try:
-            Reserve.objects.filter(pk=pk).delete()
-        except Reserve.DoesNotExist: 
+        reserves, _ = Reserve.objects.filter(pk=pk).release()
+        if not reserves:
             raise NotFound('Reserva não encontrada')
 
         return Response(data={'success': 'Reserva foi cancelada com sucesso.'}, status=status.HTTP_200_OK)
@@ -263,14 +634,22 @@ class ReserveViewSet(viewsets.ModelViewSet):
         if not finished:
             raise ValidationError('Parâmetro \'finished\' não informado.')
 
-        try:
-            reserve = Reserve.objects.get(pk=pk)
-        except Reserve.DoesNotExist: 
-            raise NotFound('Reserva não encontrada')
+        with transaction.atomic():
+            try:
+                reserve = Reserve.objects.select_for_update().get(pk=pk)
+            except Reserve.DoesNotExist:
+                raise NotFound('Reserva não encontrada')
+
+            self.is_session_valid(reserve)
 
-        reserve.finished = True
-        reserve.code = self.create_hash()
-        reserve.save()
+            # a retried finish keeps the code given by the first one
+            if not reserve.finished or not reserve.code:
+                was_finished = reserve.finished
+                reserve.finished = True
+                save_with_code(reserve)
+
+                if not was_finished:
+                    reserves_finished.send(sender=Reserve, event_id=reserve.event_id, reserve_ids=[reserve.pk])
 
         return Response(data={'success': 'Solicitação de reserva concluída.',
                               'info': 'Após a confirmação do pagamento você poderá imprimir seu comprovante de reserva.'}, 
@@ -291,24 +670,63 @@ class ReserveViewSet(viewsets.ModelViewSet):
         if not paid:
             raise ValidationError('Parâmetro \'paid\' não informado.')
 
-        try:
-            reserve = Reserve.objects.get(pk=pk)
-        except Reserve.DoesNotExist:
-            raise NotFound('Reserva não encontrada')
+        with transaction.atomic():
+            try:
+                reserve = Reserve.objects.select_for_update().get(pk=pk)
+            except Reserve.DoesNotExist:
+                raise NotFound('Reserva não encontrada')
+
+            was_paid = reserve.is_paid
+            reserve.is_paid = True
+            reserve.save()
 
-        reserve.paid = True
-        reserve.save()
+            # a reserve is counted and streamed as paid once, paying it again only refreshes it
+            if not was_paid:
+                seats_paid.send(sender=Reserve, event_id=reserve.event_id, seat_ids=list(reserve.seats.values_list('id', flat=True)),
+                                reserve_ids=[reserve.pk])
 
         return Response(data={'success': 'Pagamento confirmado.'}, status=status.HTTP_200_OK)
 
+    @list_route(methods=['post'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='bulk-paid')
+    def bulk_paid(self, request):
+        """
+        confirm payment received for a list of reserves, each one gets its status: paid, already_paid or not_found
+        """
+
+        return self.bulk_response(bulk.pay(*self.get_bulk_reserves(request.data)))
+
+    @list_route(methods=['post'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='bulk-finish')
+    def bulk_finish(self, request):
+        """
+        finish a list of reserves, each one gets its status: finished, already_finished, expired or not_found
+        """
+
+        return self.bulk_response(bulk.finish(*self.get_bulk_reserves(request.data)))
+
+    @list_route(methods=['post'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='bulk-cancel')
+    def bulk_cancel(self, request):
+        """
+        cancel a list of reserves and release their seats, each one gets its status: cancelled or not_found
+        """
+
+        return self.bulk_response(bulk.cancel(*self.get_bulk_reserves(request.data)))
+
+    @list_route(methods=['get'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='throttles')
+    def throttles(self, request):
+        """
+        show the rate of each throttle scope and the calls it refused
+        """
+
+        return Response(data=get_stats(), status=status.HTTP_200_OK)
+
     @detail_route(methods=['get'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='view-confirmation')
     def get_confirmation(self, request, pk):
-        context = self.get_confirmation_context(pk)
-        return render_to_pdf('booking-confirmation.html', context)
+        context = get_confirmation_context(pk)
+        return render_to_pdf('booking-confirmation.html', context, poll_url=request.build_absolute_uri())
 
     @detail_route(methods=['get'], permission_classes=[rf_permissions.IsAuthenticated, rf_permissions.IsAdminUser], url_path='send-confirmation')
     def send_confirmation_mail(self, request, pk):
-        context = self.get_confirmation_context(pk)
+        context = get_confirmation_context(pk)
         error = send_mail(template_src='emails/booking-confirmation.html', context=context, 
             mail_from='no-reply@gmail.com', mail_to='rdgsdev@gmail.com')
 